@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+
+NUM_WORKERS = 16
+BATCH = 16  # messages an actor handles before it lets other actors have the worker thread
+
+
+class Actor(object):
+    """
+    The mailbox of one key (e.g. one game) and how many of its messages have been handled.
+    """
+    __slots__ = ("key", "mailbox", "scheduled", "handled", "total_wait")
+
+    def __init__(self, key):
+        self.key = key
+        self.mailbox = deque()  # (time queued, function, args, kwargs, Future)
+        self.scheduled = False  # whether a worker is handling (or about to handle) the mailbox
+        self.handled = 0
+        self.total_wait = 0.0
+
+
+class ActorPool(object):
+    """
+    Runs functions one after the other per key, on a shared pool of worker threads.
+
+    Everything submitted with the same key is handled strictly in the order it
+    was submitted and never concurrently, while different keys run in
+    parallel. An actor only exists while it has messages queued or in
+    flight, so idle games cost nothing.
+    """
+
+    def __init__(self, workers=NUM_WORKERS, batch=BATCH):
+        self.batch = batch
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="actor")
+        self._lock = threading.Condition()
+        self._actors = {}  # key -> Actor
+        self._stopped = False
+
+    def submit(self, key, function, *args, **kwargs):
+        """
+        Queue function(*args, **kwargs) in the mailbox of `key`. Returns a Future of its result.
+        """
+        future = Future()
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("the actor pool has been stopped")
+            actor = self._actors.get(key)
+            if actor is None:
+                actor = self._actors[key] = Actor(key)
+            actor.mailbox.append((time.monotonic(), function, args, kwargs, future))
+            schedule = not actor.scheduled
+            actor.scheduled = True
+        if schedule:
+            self._executor.submit(self._run, actor)
+        return future
+
+    def _run(self, actor):
+        for _ in range(self.batch):
+            with self._lock:
+                if not actor.mailbox:
+                    actor.scheduled = False
+                    del self._actors[actor.key]
+                    self._lock.notify_all()
+                    return
+                queued, function, args, kwargs, future = actor.mailbox.popleft()
+            wait = time.monotonic() - queued
+            actor.handled += 1
+            actor.total_wait += wait
+            metrics.ACTOR_WAIT_SECONDS.observe(wait)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                logging.getLogger(__name__).exception("Actor %s failed", actor.key)
+                future.set_exception(e)
+        self._executor.submit(self._run, actor)  # to the back of the line, after the other actors' turns
+
+    def stats(self):
+        """
+        Returns {key: (messages queued, seconds the oldest of them has been waiting, messages handled, their mean
+        wait in seconds)} of all busy actors
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {key: (len(actor.mailbox), now - actor.mailbox[0][0] if actor.mailbox else 0.0, actor.handled,
+                          actor.total_wait / actor.handled if actor.handled else 0.0)
+                    for key, actor in self._actors.items()}
+
+    def stop(self, timeout=None):
+        """
+        Stop taking messages, handle everything that is queued and stop the workers. Returns False on timeout.
+        """
+        with self._lock:
+            self._stopped = True
+            done = self._lock.wait_for(lambda: not self._actors, timeout)
+        self._executor.shutdown(wait=done)
+        return done
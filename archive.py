@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+ARCHIVE_FILE = "ignore/archive.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    started REAL,
+    ended REAL,
+    num_players INTEGER NOT NULL,
+    winner TEXT NOT NULL,
+    mudista INTEGER NOT NULL,
+    chavista INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS games_by_chat ON games (chat_id);
+
+CREATE TABLE IF NOT EXISTS seats (
+    game_id INTEGER NOT NULL REFERENCES games (id),
+    seat INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    role TEXT NOT NULL,
+    won INTEGER NOT NULL,
+    died INTEGER NOT NULL,
+    PRIMARY KEY (game_id, seat)
+);
+CREATE INDEX IF NOT EXISTS seats_by_user ON seats (user_id);
+
+CREATE TABLE IF NOT EXISTS elections (
+    game_id INTEGER NOT NULL REFERENCES games (id),
+    number INTEGER NOT NULL,
+    president_seat INTEGER NOT NULL,
+    chancellor_seat INTEGER NOT NULL,
+    passed INTEGER NOT NULL,
+    PRIMARY KEY (game_id, number)
+);
+
+CREATE TABLE IF NOT EXISTS votes (
+    game_id INTEGER NOT NULL,
+    election INTEGER NOT NULL,
+    seat INTEGER NOT NULL,
+    ja INTEGER NOT NULL,
+    PRIMARY KEY (game_id, election, seat),
+    FOREIGN KEY (game_id, election) REFERENCES elections (game_id, number)
+);
+
+CREATE TABLE IF NOT EXISTS legislations (
+    game_id INTEGER NOT NULL REFERENCES games (id),
+    number INTEGER NOT NULL,
+    president_seat INTEGER NOT NULL,
+    chancellor_seat INTEGER NOT NULL,
+    drawn TEXT NOT NULL,
+    passed TEXT,
+    president_claim TEXT,
+    chancellor_claim TEXT,
+    result TEXT,
+    veto INTEGER NOT NULL,
+    PRIMARY KEY (game_id, number)
+);
+
+-- aggregates, updated together with every archived game
+
+CREATE TABLE IF NOT EXISTS player_stats (
+    user_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    games INTEGER NOT NULL DEFAULT 0,
+    wins INTEGER NOT NULL DEFAULT 0,
+    mudista_games INTEGER NOT NULL DEFAULT 0,
+    mudista_wins INTEGER NOT NULL DEFAULT 0,
+    chavista_games INTEGER NOT NULL DEFAULT 0,
+    chavista_wins INTEGER NOT NULL DEFAULT 0,
+    chavez_games INTEGER NOT NULL DEFAULT 0,
+    chavez_wins INTEGER NOT NULL DEFAULT 0,
+    deaths INTEGER NOT NULL DEFAULT 0,
+    ja INTEGER NOT NULL DEFAULT 0,
+    nein INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS group_stats (
+    chat_id INTEGER PRIMARY KEY,
+    games INTEGER NOT NULL DEFAULT 0,
+    mudista_wins INTEGER NOT NULL DEFAULT 0,
+    chavista_wins INTEGER NOT NULL DEFAULT 0,
+    players INTEGER NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0
+);
+"""
+
+ROLE_COLUMNS = {"mudista": "mudista", "chavista": "chavista", "Chavez": "chavez"}
+PLAYER_STATS = ("games", "wins", "mudista_games", "mudista_wins", "chavista_games", "chavista_wins",
+                "chavez_games", "chavez_wins", "deaths", "ja", "nein")
+GROUP_STATS = ("games", "mudista_wins", "chavista_wins", "players", "seconds")
+
+
+def game_record(game):
+    """
+    Everything the archive keeps about a decided game, as plain values (so it can be written in the background)
+    """
+    record = {
+        "game": (game.global_chat, game.seed, game.timings.term_start[0] if game.timings.term_start else None,
+                 game.now(), game.num_players, game.winner, game.mudista, game.chavista),
+        "seats": [(seat, user_id, name, role, int(role.replace("Chavez", "chavista") == game.winner),
+                   game.dead_seats >> seat & 1) for seat, (user_id, name, role) in enumerate(game.roster)],
+        "elections": [(number, game.seat_of.get(election.president, -1), game.seat_of.get(election.chancellor, -1),
+                       int(election.passed))
+                      for number, election in enumerate(game.elections)],
+        "votes": [(number, seat, int(vote)) for number, election in enumerate(game.elections)
+                  for seat, vote in enumerate(election.votes) if vote is not None],
+        "legislations": [(number, game.seat_of.get(legislation.president, -1),
+                          game.seat_of.get(legislation.chancellor, -1), legislation.drawn,
+                          legislation.passed, legislation.president_claim, legislation.chancellor_claim,
+                          legislation.result, int(legislation.veto))
+                         for number, legislation in enumerate(game.legislations)],
+    }
+    return record
+
+
+class Archive(object):
+    """
+    SQLite archive of decided games.
+
+    archive(game) only takes a copy of the game's data; a background thread
+    writes it, and updates the per-player and per-group aggregates in the
+    same transaction, so that player_stats() and group_stats() are single
+    primary key lookups.
+    """
+
+    def __init__(self, fname=ARCHIVE_FILE):
+        self.fname = fname
+        directory = os.path.dirname(fname)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._pending = queue.Queue()
+        self._thread = None
+
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        connection.close()
+        self._reader = self._connect()
+        self._reader_lock = threading.Lock()
+
+    def _connect(self):
+        # several processes (see sharding.py) may write to the same archive
+        connection = sqlite3.connect(self.fname, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write, name="archive")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Write everything that is still queued, then stop the writer
+        """
+        self._pending.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def archive(self, game):
+        """
+        Queue a game that is over for archiving. Games without a winner (e.g. cancelled ones) are not archived.
+        """
+        if game.winner is None:
+            return
+        self._pending.put(game_record(game))
+
+    def _write(self):
+        connection = self._connect()
+        while True:
+            record = self._pending.get()
+            if record is None:
+                break
+            try:
+                with connection:
+                    self._insert(connection, record)
+            except Exception:  # a bad record must not stop the writer, or every later game would be lost
+                logging.getLogger(__name__).exception("Archiving a game in chat %s failed", record["game"][0])
+        connection.close()
+
+    @staticmethod
+    def _insert(connection, record):
+        game_id = connection.execute(
+            "INSERT INTO games (chat_id, seed, started, ended, num_players, winner, mudista, chavista) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", record["game"]).lastrowid
+        connection.executemany("INSERT INTO seats VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [(game_id,) + seat for seat in record["seats"]])
+        connection.executemany("INSERT INTO elections VALUES (?, ?, ?, ?, ?)",
+                               [(game_id,) + election for election in record["elections"]])
+        connection.executemany("INSERT INTO votes VALUES (?, ?, ?, ?)",
+                               [(game_id,) + vote for vote in record["votes"]])
+        connection.executemany("INSERT INTO legislations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               [(game_id,) + legislation for legislation in record["legislations"]])
+
+        # aggregates
+        votes = {}  # seat -> [ja, nein]
+        for _, seat, ja in record["votes"]:
+            votes.setdefault(seat, [0, 0])[0 if ja else 1] += 1
+        for seat, user_id, name, role, won, died in record["seats"]:
+            increments = dict.fromkeys(PLAYER_STATS, 0)
+            increments.update(games=1, wins=won, deaths=died)
+            increments[ROLE_COLUMNS[role] + "_games"] = 1
+            increments[ROLE_COLUMNS[role] + "_wins"] = won
+            increments["ja"], increments["nein"] = votes.get(seat, (0, 0))
+            connection.execute(
+                "INSERT INTO player_stats (user_id, name, {0}) VALUES (?, ?, {1}) "
+                "ON CONFLICT (user_id) DO UPDATE SET name = excluded.name, {2}".format(
+                    ", ".join(PLAYER_STATS), ", ".join("?" * len(PLAYER_STATS)),
+                    ", ".join("{0} = {0} + excluded.{0}".format(column) for column in PLAYER_STATS)),
+                [user_id, name] + [increments[column] for column in PLAYER_STATS])
+
+        chat_id, _, started, ended, num_players, winner = record["game"][:6]
+        increments = (1, int(winner == "mudista"), int(winner == "chavista"), num_players,
+                      ended - started if started is not None else 0)
+        connection.execute(
+            "INSERT INTO group_stats (chat_id, {0}) VALUES (?, {1}) ON CONFLICT (chat_id) DO UPDATE SET {2}".format(
+                ", ".join(GROUP_STATS), ", ".join("?" * len(GROUP_STATS)),
+                ", ".join("{0} = {0} + excluded.{0}".format(column) for column in GROUP_STATS)),
+            (chat_id,) + increments)
+
+    def player_stats(self, user_id):
+        """
+        Returns a dict of the aggregates of a user (see PLAYER_STATS), or None if they have no archived games
+        """
+        return self._lookup("SELECT name, {} FROM player_stats WHERE user_id = ?".format(", ".join(PLAYER_STATS)),
+                            user_id, ("name",) + PLAYER_STATS)
+
+    def group_stats(self, chat_id):
+        """
+        Returns a dict of the aggregates of a group (see GROUP_STATS), or None if it has no archived games
+        """
+        return self._lookup("SELECT {} FROM group_stats WHERE chat_id = ?".format(", ".join(GROUP_STATS)),
+                            chat_id, GROUP_STATS)
+
+    def _lookup(self, query, key, columns):
+        with self._reader_lock:
+            row = self._reader.execute(query, (key,)).fetchone()
+        return None if row is None else dict(zip(columns, row))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""
+A local stand-in for the Telegram Bot API, for load tests without the network.
+
+It implements what the bot uses: getMe, getUpdates (long polling), sendMessage,
+editMessageText, editMessageReplyMarkup, answerCallbackQuery, getChat,
+getChatAdministrators, getMyCommands and exportChatInviteLink. Every other
+method just succeeds. Updates are pushed in by a driver (see load_test.py), which also
+sees every call the bot makes.
+
+Calls can be slowed down by a random latency, and a share of them can fail
+with 429 (flood control) or, for private chats, 403 (the user blocked the
+bot). To point the bot at a running server, put its URL into config/api_url:
+
+    python benchmarks/fake_bot_api.py [--port 8081] [--latency 0.05] [--flood 0.01] [--blocked 0.001]
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+BOT_ID = 1000
+SENDING_METHODS = ("sendMessage", "editMessageText", "editMessageReplyMarkup")  # subject to injected errors
+
+
+class ApiError(Exception):
+    def __init__(self, code, description, parameters=None):
+        Exception.__init__(self, description)
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeBotApi(object):
+    """
+    The fake server's state: the queue of updates, the chats it knows and the messages the bot sent.
+
+    `on_call(method, params, result)` is called (on the server's threads) for every successful call but
+    getUpdates. Group chats are known from the updates that mention them; their admin is the first user that
+    wrote in them.
+    """
+
+    def __init__(self, username="fake_bot", listen="127.0.0.1", port=0, latency=0.0, flood=0.0, retry_after=1,
+                 blocked=0.0, seed=None, on_call=None):
+        self.username = username
+        self.latency = latency  # mean seconds per call (uniformly spread between half and one and a half of it)
+        self.flood = flood  # share of sending calls answered with 429
+        self.retry_after = retry_after
+        self.blocked = blocked  # share of sending calls to private chats answered with 403
+        self.on_call = on_call
+        self.rng = random.Random(seed)
+
+        self.calls = {}  # method -> count
+        self.errors = {}  # HTTP status -> count
+        self.updates_delivered = 0
+        self._updates = []  # [update dict], ordered by update_id
+        self._next_update_id = 1
+        self._chats = {}  # chat id -> chat dict
+        self._admins = {}  # chat id -> user dict
+        self._next_message_id = 1
+        self._lock = threading.Condition()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode("utf-8") if length else ""
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body) if body else {}
+                else:
+                    params = dict(urllib.parse.parse_qsl(body))
+                self.respond(params)
+
+            def do_GET(self):
+                self.respond(dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query)))
+
+            def respond(self, params):
+                method = urllib.parse.urlparse(self.path).path.rsplit("/", 1)[-1]
+                status, payload = api.call(method, params)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((listen, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.httpd.server_address[:2])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-bot-api")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def push_update(self, update):
+        """
+        Queue an update (without "update_id", which is assigned here) for getUpdates. Returns its update_id.
+        """
+        message = update.get("message") or (update.get("callback_query") or {}).get("message")
+        with self._lock:
+            update["update_id"] = self._next_update_id
+            self._next_update_id += 1
+            if message is not None:
+                chat = message["chat"]
+                self._chats.setdefault(chat["id"], chat)
+                if "from" in message and chat["type"] != "private":
+                    self._admins.setdefault(chat["id"], message["from"])
+            self._updates.append(update)
+            self._lock.notify_all()
+        return update["update_id"]
+
+    def pending_updates(self):
+        with self._lock:
+            return len(self._updates)
+
+    def call(self, method, params):
+        """
+        Returns (HTTP status, response) of a Bot API call
+        """
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        try:
+            if method == "getUpdates":
+                result = self.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0),
+                                          int(params.get("limit") or 100))
+            else:
+                if self.latency:
+                    time.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+                if method in SENDING_METHODS:
+                    self.inject_errors(int(params["chat_id"]))
+                result = self.handle(method, params)
+        except ApiError as e:
+            with self._lock:
+                self.errors[e.code] = self.errors.get(e.code, 0) + 1
+            response = {"ok": False, "error_code": e.code, "description": e.description}
+            if e.parameters:
+                response["parameters"] = e.parameters
+            return e.code, response
+        if method != "getUpdates" and self.on_call is not None:
+            self.on_call(method, params, result)
+        return 200, {"ok": True, "result": result}
+
+    def inject_errors(self, chat_id):
+        if self.flood and self.rng.random() < self.flood:
+            raise ApiError(429, "Too Many Requests: retry after {}".format(self.retry_after),
+                           {"retry_after": self.retry_after})
+        if chat_id > 0 and self.blocked and self.rng.random() < self.blocked:
+            raise ApiError(403, "Forbidden: bot was blocked by the user")
+
+    def get_updates(self, offset, timeout, limit):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            # updates before the offset have been handled
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._lock.wait(remaining)
+            updates = self._updates[:limit]
+            self.updates_delivered += len(updates)  # (counts updates again if the bot fetches them twice)
+            return updates
+
+    def chat(self, chat_id):
+        with self._lock:
+            chat = self._chats.get(chat_id)
+        if chat is None:
+            if chat_id > 0:
+                chat = {"id": chat_id, "type": "private", "first_name": "User{}".format(chat_id)}
+            else:
+                chat = {"id": chat_id, "type": "supergroup", "title": "Group {}".format(-chat_id)}
+        return chat
+
+    def message(self, params):
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        message = {"message_id": int(params.get("message_id") or message_id), "date": int(time.time()),
+                   "chat": self.chat(int(params["chat_id"])),
+                   "from": {"id": BOT_ID, "is_bot": True, "first_name": "Fake", "username": self.username}}
+        if "text" in params:
+            message["text"] = params["text"]
+        reply_markup = params.get("reply_markup")
+        if isinstance(reply_markup, str):  # python-telegram-bot sends it as a JSON string
+            reply_markup = json.loads(reply_markup)
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+        return message
+
+    def handle(self, method, params):
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Fake", "username": self.username}
+        elif method in SENDING_METHODS:
+            return self.message(params)
+        elif method == "getChat":
+            chat = dict(self.chat(int(params["chat_id"])))
+            if chat["type"] != "private":
+                chat["invite_link"] = "https://t.me/joinchat/fake{}".format(-chat["id"])
+            return chat
+        elif method == "getChatAdministrators":
+            chat_id = int(params["chat_id"])
+            with self._lock:
+                admin = self._admins.get(chat_id)
+            return [{"user": admin, "status": "creator"}] if admin is not None else []
+        elif method == "getMyCommands":
+            return []
+        elif method == "exportChatInviteLink":
+            return "https://t.me/joinchat/fake{}".format(-int(params["chat_id"]))
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--username", default="fake_bot")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds per call")
+    parser.add_argument("--flood", type=float, default=0.0, help="share of sending calls that get a 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked", type=float, default=0.0, help="share of private sends that get a 403")
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.username, args.listen, args.port, args.latency, args.flood, args.retry_after,
+                     args.blocked)
+    api.start()
+    print("Fake Bot API at {}".format(api.url))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+Startup benchmark: measures how long importing the bot's modules takes in a fresh interpreter.
+
+Run from the repository root (bot_telegram reads its files from config/):
+
+    python benchmarks/import_time.py [--runs N] [--max SECONDS]
+
+Exits with status 1 if the median import time of any module exceeds --max, so it can guard
+against expensive work creeping back into module level.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+MODULES = ("secret_hitler", "bot_telegram")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE = "import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)"
+
+
+def import_time(module):
+    """
+    Import `module` in a new interpreter and return the time it took in seconds
+    """
+    output = subprocess.check_output([sys.executable, "-c", MEASURE.format(module)], cwd=ROOT)
+    return float(output.decode().split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per module")
+    parser.add_argument("--max", type=float, default=1.0, help="allowed median import time in seconds")
+    args = parser.parse_args()
+
+    too_slow = False
+    for module in MODULES:
+        try:
+            timings = [import_time(module) for _ in range(args.runs)]
+        except subprocess.CalledProcessError:
+            print("{}: import failed".format(module))
+            too_slow = True
+            continue
+        median = statistics.median(timings)
+        print("{}: median {:.3f}s, min {:.3f}s, max {:.3f}s over {} runs".format(
+            module, median, min(timings), max(timings), args.runs))
+        if median > args.max:
+            print("  exceeds the limit of {:.3f}s".format(args.max))
+            too_slow = True
+
+    sys.exit(1 if too_slow else 0)
+
+
+if __name__ == "__main__":
+    main()
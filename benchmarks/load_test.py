@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end load test: runs the real bot (bot_telegram.py, with all handlers of
+main()) against the fake Bot API of fake_bot_api.py and lets simulated players
+play full games in many group chats at once.
+
+The players create and join games, start them and press random buttons of the
+keyboards they get, after a random think time. Players the bot can't reach
+message it again, like real ones would. Games that don't make progress for
+--stuck seconds are cancelled. Run from the repository root:
+
+    python benchmarks/load_test.py [--groups 200] [--duration 120] [--latency 0.05] [--flood 0.01] [--blocked 0.001]
+
+Reports updates/sec, finished games and the latency from an update to the
+bot's reaction: the answer of a button press, or the next message or edit in
+the group of a command. The bot's own rate limits (see message_queue.py)
+apply, so in busy groups latency includes waiting for them. Exits with status
+1 if no game finished or the p99 latency exceeds --max-p99.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotApi
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = "load_test_bot"
+USER_ID_REGEX = re.compile(r"tg://user\?id=(\d+)")
+
+
+def percentiles(values, fractions=(0.5, 0.9, 0.99, 1)):
+    values = sorted(values)
+    if not values:
+        return [0.0] * len(fractions)
+    return [values[min(len(values) - 1, int(f * len(values)))] for f in fractions]
+
+
+class Group(object):
+    """
+    A simulated group chat with its players
+    """
+
+    def __init__(self, index, num_players):
+        self.chat = {"id": -1000000 - index, "type": "group", "title": "Load test {}".format(index)}
+        self.users = [{"id": (index + 1) * 100 + seat, "is_bot": False, "first_name": "P{}x{}".format(index, seat)}
+                      for seat in range(num_players)]
+        self.welcomed = 0  # players that have joined the current game
+        self.started = None  # time the current game was created
+        self.last_seen = time.monotonic()  # last message of the bot in the group
+
+
+class Driver(object):
+    """
+    Plays the simulated players. It reacts to the bot's calls (reported by the fake API on its threads) and to
+    its own timers on a single thread.
+    """
+
+    def __init__(self, api, groups, think, stuck, rng):
+        self.api = api
+        self.groups = {group.chat["id"]: group for group in groups}
+        self.group_of_user = {user["id"]: group for group in groups for user in group.users}
+        self.think = think
+        self.stuck = stuck
+        self.rng = rng
+        self.running = True  # False once no new games should be created
+
+        self.events = queue.Queue()  # (method, params, result) of the bot's calls
+        self._timers = []  # heap of (due, sequence number, function, args)
+        self._sequence = itertools.count()
+        self._message_ids = itertools.count(1)
+        self._update_times = defaultdict(deque)  # chat id -> times of the commands sent there without reaction yet
+        self._callback_times = {}  # callback query id -> time it was sent
+
+        self.command_latencies = []
+        self.button_latencies = []
+        self.game_seconds = []
+        self.games_finished = 0
+        self.games_cancelled = 0
+        self.updates_sent = 0
+
+    def on_call(self, method, params, result):
+        self.events.put((method, params, result))
+
+    def later(self, delay, function, *args):
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), function, args))
+
+    def think_time(self):
+        return self.rng.uniform(0.5, 1.5) * self.think
+
+    def run(self, until):
+        for group in self.groups.values():
+            self.later(self.rng.uniform(0, 5), self.new_game, group)
+        self.later(self.stuck, self.check_stuck)
+        while time.monotonic() < until:
+            while self._timers and self._timers[0][0] <= time.monotonic():
+                _, _, function, args = heapq.heappop(self._timers)
+                function(*args)
+            timeout = min(1.0, max(0.0, self._timers[0][0] - time.monotonic())) if self._timers else 1.0
+            try:
+                self.react(*self.events.get(timeout=timeout))
+            except queue.Empty:
+                pass
+
+    # updates
+
+    def send_text(self, user, chat, text):
+        message = {"message_id": next(self._message_ids), "from": user, "chat": chat, "date": int(time.time()),
+                   "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            if chat["type"] != "private":
+                self._update_times[chat["id"]].append(time.monotonic())
+        self.api.push_update({"message": message})
+        self.updates_sent += 1
+
+    def press(self, user, message, data):
+        query_id = "{}".format(next(self._message_ids))
+        self._callback_times[query_id] = time.monotonic()
+        self.api.push_update({"callback_query": {"id": query_id, "from": user, "chat_instance": query_id,
+                                                 "data": data, "message": message}})
+        self.updates_sent += 1
+
+    def new_game(self, group):
+        if not self.running:
+            return
+        group.welcomed = 0
+        group.started = time.monotonic()
+        group.last_seen = time.monotonic()
+        self.send_text(group.users[0], group.chat, "/newgame confirm")
+
+    def check_stuck(self):
+        now = time.monotonic()
+        for group in self.groups.values():
+            if group.started is not None and now - group.last_seen > self.stuck:
+                group.started = None
+                self.send_text(group.users[0], group.chat, "/cancelgame")
+                self.later(self.think_time(), self.new_game, group)
+        self.later(self.stuck, self.check_stuck)
+
+    # reactions to the bot
+
+    def react(self, method, params, result):
+        if method == "answerCallbackQuery":
+            sent = self._callback_times.pop(params.get("callback_query_id"), None)
+            if sent is not None:
+                self.button_latencies.append(time.monotonic() - sent)
+            return
+        if method not in ("sendMessage", "editMessageText"):
+            return
+        chat_id = int(params["chat_id"])
+        waiting = self._update_times.get(chat_id)
+        while waiting:
+            self.command_latencies.append(time.monotonic() - waiting.popleft())
+
+        if chat_id > 0:
+            keyboard = result.get("reply_markup", {}).get("inline_keyboard")
+            if keyboard and chat_id in self.group_of_user:
+                user = next(user for user in self.group_of_user[chat_id].users if user["id"] == chat_id)
+                button = self.rng.choice([button for row in keyboard for button in row])
+                self.later(self.think_time(), self.press, user, result, button["callback_data"])
+            return
+
+        group = self.groups.get(chat_id)
+        if group is None or method != "sendMessage":
+            return
+        group.last_seen = time.monotonic()
+        text = params.get("text", "")
+        if "Created game!" in text:
+            for user in group.users:
+                self.later(self.think_time(), self.send_text, user, group.chat, "/joingame")
+        if "Welcome, " in text:
+            group.welcomed += text.count("Welcome, ")
+            if group.welcomed == len(group.users):
+                self.later(self.think_time(), self.send_text, group.users[0], group.chat, "/startgame")
+        if "must message/unblock me" in text or "I can't send" in text:
+            for user_id in USER_ID_REGEX.findall(text):
+                user = {"id": int(user_id), "is_bot": False, "first_name": "Returning"}
+                self.later(self.think_time(), self.send_text, user,
+                           {"id": int(user_id), "type": "private", "first_name": "Returning"}, "hi")
+            if "must message/unblock me" in text:
+                self.later(2 * self.think + 1, self.send_text, group.users[0], group.chat, "/startgame")
+        if "team wins!" in text and group.started is not None:
+            if "cancelled" in text:
+                self.games_cancelled += 1
+            else:
+                self.games_finished += 1
+                self.game_seconds.append(time.monotonic() - group.started)
+            group.started = None
+            self.later(self.think_time(), self.new_game, group)
+
+
+def write_config(directory, api_url):
+    os.makedirs(os.path.join(directory, "config"))
+    for name, value in (("key", "123456:LOADTEST"), ("devchat", "-1"), ("username", USERNAME),
+                        ("api_url", api_url)):
+        with open(os.path.join(directory, "config", name), "w") as config_file:
+            config_file.write(value + "\n")
+    os.symlink(os.path.join(ROOT, "static_responses"), os.path.join(directory, "static_responses"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=120, help="seconds of load")
+    parser.add_argument("--think", type=float, default=1.0, help="mean seconds players take to act")
+    parser.add_argument("--stuck", type=float, default=60, help="cancel games without progress for this long")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds per Bot API call")
+    parser.add_argument("--flood", type=float, default=0.0, help="share of sending calls that get a 429")
+    parser.add_argument("--blocked", type=float, default=0.0, help="share of private sends that get a 403")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-p99", type=float, help="fail if the p99 latency exceeds this many seconds")
+    parser.add_argument("--output", help="write the results to this file as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the bot's working directory (and its log)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    groups = [Group(i, 5 + i % 6) for i in range(args.groups)]
+    api = FakeBotApi(USERNAME, latency=args.latency, flood=args.flood, blocked=args.blocked, seed=args.seed)
+    driver = Driver(api, groups, args.think, args.stuck, rng)
+    api.on_call = driver.on_call
+    api.start()
+
+    directory = tempfile.mkdtemp(prefix="load_test_")
+    write_config(directory, api.url)
+    log = open(os.path.join(directory, "bot.log"), "w")
+    bot = subprocess.Popen([sys.executable, os.path.join(ROOT, "bot_telegram.py")], cwd=directory,
+                           stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 60
+        while not api.calls.get("getUpdates"):
+            if bot.poll() is not None or time.monotonic() > deadline:
+                sys.exit("the bot didn't start, see {}".format(log.name))
+            time.sleep(0.1)
+
+        start = time.monotonic()
+        driver.run(start + args.duration)
+        elapsed = time.monotonic() - start
+        driver.running = False
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        api.stop()
+        log.close()
+
+    latencies = driver.command_latencies + driver.button_latencies
+    results = {
+        "groups": args.groups,
+        "seconds": elapsed,
+        "updates": driver.updates_sent,
+        "updates_per_sec": api.updates_delivered / elapsed,
+        "games_finished": driver.games_finished,
+        "games_cancelled": driver.games_cancelled,
+        "game_seconds_p50": percentiles(driver.game_seconds)[0],
+        "latency": dict(zip(("p50", "p90", "p99", "max"), percentiles(latencies))),
+        "command_latency": dict(zip(("p50", "p90", "p99", "max"), percentiles(driver.command_latencies))),
+        "button_latency": dict(zip(("p50", "p90", "p99", "max"), percentiles(driver.button_latencies))),
+        "api_calls": api.calls,
+        "api_errors": {str(code): count for code, count in api.errors.items()},
+    }
+    print("{} groups for {:.0f}s: {} updates ({:.1f} updates/sec), {} games finished, {} cancelled".format(
+        args.groups, elapsed, driver.updates_sent, results["updates_per_sec"], driver.games_finished,
+        driver.games_cancelled))
+    for name in ("latency", "command_latency", "button_latency"):
+        print("{:16} p50 {p50:.3f}s  p90 {p90:.3f}s  p99 {p99:.3f}s  max {max:.3f}s".format(name, **results[name]))
+    print("API calls: {}".format(", ".join("{} {}".format(method, count)
+                                           for method, count in sorted(api.calls.items()))))
+    if api.errors:
+        print("Injected errors: {}".format(results["api_errors"]))
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(results, out_file, indent=2)
+    if args.keep:
+        print("Bot log: {}".format(log.name))
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    failed = driver.games_finished == 0
+    if args.max_p99 is not None and results["latency"]["p99"] > args.max_p99:
+        print("p99 latency exceeds the limit of {:.3f}s".format(args.max_p99))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless simulation harness and throughput benchmark for the game engine.
+
+Plays complete games through Game.handle_message with a null transport and
+simulated players, checks the game's invariants after every command and
+reports games/sec plus handler latency percentiles per game state. Run from
+the repository root:
+
+    python benchmarks/simulate.py [--games N] [--seed S] [--output FILE] [--baseline FILE]
+
+The results are written to FILE as JSON. With --baseline, the run fails if
+its games/sec dropped by more than --tolerance compared to an earlier result.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import secret_hitler
+from secret_hitler import GameStates
+
+MAX_COMMANDS_PER_GAME = 2000  # a game that takes longer is considered stuck
+CLAIMS = ("FFF", "FFL", "FLL", "LLL", "FF", "FL", "LL")
+QUERIES = ("logs", "boardstats", "deckstats", "listplayers", "timelogs", "blame")
+
+
+class NullTransport(secret_hitler.Transport):
+    """
+    Counts messages instead of sending them.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.live_texts = {}  # (chat id, key) -> text
+
+    def send(self, chat_id, text, supress_errors=True, **kwargs):
+        self.messages += 1
+        delivery = Future()
+        delivery.set_result(None)
+        return delivery
+
+    def live(self, chat_id, key, text):
+        if self.live_texts.get((chat_id, key)) != text:  # not debounced, so this overcounts the edits
+            self.live_texts[(chat_id, key)] = text
+            self.messages += 1
+
+    def end_live(self, chat_id, key):
+        self.live_texts.pop((chat_id, key), None)
+
+
+class RandomAgent(object):
+    """
+    Picks uniformly among the moves it is offered. Also claims and asks for stats now and then.
+    """
+
+    def __init__(self, rng, chatter=0.1):
+        self.rng = rng
+        self.chatter = chatter
+
+    def choose(self, game, player, moves):
+        return self.rng.choice(moves)
+
+    def extra(self, game, player):
+        """
+        Returns an optional command that isn't required to advance the game
+        """
+        if self.rng.random() < self.chatter:
+            return "claim", self.rng.choice(CLAIMS)
+        if self.rng.random() < self.chatter:
+            return self.rng.choice(QUERIES), ""
+        return None
+
+
+class ScriptedAgent(object):
+    """
+    Plays a fixed list of (command, args) moves, whether they are valid or not, then hands over to `fallback`.
+    """
+
+    def __init__(self, script, fallback=None):
+        self.script = list(script)
+        self.fallback = fallback
+
+    def choose(self, game, player, moves):
+        if self.script:
+            return self.script.pop(0)
+        return self.fallback.choose(game, player, moves)
+
+    def extra(self, game, player):
+        return None if self.fallback is None else self.fallback.extra(game, player)
+
+
+def alive(game):
+    return game.alive_players()
+
+
+def pending_move(game):
+    """
+    Returns the player who has to act next and the moves available to them
+    """
+    state = game.game_state
+    president = game.president
+    if state == GameStates.CHANCY_NOMINATION:
+        return president, [("nominate", p.name) for p in alive(game)
+                           if p != president and not game.is_termlimited(p)]
+    elif state == GameStates.ELECTION:
+        voter = next(p for p in alive(game) if game.votes[game.seat_of[p]] is None)
+        return voter, [("ja", ""), ("nein", "")]
+    elif state == GameStates.LEG_PRES:
+        return president, [("discard", policy) for policy in sorted(set(game.deck[:3]))]
+    elif state == GameStates.LEG_CHANCY:
+        return game.chancellor, [("enact", policy) for policy in sorted(set(game.deck[:2]))]
+    elif state == GameStates.VETO_CHOICE:
+        voter = president if game.president_veto_vote is None else game.chancellor
+        return voter, [("ja", ""), ("nein", "")]
+    elif state == GameStates.INVESTIGATION:
+        return president, [("investigate", p.name) for p in alive(game) if p != president]
+    elif state == GameStates.SPECIAL_ELECTION:
+        return president, [("nominate", p.name) for p in alive(game) if p != president]
+    elif state == GameStates.EXECUTION:
+        # a chavista president has to confirm killing Chavez explicitly
+        return president, [("kill", "Chavez" if p.role == "Chavez" and president.party == "chavista" else p.name)
+                           for p in alive(game) if p != president]
+    raise AssertionError("no moves in state {}".format(state))
+
+
+def check_invariants(game):
+    """
+    Returns a list of violated invariants (empty if everything is fine)
+    """
+    errors = []
+    held_back = [game.vetoable_polcy] if game.game_state == GameStates.VETO_CHOICE else []
+    if len(game.deck) + len(game.discard) + len(held_back) + game.mudista + game.chavista != 17:
+        errors.append("policies went missing")
+    if (game.deck + game.discard + held_back).count("L") + game.mudista != 6:
+        errors.append("mudista policies went missing")
+    if not (0 <= game.mudista <= 5 and 0 <= game.chavista <= 6 and 0 <= game.anarchy_progress <= 3):
+        errors.append("tracks out of range")
+    if game.num_dead_players != bin(game.dead_seats).count("1") or game.num_alive_players != len(alive(game)):
+        errors.append("dead player count out of sync")
+    if game.ja_votes != game.votes.count(True) or game.nein_votes != game.votes.count(False):
+        errors.append("vote tallies out of sync")
+    if game.game_state != GameStates.GAME_OVER:
+        if game.anarchy_progress == 3:
+            errors.append("anarchy was not resolved")
+        if game.is_dead(game.president):
+            errors.append("dead president")
+        if game.chancellor is not None and game.is_dead(game.chancellor):
+            errors.append("dead chancellor")
+        if game.game_state in (GameStates.ELECTION, GameStates.LEG_PRES, GameStates.LEG_CHANCY) \
+                and game.chancellor is None:
+            errors.append("no chancellor in {}".format(game.game_state))
+    return errors
+
+
+def simulate_game(num_players, seed, agents=None, latencies=None):
+    """
+    Play one game. `agents` maps seat indices (before seats are shuffled) to agents, everyone else plays
+    randomly. Handler latencies are appended to `latencies` (state/command name -> [seconds]).
+    Returns (result, number of commands, list of invariant violations).
+    """
+    rng = random.Random(seed)
+    chat_id = -seed - 1
+    game = secret_hitler.Game(chat_id, seed=seed)
+    players = [secret_hitler.Player(i + 1, "Player{}".format(i + 1)) for i in range(num_players)]
+    agents = dict(agents or {})
+    for i, player in enumerate(players):
+        agents[player] = agents.pop(i, None) or RandomAgent(rng)
+    if latencies is None:
+        latencies = defaultdict(list)
+
+    def handle(player, command, args):
+        key = "{}/{}".format(game.game_state.name, command)
+        start = time.perf_counter()
+        game.handle_message(chat_id, player, command, args)
+        game.finish_command()  # like bot_telegram.game_command_executor
+        latencies[key].append(time.perf_counter() - start)
+
+    commands = 0
+    try:
+        for player in players:
+            handle(player, "joingame", "")
+        handle(players[0], "startgame", "")
+        while commands < MAX_COMMANDS_PER_GAME:
+            player, moves = pending_move(game)
+            command, args = agents[player].choose(game, player, moves)
+            handle(player, command, args)
+            commands += 1
+
+            bystander = rng.choice(players)
+            extra = agents[bystander].extra(game, bystander)
+            if extra is not None:
+                handle(bystander, *extra)
+                commands += 1
+
+            errors = check_invariants(game)
+            if errors:
+                return "invariant violated", commands, errors
+        return "stuck", commands, []
+    except secret_hitler.GameOverException as e:
+        errors = check_invariants(game)
+        return str(e), commands, errors
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+
+    return {"count": len(samples), "p50_ms": at(0.5), "p90_ms": at(0.9), "p99_ms": at(0.99),
+            "max_ms": samples[-1] * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--baseline", help="an earlier output file to compare games/sec with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    transport = NullTransport()
+    secret_hitler.configure(transport=transport)
+
+    latencies = defaultdict(list)
+    results = defaultdict(int)
+    failures = []
+    commands = 0
+    start = time.perf_counter()
+    for i in range(args.games):
+        seed = args.seed + i
+        result, game_commands, errors = simulate_game(5 + i % 6, seed, latencies=latencies)
+        results[result] += 1
+        commands += game_commands
+        if errors or result == "stuck":
+            failures.append({"seed": seed, "players": 5 + i % 6, "result": result, "errors": errors})
+    elapsed = time.perf_counter() - start
+
+    by_state = defaultdict(list)
+    for key, samples in latencies.items():
+        by_state[key.split("/")[0]].extend(samples)
+
+    report = {
+        "games": args.games,
+        "seconds": elapsed,
+        "games_per_second": args.games / elapsed,
+        "commands_per_second": commands / elapsed,
+        "messages_per_game": transport.messages / float(args.games),
+        "results": dict(results),
+        "failures": failures,
+        "latency_by_state": {state: percentiles(samples) for state, samples in sorted(by_state.items())},
+        "latency_by_command": {key: percentiles(samples) for key, samples in sorted(latencies.items())},
+    }
+    with open(args.output, "w") as out_file:
+        json.dump(report, out_file, indent=2, sort_keys=True)
+
+    print("{} games in {:.2f}s: {:.1f} games/sec, {:.0f} commands/sec".format(
+        args.games, elapsed, report["games_per_second"], report["commands_per_second"]))
+    for state, stats in sorted(report["latency_by_state"].items()):
+        print("  {:<20} p50 {:.3f}ms  p99 {:.3f}ms  max {:.3f}ms".format(
+            state, stats["p50_ms"], stats["p99_ms"], stats["max_ms"]))
+    for failure in failures:
+        print("FAILED: seed {seed} with {players} players: {result} {errors}".format(**failure))
+
+    failed = len(failures) > 0
+    if args.baseline:
+        with open(args.baseline) as in_file:
+            baseline = json.load(in_file)["games_per_second"]
+        if report["games_per_second"] < baseline * (1 - args.tolerance):
+            print("REGRESSION: {:.1f} games/sec, baseline {:.1f}".format(report["games_per_second"], baseline))
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
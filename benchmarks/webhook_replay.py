@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Replays recorded Telegram updates against a webhook listener and measures how
+long it takes until each update has been handed over.
+
+Record updates by adding "record = FILE" to config/webhook (one JSON update per
+line), then run from the repository root:
+
+    python benchmarks/webhook_replay.py FILE --url http://127.0.0.1:8443/ --secret SECRET
+
+Without --url, a local webhook.WebhookServer is started that only queues the
+updates, which measures the listener on its own. Updates are sent by
+--concurrency parallel connections, like Telegram does with max_connections.
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import webhook
+
+
+def load_updates(fname):
+    with open(fname, "r") as in_file:
+        return [json.loads(line) for line in in_file if line.strip()]
+
+
+def post(url, secret, update):
+    """
+    Returns (HTTP status, seconds until the response arrived)
+    """
+    request = urllib.request.Request(url, data=json.dumps(update).encode("utf-8"),
+                                     headers={"Content-Type": "application/json", webhook.SECRET_HEADER: secret})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+
+def replay(url, secret, updates, concurrency):
+    """
+    POST all updates, keeping `concurrency` requests in flight. Returns ([latencies], {status: count}, seconds).
+    """
+    pending = queue.Queue()
+    for update in updates:
+        pending.put(update)
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                update = pending.get_nowait()
+            except queue.Empty:
+                return
+            status, latency = post(url, secret, update)
+            with lock:
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("updates", help="file with one recorded update per line")
+    parser.add_argument("--url", help="webhook listener to replay against (default: start a local one)")
+    parser.add_argument("--secret", default="benchmark")
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=1, help="send the recorded updates this many times")
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates) * args.repeat
+    if not updates:
+        sys.exit("no updates in {}".format(args.updates))
+
+    server = None
+    if args.url is None:
+        received = queue.Queue()
+        server = webhook.WebhookServer(received.put, args.secret, port=0, concurrency=args.concurrency)
+        server.start()
+        args.url = "http://127.0.0.1:{}/".format(server.httpd.server_address[1])
+
+    latencies, statuses, elapsed = replay(args.url, args.secret, updates, args.concurrency)
+    if server is not None:
+        server.stop()
+
+    latencies.sort()
+    print("{} updates in {:.2f}s: {:.0f} updates/sec, responses {}".format(
+        len(updates), elapsed, len(updates) / elapsed, statuses))
+    print("latency p50 {:.2f}ms  p90 {:.2f}ms  p99 {:.2f}ms  max {:.2f}ms".format(
+        *[latencies[min(len(latencies) - 1, int(f * len(latencies)))] * 1000 for f in (0.5, 0.9, 0.99, 1)]))
+    sys.exit(0 if set(statuses) == {200} else 1)
+
+
+if __name__ == "__main__":
+    main()
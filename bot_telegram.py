@@ -1,17 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import functools
 import logging
 import os
+import queue
 import sys
 import threading
 from subprocess import call
 
 import telegram
 from telegram.error import TelegramError
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters
-
+from telegram.utils.request import Request
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, Filters, \
+    DispatcherHandlerStop
+from telegram.ext.dispatcher import DEFAULT_GROUP
+
+import actors
+import archive
+import chat_cache
+import game_journal
+import handoff
+import message_queue
+import metrics
+import rate_limit
 import secret_hitler
+import sharding
+import telegram_transport
+import webhook
 
 with open("config/key", "r") as file:
     API_KEY = file.read().rstrip()
@@ -19,80 +35,405 @@ with open("config/key", "r") as file:
 with open("config/devchat", "r") as file:
     DEV_CHAT_ID = int(file.read().rstrip())
 
-bot = telegram.Bot(token=API_KEY)
-updater = Updater(token=API_KEY)
-restored_players = {}
-restored_game = {}
-MAINTENANCE_MODE = False
-MAX_MESSAGE_LENGTH = 4096
+with open("config/username", "r") as file:
+    BOT_USERNAME = file.read().rstrip()
+
+# optional: talk to another Bot API server than Telegram's (e.g. benchmarks/fake_bot_api.py)
+API_URL = webhook.API_URL
+if os.path.exists("config/api_url"):
+    with open("config/api_url", "r") as file:
+        API_URL = file.read().rstrip().rstrip("/")
+
+# optional: spread the games over this many worker processes (see sharding.py)
+NUM_SHARDS = 1
+if os.path.exists("config/shards"):
+    with open("config/shards", "r") as file:
+        NUM_SHARDS = int(file.read().rstrip())
+
+# optional: receive updates via a webhook instead of polling for them (see README)
+WEBHOOK = webhook.load_settings("config/webhook")
+
+# optional: serve Prometheus metrics on this local port (shards use the following ports)
+METRICS_PORT = None
+if os.path.exists("config/metrics"):
+    with open("config/metrics", "r") as file:
+        METRICS_PORT = int(file.read().rstrip())
+
+# every Bot API call goes through this bot, so it is counted and timed (with enough connections for the outbound
+# workers, the dispatcher and polling)
+bot = metrics.InstrumentedBot(telegram.Bot(token=API_KEY, base_url=API_URL + "/bot",
+                                           request=Request(con_pool_size=message_queue.NUM_WORKERS + 8)))
+updater = Updater(bot=bot)
+chats = chat_cache.ChatCache(bot)  # titles, invite links and admins of chats
+limiter = rate_limit.RateLimiter()  # token buckets per user and per chat for commands and button presses
+listener = None  # webhook.WebhookServer in webhook mode
+router = None  # sharding.Router in the front process of a sharded deployment
+shard = None  # sharding.Shard in the worker processes of a sharded deployment
+journal = None  # game_journal.Journal of all running games
+outbound = None  # message_queue.MessageQueue for all game messages
+failed_deliveries = None  # message_queue.FailedDeliveries of outbound
+archive_db = None  # archive.Archive of all decided games
+game_actors = None  # actors.ActorPool that runs the commands of each game one after the other
+handed_over = None  # what the previous process handed off to this one (see handoff.py), if anything
 existing_games = {}  # Chat ID -> Game
+CHAT_CACHE_GROUP = -2  # handler group of chat_update_handler, which runs before the command handlers
+RETURNING_USER_GROUP = -3  # handler group of returning_user_handler
+RATE_LIMIT_GROUP = -1  # handler group of rate_limit_handler, the last one before the command handlers
+handled_commands = set()  # commands of the registered CommandHandlers (the only commands the rate limiter charges)
 waiting_players_per_group = {}  # Chat ID -> [Chat ID]
 
 
-def split_message(message, length=MAX_MESSAGE_LENGTH):
-    return [message[i:i + length] for i in range(0, len(message), length)]
-
-
 def main():
-    global restored_players
-    global restored_game
     global updater
+    global router
+    global handed_over
+
+    # allows viewing of exceptions
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.DEBUG)  # not sure exactly how this works
 
-    if len(sys.argv) > 1:
-        restored_game = secret_hitler.Game.load(sys.argv[1])
-        for p in restored_game.players:
-            restored_players[p.id] = p
+    handed_over = handoff.load()  # before forking, so the shards get it as well
+    dispatcher = updater.dispatcher
+    if NUM_SHARDS > 1:
+        # this process only routes updates, the games are run by the shards (forked before any threads start)
+        router = sharding.Router(NUM_SHARDS, run_shard)
+        router.start()
+        register_router_handlers(dispatcher)
     else:
-        restored_game = None
+        register_handlers(dispatcher)
+        start_games(dispatcher)
+    if METRICS_PORT is not None:
+        metrics.serve(METRICS_PORT)
 
-    # Set up all command handlers
+    start_bot()
 
-    dispatcher = updater.dispatcher
 
+def start_games(dispatcher, select=None, global_share=1):
+    """
+    Start delivering game messages and journaling, and resume the journaled games
+    (only those whose chat id passes select(chat_id), if given)
+    """
+    global outbound
+    global failed_deliveries
+    global journal
+    global archive_db
+    global game_actors
+
+    # Game messages are queued and delivered in the background, so handlers don't wait for Telegram
+    failed_deliveries = message_queue.FailedDeliveries(on_unreachable=player_unreachable)
+    outbound = message_queue.MessageQueue(bot, on_error=failed_deliveries.report, global_share=global_share)
+    outbound.start()
+    failed_deliveries.start(outbound)
+    secret_hitler.configure(transport=telegram_transport.TelegramTransport(outbound), bot_username=BOT_USERNAME)
+    game_actors = actors.ActorPool()
+
+    # finished games are archived for /mystats and /groupstats (all shards share the archive)
+    archive_db = archive.Archive()
+    archive_db.start()
+
+    # Bring back every game that was running when the bot went down
+    journal = game_journal.Journal()
+    for game in journal.resume(select, on_game_over=resumed_game_over):
+        restore_game(dispatcher, game)
+    if handed_over is not None:
+        for chat_id, waiting_players in handed_over["waiting"].items():
+            if select is None or select(int(chat_id)):
+                waiting_players_per_group[chat_id] = waiting_players
+    if len(sys.argv) > 1:  # a game saved with /savegame
+        game = secret_hitler.Game.load(sys.argv[1])
+        if select is None or select(game.global_chat):
+            restore_game(dispatcher, game)
+            journal.open(game)
+    journal.start()
+
+
+def resumed_game_over(game):
+    """
+    Archive a game whose journal ended with the game over, because the bot went down before it could
+    """
+    archive_db.archive(game)
+    send_message(DEV_CHAT_ID, "A game has ended in {} (before the restart).".format(chats.title(game.global_chat)))
+
+
+def run_shard(index, num_shards, inbox, reports):
+    """
+    Main function of a shard's worker process: runs the games of the chats hashed to it like a
+    single-process bot would, with an equal share of the bot's global rate limit
+    """
+    global shard
+    shard = sharding.Shard(index, num_shards, inbox, reports)
+    if METRICS_PORT is not None:
+        metrics.serve(METRICS_PORT + 1 + index)
+    dispatcher = updater.dispatcher
+    register_handlers(dispatcher)
+    start_games(dispatcher, select=shard.owns, global_share=num_shards)
+    shard.serve(lambda data: dispatcher.process_update(telegram.Update.de_json(data, dispatcher.bot)),
+                SHARD_CALLS)
+    game_actors.stop(timeout=30)
+    outbound.stop(timeout=30)
+    failed_deliveries.stop()
+    journal.stop()
+    archive_db.stop()
+
+
+def register_handlers(dispatcher):
+    """
+    Set up all command handlers (the same ones whether updates are polled or pushed via the webhook)
+    """
     dispatcher.add_handler(get_static_handler("start"))
     dispatcher.add_handler(get_static_handler("help"))
     dispatcher.add_handler(get_static_handler("changelog"))
     dispatcher.add_handler(CommandHandler('feedback', feedback_handler, pass_args=True))
 
-    dispatcher.add_handler(CommandHandler('newgame', newgame_handler, pass_chat_data=True))
-    dispatcher.add_handler(CommandHandler('cancelgame', cancelgame_handler, pass_chat_data=True))
-    dispatcher.add_handler(CommandHandler('leave', leave_handler, pass_user_data=True))
+    dispatcher.add_handler(CommandHandler('newgame', in_actor(newgame_handler), pass_chat_data=True))
+    dispatcher.add_handler(CommandHandler('cancelgame', in_actor(cancelgame_handler), pass_chat_data=True))
+    dispatcher.add_handler(CommandHandler('leave', in_actor(leave_handler), pass_user_data=True))
     dispatcher.add_handler(CommandHandler('listgames', listgames_handler))
+    dispatcher.add_handler(CommandHandler('botstats', botstats_handler))
     dispatcher.add_handler(CommandHandler('restart', restart_handler))
-    dispatcher.add_handler(CommandHandler('nextgame', nextgame_handler, pass_chat_data=True))
-    dispatcher.add_handler(CommandHandler('joingame', joingame_handler, pass_chat_data=True, pass_user_data=True))
+    dispatcher.add_handler(CommandHandler('mystats', mystats_handler))
+    dispatcher.add_handler(CommandHandler('groupstats', groupstats_handler))
+    dispatcher.add_handler(CommandHandler('nextgame', in_actor(nextgame_handler), pass_chat_data=True))
+    dispatcher.add_handler(CommandHandler('spectatorchannel', in_actor(spectator_channel_handler), pass_chat_data=True,
+                                          pass_args=True))
+    dispatcher.add_handler(CommandHandler('joingame', in_actor(joingame_handler), pass_chat_data=True, pass_user_data=True))
     dispatcher.add_handler(
-        CommandHandler(secret_hitler.Game.ACCEPTED_COMMANDS + tuple(COMMAND_ALIASES.keys()), game_command_handler,
+        CommandHandler(secret_hitler.Game.ACCEPTED_COMMANDS + tuple(COMMAND_ALIASES.keys()), in_actor(game_command_handler),
                        pass_chat_data=True, pass_user_data=True))
-    dispatcher.add_handler(CommandHandler('savegame', save_game, pass_chat_data=True, pass_user_data=True))
+    dispatcher.add_handler(CommandHandler('savegame', in_actor(save_game), pass_chat_data=True, pass_user_data=True))
 
-    dispatcher.add_handler(CallbackQueryHandler(button_handler, pass_chat_data=True, pass_user_data=True))
+    dispatcher.add_handler(CallbackQueryHandler(in_actor(button_handler), pass_chat_data=True, pass_user_data=True))
 
-    dispatcher.add_handler(MessageHandler(Filters.animation, animation_handler))
+    dispatcher.add_handler(MessageHandler(Filters.animation & Filters.chat(DEV_CHAT_ID), animation_handler))
+    dispatcher.add_handler(MessageHandler(Filters.group, chat_update_handler), group=CHAT_CACHE_GROUP)
+    dispatcher.add_handler(MessageHandler(Filters.private, returning_user_handler), group=RETURNING_USER_GROUP)
+    dispatcher.add_handler(TypeHandler(telegram.Update, rate_limit_handler), group=RATE_LIMIT_GROUP)
+    handled_commands.update(command for handler in dispatcher.handlers[DEFAULT_GROUP]
+                            if isinstance(handler, CommandHandler) for command in handler.command)
 
     dispatcher.add_error_handler(handle_error)
 
-    # allows viewing of exceptions
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.DEBUG)  # not sure exactly how this works
 
-    start_bot()
+def register_router_handlers(dispatcher):
+    """
+    Set up the front process of a sharded deployment: admin commands that concern all shards are
+    answered here, everything else is forwarded to a shard
+    """
+    dispatcher.add_handler(CommandHandler('listgames', listgames_handler))
+    dispatcher.add_handler(CommandHandler('botstats', botstats_handler))
+    dispatcher.add_handler(CommandHandler('restart', restart_handler))
+    dispatcher.add_handler(TypeHandler(telegram.Update, lambda bot, update: router.route(update.to_dict())))
+    dispatcher.add_handler(MessageHandler(Filters.group, chat_update_handler), group=CHAT_CACHE_GROUP)
+
+    dispatcher.add_error_handler(handle_error)
+
+
+def in_actor(handler):
+    """
+    Wraps a handler that touches a game, so that it runs in that game's actor instead of the dispatcher's
+    thread: commands about the same game are handled one after the other, different games in parallel.
+    """
+
+    @functools.wraps(handler)
+    def submit(bot, update, **kwargs):
+        game_actors.submit(actor_key(update, kwargs.get("chat_data"), kwargs.get("user_data")),
+                           run_handler, handler, bot, update, kwargs)
+
+    return submit
+
+
+def actor_key(update, chat_data=None, user_data=None):
+    """
+    The actor of a command is the game it goes to (see game_command_executor): the game in its chat or, if there
+    is none, the game of its user. Commands that concern no game go to the actor of their chat.
+    """
+    game = chat_data.get("game_obj") if chat_data is not None else None
+    if game is None and user_data is not None and user_data.get("player_obj") is not None:
+        game = user_data["player_obj"].game
+    return game.global_chat if game is not None else update.effective_chat.id
+
+
+def run_handler(handler, bot, update, kwargs):
+    try:
+        with outbound.turn():  # everything the command sends goes out merged per chat once it's done
+            handler(bot, update, **kwargs)
+    except Exception as e:
+        updater.dispatcher.dispatch_error(update, e)
+
+
+def send_message(chat_id, text, **kwargs):
+    """
+    Send a handler's message through the outbound queue, so that it keeps its place behind the messages of the
+    same command and counts against the rate limits. (The routing process of a sharded deployment has no queue
+    and sends directly.)
+    """
+    if outbound is None:
+        return bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    return outbound.send(chat_id, text, **kwargs)
+
+
+def chat_update_handler(bot, update):
+    """
+    Runs (in its own handler group) for every group message, to keep the cached chat titles and admins current
+    """
+    chats.observe(update.effective_message)
+
+
+def rate_limit_handler(bot, update):
+    """
+    Runs before the command handlers for every update: commands and button presses beyond their user's or chat's
+    rate limit go no further. A button press is answered with a notice, a command gets a reply in its chat (only
+    the first one until the user's commands pass again).
+    """
+    user = update.effective_user
+    if user is None:
+        return
+    if update.callback_query is not None:
+        command = "button"
+    else:
+        message = update.effective_message
+        if message is None or not message.text or not message.text.startswith("/"):
+            return
+        command, _, username = message.text.split()[0][1:].lower().partition("@")
+        if (username and username != BOT_USERNAME.lower()) or command not in handled_commands:
+            return  # meant for another bot, or not a command at all
+        command = COMMAND_ALIASES.get(command, command)
+    chat_id = update.effective_chat.id if update.effective_chat is not None else user.id
+    delay = limiter.check(user.id, chat_id, rate_limit.cost(command))
+    if delay == 0:
+        return
+
+    metrics.THROTTLED_REQUESTS.inc(command)
+    wait = int(delay) + 1
+    if update.callback_query is not None:
+        update.callback_query.answer(text="Slow down! Try again in {}s.".format(wait))
+    elif limiter.warn(user.id):
+        # in the chat of the command, not privately: the user may never have started a chat with the bot
+        outbound.send(chat_id, "Slow down! I'm ignoring your commands for {}s.".format(wait),
+                      reply_to_message_id=update.effective_message.message_id)
+    raise DispatcherHandlerStop()
+
+
+def returning_user_handler(bot, update):
+    """
+    Runs for every private message: a user that couldn't be reached before is back, so they get the critical
+    messages they missed
+    """
+    user_id = update.effective_user.id
+    if failed_deliveries.is_unreachable(user_id):
+        logging.info("User %s is back, redelivered %s messages", user_id, failed_deliveries.returned(user_id))
+
+
+def player_unreachable(user_id):
+    """
+    Tell a game that one of its players can't get their messages (called by failed_deliveries)
+    """
+    player = updater.dispatcher.user_data.get(user_id, {}).get("player_obj")
+    if player is not None and player.game is not None and player in player.game.seat_of:
+        outbound.send(player.game.global_chat,
+                      "I can't send {} their messages. Please [message me](t.me/{}) to get them!".format(
+                          player.get_markdown_tag(), BOT_USERNAME),
+                      parse_mode=telegram.ParseMode.MARKDOWN)
+
+
+def restore_game(dispatcher, game):
+    """
+    Make a restored game reachable again: from its group and from the players and spectators in it
+    """
+    dispatcher.chat_data[game.global_chat]["game_obj"] = game
+    existing_games["{}".format(game.global_chat)] = game
+    for p in game.players + list(game.spectators):
+        if p.game is game:
+            dispatcher.user_data[p.id]["player_obj"] = p
+            if shard is not None:
+                shard.bind(p.id)
+    logging.info("Restored game in chat %s (%s)", game.global_chat, game.game_state)
 
 
 def start_bot():
     global updater
-    updater.start_polling()
+    if handed_over is not None:
+        # continue with the updates that the previous process received but didn't handle anymore
+        if handed_over["offset"]:
+            updater.last_update_id = handed_over["offset"]
+        for data in handed_over["updates"]:
+            updater.update_queue.put(telegram.Update.de_json(data, updater.bot))
+    if WEBHOOK is None:
+        updater.start_polling()
+    else:
+        start_webhook()
     updater.idle()
     bot.send_message(chat_id=DEV_CHAT_ID, text="Bot restarted successfully!")
 
 
+def start_webhook():
+    """
+    Let Telegram push updates to a local listener, which hands them straight to the dispatcher.
+    (Switching back to polling later is fine: start_polling removes the webhook again.)
+    """
+    global listener
+    threading.Thread(target=updater.dispatcher.start, name="dispatcher").start()
+    updater.running = True  # so that updater.stop() also stops the dispatcher
+
+    listener = webhook.WebhookServer(
+        webhook_update, WEBHOOK["secret"], listen=WEBHOOK.get("listen", "127.0.0.1"), port=int(WEBHOOK.get("port", 8443)),
+        path=WEBHOOK.get("path", "/"), concurrency=int(WEBHOOK.get("concurrency", 40)),
+        record_to=WEBHOOK.get("record"))
+    listener.start()
+    webhook.set_webhook(API_KEY, WEBHOOK["url"], WEBHOOK["secret"],
+                        max_connections=int(WEBHOOK.get("max_connections", 40)), api_url=API_URL)
+
+
+def webhook_update(data):
+    if router is not None and not router.is_local(data):
+        router.route(data)  # no need to parse updates that are only forwarded
+    else:
+        updater.update_queue.put(telegram.Update.de_json(data, updater.bot))
+
+
 def stop_bot():
+    """
+    Stop taking updates, let everything in flight finish and hand off to the next process (see handoff.py)
+    """
     global updater
-    updater.stop()
+    if listener is not None:
+        listener.stop()
+    updater.stop()  # stops polling, and the dispatcher once it is done with the current update
+    updates = []
+    while True:
+        try:
+            update = updater.update_queue.get_nowait()
+        except queue.Empty:
+            break
+        if isinstance(update, telegram.Update):
+            updates.append(update.to_dict())
+    if router is not None:
+        waiting_players = {}
+        for shard_waiting_players in router.gather("hand_off"):
+            waiting_players.update(shard_waiting_players or {})
+        router.stop()
+    else:
+        waiting_players = hand_off_games()
+    handoff.save(updater.last_update_id, updates, waiting_players)
+    logging.info("Handed off %s unhandled updates", len(updates))
     updater.is_idle = False
 
 
+def hand_off_games():
+    """
+    Deliver all queued messages and snapshot all games, so the next process can resume them without replaying
+    anything. Returns the waiting lists.
+    """
+    game_actors.stop(timeout=30)
+    outbound.stop(timeout=30)
+    failed_deliveries.stop()
+    journal.compact(list(existing_games.values()))
+    journal.stop()
+    archive_db.stop()
+    return dict(waiting_players_per_group)
+
+
 def get_static_handler(command):
     """
     Given a string command, returns a CommandHandler for that string that
@@ -106,19 +447,46 @@ def get_static_handler(command):
 
     return CommandHandler(command,
                           (lambda bot, update:
-                           [bot.send_message(chat_id=update.message.chat.id, text=part,
-                                             parse_mode=telegram.ParseMode.MARKDOWN) for part in
-                            split_message(response)]))
+                           [send_message(update.message.chat.id, part, parse_mode=telegram.ParseMode.MARKDOWN)
+                            for part in message_queue.split_message(response)]))
 
 
 def button_handler(bot, update, chat_data, user_data):
     """
-    Handles any command sent to the bot via an inline button
+    Handles any command sent to the bot via an inline button. Buttons of earlier states of the game (or of other
+    games) are rejected before they get to the game.
     """
-    command, args = parse_message(update.callback_query.data)
-    game_command_executor(bot, command, args, update.callback_query.from_user, update.callback_query.message.chat.id,
-                          chat_data, user_data)
-    update.callback_query.message.edit_reply_markup()
+    query = update.callback_query
+    if query.data.startswith("/"):  # sent before buttons carried packed callback data
+        command, args = parse_message(query.data)
+    else:
+        try:
+            game_id, serial, command, arg = secret_hitler.decode_callback(query.data)
+        except ValueError:
+            query.answer()
+            return
+        game = chat_data.get("game_obj")
+        if game is None and user_data.get("player_obj") is not None:
+            game = user_data["player_obj"].game
+        args = None
+        if game is not None and game.seed & 0xFFFFFFFF == game_id:
+            args = game.button_command(serial, command, arg)
+        if args is None:
+            query.answer(text="This button has expired.")
+            remove_keyboard(query.message)
+            return
+    query.answer()
+    with metrics.COMMAND_SECONDS.time(command, "button"):
+        game_command_executor(bot, command, args, query.from_user, query.message.chat.id, chat_data, user_data)
+        remove_keyboard(query.message)
+
+
+def remove_keyboard(message):
+    """
+    Queue the removal of a message's inline keyboard in its chat's lane, so it counts against the rate limits
+    """
+    outbound.submit("edit_message_reply_markup", message.chat.id,
+                    {"chat_id": message.chat.id, "message_id": message.message_id})
 
 
 def newgame_handler(bot, update, chat_data):
@@ -129,29 +497,24 @@ def newgame_handler(bot, update, chat_data):
 
     chat_id = update.message.chat.id
     if update.message.chat.type == "private":
-        bot.send_message(chat_id=chat_id, text="You can’t create a game in a private chat!")
-    elif MAINTENANCE_MODE:
-        currently_active_games = len(running_games())
-        bot.send_message(chat_id=chat_id,
-                         text="A restart has been scheduled. No new games can be created while we wait for the remaining {} to finish.".format(
-                             "game" if currently_active_games == 1 else "{} games".format(currently_active_games)))
+        send_message(chat_id, "You can’t create a game in a private chat!")
     elif game is not None and game.game_state != secret_hitler.GameStates.GAME_OVER and update.message.text.find(
             "confirm") == -1:
-        bot.send_message(chat_id=chat_id,
-                         text="Warning: game already in progress here. Reply '/newgame confirm' to confirm")
+        send_message(chat_id, "Warning: game already in progress here. Reply '/newgame confirm' to confirm")
     else:
         if game is not None:  # properly end any previous game
             game.set_game_state(secret_hitler.GameStates.GAME_OVER)
+            journal.close(game)
         chat_data["game_obj"] = secret_hitler.Game(chat_id)
-        bot.send_message(chat_id=chat_id, text="Created game! /joingame to join, /startgame to start")
+        journal.open(chat_data["game_obj"])
+        send_message(chat_id, "Created game! /joingame to join, /startgame to start")
         existing_games["{}".format(chat_id)] = chat_data["game_obj"]
         if "{}".format(chat_id) in waiting_players_per_group:
-            invite_link = bot.export_chat_invite_link(chat_id=chat_id)
+            invite_link = chats.invite_link(chat_id)
             for waiting_player in waiting_players_per_group["{}".format(chat_id)]:
-                bot.send_message(chat_id=int(waiting_player),
-                                 text="A new game is starting in [{}]({})!".format(update.message.chat.title,
-                                                                                   invite_link),
-                                 parse_mode=telegram.ParseMode.MARKDOWN)
+                send_message(int(waiting_player),
+                             "A new game is starting in [{}]({})!".format(update.message.chat.title, invite_link),
+                             parse_mode=telegram.ParseMode.MARKDOWN)
             del waiting_players_per_group["{}".format(chat_id)]
 
 
@@ -162,21 +525,20 @@ def nextgame_handler(bot, update, chat_data):
     game = chat_data.get("game_obj")
     chat_id = update.message.chat.id
     if update.message.chat.type == "private":
-        bot.send_message(chat_id=chat_id, text="You can’t wait for new games in private chat!")
+        send_message(chat_id, "You can’t wait for new games in private chat!")
     if game is not None and game.game_state == secret_hitler.GameStates.ACCEPT_PLAYERS and game.num_players < 10 and update.message.from_user.id not in map(
             lambda player: player.id, game.players) and update.message.text.find("confirm") == -1:
-        bot.send_message(chat_id=chat_id,
-                         text="You could still join the _current_ game via /joingame. Type '/nextgame confirm' if you really want to wait.",
-                         parse_mode=telegram.ParseMode.MARKDOWN)
+        send_message(chat_id,
+                     "You could still join the _current_ game via /joingame. Type '/nextgame confirm' if you really want to wait.",
+                     parse_mode=telegram.ParseMode.MARKDOWN)
     else:
         if "{}".format(chat_id) not in waiting_players_per_group:
             waiting_players_per_group["{}".format(chat_id)] = []
         waiting_players_per_group["{}".format(chat_id)].append(update.message.from_user.id)
-        bot.send_message(chat_id=update.message.from_user.id,
-                         text="I will notify you when a new game starts in [{}]({})".format(update.message.chat.title,
-                                                                                            bot.export_chat_invite_link(
-                                                                                                chat_id=chat_id)),
-                         parse_mode=telegram.ParseMode.MARKDOWN)
+        send_message(update.message.from_user.id,
+                     "I will notify you when a new game starts in [{}]({})".format(update.message.chat.title,
+                                                                                  chats.invite_link(chat_id)),
+                     parse_mode=telegram.ParseMode.MARKDOWN)
 
 
 def cancelgame_handler(bot, update, chat_data):
@@ -187,11 +549,44 @@ def cancelgame_handler(bot, update, chat_data):
 
     chat_id = update.message.chat.id
     if game is not None:
-        game.end_game("whole", "Game has been cancelled{}".format(
-            "" if MAINTENANCE_MODE else ". Type /newgame to start a new one"))
-        del existing_games["{}".format(chat_id)]
+        try:
+            game.end_game("whole", "Game has been cancelled. Type /newgame to start a new one")
+        except secret_hitler.GameOverException:
+            pass
+        journal.close(game)
+        existing_games.pop("{}".format(chat_id), None)
+    else:
+        send_message(chat_id, "No game in progress here.")
+
+
+def spectator_channel_handler(bot, update, chat_data, args=None):
+    """
+    Post the spectators' log of this group's game in a channel (given by its @username or id) instead of sending
+    it to every spectator, or stop doing so with "off". Group admins only.
+    """
+    chat_id = update.message.chat.id
+    game = chat_data.get("game_obj")
+    if update.message.chat.type == "private" or game is None:
+        reply = "There is no game in progress here."
+    elif not chats.is_admin(chat_id, update.message.from_user.id):
+        reply = "Only admins of this group can set its spectator channel."
+    elif not args:
+        reply = "Usage: /spectatorchannel @channel (or /spectatorchannel off)"
     else:
-        bot.send_message(chat_id=chat_id, text="No game in progress here.")
+        channel_id = None
+        if args[0] != "off":
+            try:
+                channel_id = bot.get_chat(chat_id=args[0]).id
+                outbound.send(channel_id, "This channel gets the spectators' log of the game in {}.".format(
+                    chats.title(chat_id)), supress_errors=False).result()
+            except TelegramError as e:
+                send_message(chat_id, "I can't post in {}: {}".format(args[0], e))
+                return
+        game.set_spectator_channel(channel_id)
+        journal.record_spectator_channel(game, update.message.from_user.id, update.message.from_user.first_name,
+                                         channel_id)
+        reply = "Spectator channel set." if channel_id is not None else "Spectators get their log directly again."
+    send_message(chat_id, reply)
 
 
 def joingame_handler(bot, update, chat_data, user_data):
@@ -208,13 +603,6 @@ def leave_handler(bot, update, user_data):
     kill the game)
     """
 
-    player_id = update.message.from_user.id
-    # edge case: first message after restore is /leave
-    global restored_players
-    if player_id in list(restored_players.keys()):
-        user_data["player_obj"] = restored_players[player_id]
-        del restored_players[player_id]
-
     player = user_data.get("player_obj")
 
     if player is None or player.game is None:
@@ -222,21 +610,38 @@ def leave_handler(bot, update, user_data):
     else:
         game = player.game
         player.leave_game(confirmed=True)
+        if game.game_state == secret_hitler.GameStates.GAME_OVER:  # the game self-destructed
+            journal.close(game)
+        else:
+            journal.record_leave(game, player)
+            game.finish_command()
+        if shard is not None:
+            shard.unbind(player.id)
         reply = "Successfully left game!"
         if game is not None and game.game_state == secret_hitler.GameStates.ACCEPT_PLAYERS and game.num_players == 9:
-            for waiting_player in waiting_players_per_group["{}".format(game.global_chat)]:
-                bot.send_message(chat_id=waiting_player, text="A slot just opened up in [{}]({})!".format(
-                    bot.get_chat(chat_id=game.global_chat).title,
-                    bot.export_chat_invite_link(chat_id=game.global_chat)), parse_mode=telegram.ParseMode.MARKDOWN)
+            for waiting_player in waiting_players_per_group.get("{}".format(game.global_chat), []):
+                send_message(waiting_player, "A slot just opened up in [{}]({})!".format(
+                    chats.title(game.global_chat), chats.invite_link(game.global_chat)),
+                             parse_mode=telegram.ParseMode.MARKDOWN)
     if player is None:
-        bot.send_message(chat_id=update.message.chat.id, text=reply)
+        send_message(update.message.chat.id, reply)
     else:
         player.send_message(reply)
 
 
 def running_games():
-    return [game for game in existing_games if "{}".format(game) in existing_games and existing_games[
-        "{}".format(game)].game_state not in [secret_hitler.GameStates.ACCEPT_PLAYERS, secret_hitler.GameStates.GAME_OVER]]
+    # games are added and removed by the actors while this runs, hence the copy
+    return [chat_id for chat_id, game in list(existing_games.items()) if game.game_state not in [
+        secret_hitler.GameStates.ACCEPT_PLAYERS, secret_hitler.GameStates.GAME_OVER]]
+
+
+def all_running_games():
+    """
+    running_games() of this process, or of all shards in a sharded deployment
+    """
+    if router is None:
+        return running_games()
+    return [game for games in router.gather("running_games") for game in games]
 
 
 def listgames_handler(bot, update):
@@ -245,60 +650,177 @@ def listgames_handler(bot, update):
     """
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
-    admins = bot.get_chat_administrators(chat_id)
-    admin_ids = [i.user.id for i in admins]
 
-    if chat_id == DEV_CHAT_ID and user_id in admin_ids:
-        list_of_active_games = running_games()
+    if chat_id == DEV_CHAT_ID and chats.is_admin(chat_id, user_id):
+        list_of_active_games = all_running_games()
         message = "The following groups host a running game:"
         for game_chat_id in [int(game) for game in list_of_active_games]:
-            message += "\n - {}".format(bot.get_chat(game_chat_id).title)
-        bot.send_message(chat_id=chat_id,text=message)
+            message += "\n - {}".format(chats.title(game_chat_id))
+        send_message(chat_id, message)
 
 
-def animation_handler(bot, update):
+def botstats_handler(bot, update):
+    """
+    Show where the bot spends its time (dev chat admins only)
+    """
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
-    admins = bot.get_chat_administrators(chat_id)
-    admin_ids = [i.user.id for i in admins]
 
-    if chat_id == DEV_CHAT_ID and user_id in admin_ids:
-        bot.send_message(
-            chat_id=chat_id,
-            text="The id of your Animation is '{}'".format(update.message.animation.file_unique_id)
-        )
+    if chat_id == DEV_CHAT_ID and chats.is_admin(chat_id, user_id):
+        if router is None:
+            message = botstats()
+        else:
+            message = "\n\n".join("Shard {}:\n{}".format(i, stats) for i, stats in enumerate(router.gather("botstats")))
+        for part in message_queue.split_message(message):
+            send_message(chat_id, part)
 
 
-def restart_handler(bot, update):
+def botstats():
+    """
+    Summary of this process' metrics
+    """
+    games = games_per_state()
+    players = players_per_state()
+    lines = ["Games: {}".format(", ".join("{} {} ({} players)".format(state, count, players[(state,)])
+                                         for (state,), count in sorted(games.items())) or "none"),
+             "Outbound queue: {}, unreachable users: {}".format(
+                 outbound.qsize() if outbound is not None else 0,
+                 len(failed_deliveries.unreachable) if failed_deliveries is not None else 0)]
+    busy = game_actors.stats() if game_actors is not None else {}
+    lines.append("Busy games: {}, {} commands queued".format(len(busy), sum(stats[0] for stats in busy.values())))
+    for chat_id, (queued, oldest, handled, mean_wait) in sorted(busy.items(), key=lambda item: -item[1][0])[:5]:
+        lines.append(" - {}: {} queued (oldest {:.0f} ms), {} handled (mean wait {:.1f} ms)".format(
+            chat_id, queued, oldest * 1000, handled, mean_wait * 1000))
+    lines += ["", "Time spent per state in all games (count, median, 90th/99th percentile):"]
+    for state, (count, (p50, p90, p99)) in sorted(secret_hitler.dwell_times.percentiles().items(),
+                                                  key=lambda item: item[0].value):
+        lines.append("{}: {} × {}, {} / {}".format(state.name, count, *[secret_hitler.Game.format_time(seconds)
+                                                                        for seconds in (p50, p90, p99)]))
+    lines += ["", "Commands (count, mean, 95th percentile):"]
+    for (command, source), (count, mean, p95) in sorted(metrics.COMMAND_SECONDS.summary().items()):
+        lines.append("/{} ({}): {} × {:.1f} ms, ≤ {:g} ms".format(command, source, count, mean * 1000, p95 * 1000))
+    lines += ["", "API calls (count, mean, errors):"]
+    errors = {}
+    for (method, error), count in metrics.API_ERRORS.values.copy().items():
+        errors.setdefault(method, []).append("{} {}".format(count, error))
+    for (method,), (count, mean, p95) in sorted(metrics.API_SECONDS.summary().items()):
+        lines.append("{}: {} × {:.0f} ms{}".format(method, count, mean * 1000,
+                                                   "".join(", " + error for error in errors.get(method, []))))
+    return "\n".join(lines)
+
+
+def percentage(part, whole):
+    return "{:.0f}%".format(100.0 * part / whole) if whole else "-"
+
+
+def mystats_handler(bot, update):
+    """
+    Show the issuing user's statistics over all archived games
     """
-    Pulls newest code and ends the bot, so that the system daemon can restart it.
+    stats = archive_db.player_stats(update.message.from_user.id)
+    if stats is None:
+        message = "You haven't finished any games yet."
+    else:
+        lines = ["Stats for {}: {} games, {} won ({})".format(stats["name"], stats["games"], stats["wins"],
+                                                              percentage(stats["wins"], stats["games"]))]
+        for role, column in (("mudista", "mudista"), ("chavista", "chavista"), ("Chavez", "chavez")):
+            games, wins = stats[column + "_games"], stats[column + "_wins"]
+            lines.append(" - as {}: {} games, {} won ({})".format(role, games, wins, percentage(wins, games)))
+        lines.append("Killed in {} games".format(stats["deaths"]))
+        lines.append("Votes: {} ja, {} nein ({} ja)".format(stats["ja"], stats["nein"],
+                                                           percentage(stats["ja"], stats["ja"] + stats["nein"])))
+        message = "\n".join(lines)
+    send_message(update.message.chat.id, message)
+
+
+def groupstats_handler(bot, update):
+    """
+    Show the statistics of all archived games of the current group
     """
-    logging.info("Restarting bot.")
+    chat_id = update.message.chat.id
+    if update.message.chat.type == "private":
+        send_message(chat_id, "Use /groupstats in a group, or /mystats for your own stats.")
+        return
+    stats = archive_db.group_stats(chat_id)
+    if stats is None:
+        message = "No game has been finished here yet."
+    else:
+        message = "\n".join([
+            "{} games finished here".format(stats["games"]),
+            " - mudista wins: {} ({})".format(stats["mudista_wins"],
+                                              percentage(stats["mudista_wins"], stats["games"])),
+            " - chavista wins: {} ({})".format(stats["chavista_wins"],
+                                               percentage(stats["chavista_wins"], stats["games"])),
+            "Average players: {:.1f}".format(stats["players"] / stats["games"]),
+            "Average duration: {}".format(secret_hitler.Game.format_time(stats["seconds"] / stats["games"]))])
+    send_message(chat_id, message)
+
+
+def games_per_state():
+    counts = {}
+    for game in list(existing_games.values()):
+        counts[(game.game_state.name,)] = counts.get((game.game_state.name,), 0) + 1
+    return counts
+
+
+def players_per_state():
+    counts = {}
+    for game in list(existing_games.values()):
+        counts[(game.game_state.name,)] = counts.get((game.game_state.name,), 0) + len(game.players)
+    return counts
+
+
+metrics.REGISTRY.register(metrics.Gauge("secret_hitler_games", "Games per state", games_per_state, ("state",)))
+metrics.REGISTRY.register(metrics.Gauge("secret_hitler_players", "Players in games per state", players_per_state,
+                                        ("state",)))
+def dwell_percentiles():
+    values = {}
+    for state, (count, percentiles) in secret_hitler.dwell_times.percentiles().items():
+        for quantile, seconds in zip(("0.5", "0.9", "0.99"), percentiles):
+            values[(state.name, quantile)] = seconds
+    return values
+
+
+metrics.REGISTRY.register(metrics.Gauge("secret_hitler_state_dwell_seconds",
+                                        "Time spent per state over the most recent games (percentiles)",
+                                        dwell_percentiles, ("state", "quantile")))
+metrics.REGISTRY.register(metrics.Gauge("secret_hitler_outbound_queue", "Bot API calls waiting to be sent",
+                                        lambda: {(): outbound.qsize() if outbound is not None else 0}))
 
+
+def actor_queues():
+    busy = game_actors.stats() if game_actors is not None else {}
+    depths = [stats[0] for stats in busy.values()]
+    return {("total",): sum(depths), ("max",): max(depths) if depths else 0}
+
+
+metrics.REGISTRY.register(metrics.Gauge("secret_hitler_actor_queue", "Commands waiting in the games' mailboxes",
+                                        actor_queues, ("stat",)))
+
+
+def animation_handler(bot, update):
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
-    admins = bot.get_chat_administrators(chat_id)
-    admin_ids = [i.user.id for i in admins]
 
-    logging.debug("Restart issued by: user_id: %s in chat_id: %s, group admins: %s", user_id, chat_id, admin_ids)
+    if chat_id == DEV_CHAT_ID and chats.is_admin(chat_id, user_id):
+        send_message(chat_id, "The id of your Animation is '{}'".format(update.message.animation.file_unique_id))
 
-    global MAINTENANCE_MODE
-    MAINTENANCE_MODE = True
 
-    if chat_id == DEV_CHAT_ID and user_id in admin_ids:
-        list_of_active_games = running_games()
-        if len(list_of_active_games) > 0 and update.message.text.find('confirm') == -1:
-            bot.send_message(chat_id=chat_id,
-                             text="{} running game(s) found. Type `/restart confirm` to cancel those games and restart anyway. Otherwise, the bot will restart after {} ended.".format(
-                                 len(list_of_active_games),
-                                 "that game has" if len(existing_games) == 1 else "those games have"))
-        else:
-            for game_chat_id in [int(game) for game in list_of_active_games]:
-                existing_games["{}".format(game_chat_id)].set_game_state(secret_hitler.GameStates.GAME_OVER)
-                bot.send_message(chat_id=game_chat_id,
-                                 text="This game has been cancelled. Don’t be sad! Bugfixes and cool new features are coming!")
-            # No need to clear the existing_games dict as the bot is shutting down anyway
-            restart_executor()
+def restart_handler(bot, update):
+    """
+    Pulls newest code and ends the bot, so that the system daemon can restart it. Running games are handed
+    over to the new process.
+    """
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    logging.debug("Restart issued by: user_id: %s in chat_id: %s", user_id, chat_id)
+
+    if chat_id == DEV_CHAT_ID and chats.is_admin(chat_id, user_id):
+        logging.info("Restarting bot.")
+        send_message(chat_id, "Restarting. {} running game(s) will continue after the restart.".format(
+            len(all_running_games())))
+        restart_executor()
     else:
         logging.warning("Restart command issued in unauthorized group or by non-admin user. Not reacting.")
 
@@ -306,10 +828,10 @@ def restart_handler(bot, update):
 def restart_executor():
     if call(["git", "pull"]) != 0:
         logging.error("git pull failed")
-        bot.send_message(chat_id=DEV_CHAT_ID, text="Failed pulling newest bot version. Shutting down anyway.")
+        send_message(DEV_CHAT_ID, "Failed pulling newest bot version. Restarting anyway.")
     else:
         logging.info("git pull successful")
-        bot.send_message(chat_id=DEV_CHAT_ID, text="Pulled newest bot version. Shutting down.")
+        send_message(DEV_CHAT_ID, "Pulled newest bot version. Handing over to it.")
     # For reasons™ the stop function needs to be called in a new thread.
     # (https://github.com/python-telegram-bot/python-telegram-bot/issues/801#issuecomment-323778248)
     threading.Thread(target=stop_bot).start()
@@ -337,7 +859,9 @@ COMMAND_ALIASES = {"nom": "nominate", "blam": "blame", "dig": "investigate", "lo
 
 def game_command_handler(bot, update, chat_data, user_data):
     command, args = parse_message(update.message.text)
-    game_command_executor(bot, command, args, update.message.from_user, update.message.chat.id, chat_data, user_data)
+    with metrics.COMMAND_SECONDS.time(command, "message"):
+        game_command_executor(bot, command, args, update.message.from_user, update.message.chat.id, chat_data,
+                              user_data)
 
 
 def game_command_executor(bot, command, args, from_user, chat_id, chat_data, user_data):
@@ -348,16 +872,6 @@ def game_command_executor(bot, command, args, from_user, chat_id, chat_data, use
     if command in list(COMMAND_ALIASES.keys()):
         command = COMMAND_ALIASES[command]
 
-    # Try to restore relevant save data (and mark this data as dirty)
-    global restored_game
-    global restored_players
-    if restored_game is not None and restored_game.global_chat == chat_id:
-        chat_data["game_obj"] = restored_game
-        restored_game = None
-    if from_user.id in list(restored_players.keys()):
-        user_data["player_obj"] = restored_players[from_user.id]
-        del restored_players[from_user.id]
-
     player = None
     game = None
     if "player_obj" in list(user_data.keys()):
@@ -370,7 +884,7 @@ def game_command_executor(bot, command, args, from_user, chat_id, chat_data, use
         # this is a user's first interaction with the bot, so a Player
         # object must be created
         if game is None:
-            bot.send_message(chat_id=chat_id, text="Error: no game in progress here. Start one with /newgame")
+            send_message(chat_id, "Error: no game in progress here. Start one with /newgame")
             return
         else:
             if args and (game.check_name(args) is None):  # args is a valid name
@@ -387,38 +901,47 @@ def game_command_executor(bot, command, args, from_user, chat_id, chat_data, use
 
         # I don't know how you can end up here
         if game is None:
-            bot.send_message(chat_id=chat_id, text="Error: it doesn't look like you're currently in a game")
+            send_message(chat_id, "Error: it doesn't look like you're currently in a game")
             return
 
     # at this point, 'player' and 'game' should both be set correctly
 
     try:
-        reply = game.handle_message(chat_id, player, command, args)
+        try:
+            reply = game.handle_message(chat_id, player, command, args)
+        except secret_hitler.GameOverException:
+            # so that a game whose end wasn't archived yet when the bot went down is over when it is resumed
+            journal.record_command(game, chat_id, player, command, args)
+            raise
+        except Exception:
+            journal.record_failed_command(game, chat_id, player, command, args)  # with what it changed so far
+            raise
+        journal.record_command(game, chat_id, player, command, args)
+        game.finish_command()
+        if shard is not None:  # private chats of players are routed to the shard of their game
+            if player.game is not None:
+                shard.bind(player.id)
+            else:
+                shard.unbind(player.id)
         # DEBUG Print time logs data structure to dev chat
         #   if command == "timelogs":
         #     bot.send_message(chat_id=DEV_CHAT_ID, text=game.print_time_logs())
-        # pass all supressed errors (if any) directly to the handler in
-        # the order that they occurred
-        while len(secret_hitler.telegram_errors) > 0:
-            handle_error(bot, command, secret_hitler.telegram_errors.pop(0))
-        # TODO: it would be cleaner to just have a consumer thread handling
-        # these errors as they occur
+        # (errors of the game's deliveries are handled by failed_deliveries in the background)
 
         if reply:  # reply is None if no response is necessary
-            for part in split_message(reply):
-                bot.send_message(chat_id=chat_id, text=part, parse_mode=telegram.ParseMode.MARKDOWN)
+            # queued like the game's own messages, so the reply can't overtake them
+            for part in message_queue.split_message(reply):
+                outbound.send(chat_id, part, parse_mode=telegram.ParseMode.MARKDOWN)
 
     except secret_hitler.GameOverException:
+        journal.close(game)
+        archive_db.archive(game)
+        if shard is not None:
+            for p in game.players + list(game.spectators):
+                shard.unbind(p.id)
         if "{}".format(game.global_chat) in existing_games:
             del existing_games["{}".format(game.global_chat)]
-        if len(existing_games) == 0 and MAINTENANCE_MODE:
-            restart_executor()
-        elif MAINTENANCE_MODE:
-            bot.send_message(chat_id=DEV_CHAT_ID,
-                             text="A game has ended but there are {} more games, so I won’t restart yet".format(
-                                 len(existing_games)))
-        else:
-            bot.send_message(chat_id=DEV_CHAT_ID, text="A game has ended in {}.".format(bot.get_chat(game.global_chat).title))
+        send_message(DEV_CHAT_ID, "A game has ended in {}.".format(chats.title(game.global_chat)))
         return
 
 
@@ -439,11 +962,9 @@ def feedback_handler(bot, update, args=None):
         feedback.write(" ".join(args))
         feedback.write("\n")
         feedback.close()
-        bot.send_message(chat_id=update.message.chat_id,
-                         text="Thanks for the feedback!")
+        send_message(update.message.chat_id, "Thanks for the feedback!")
     else:
-        bot.send_message(chat_id=update.message.chat_id,
-                         text="Format: /feedback [feedback]")
+        send_message(update.message.chat_id, "Format: /feedback [feedback]")
 
 
 def handle_error(bot, update, error):
@@ -468,9 +989,15 @@ def save_game(bot, update, chat_data, user_data):
             i += 1  # ensures multiple games can be saved
 
         game.save(fname)
-        bot.send_message(chat_id=update.message.chat_id,
-                         text="Saved game in current state as '{}'".format(fname))
+        send_message(update.message.chat_id, "Saved game in current state as '{}'".format(fname))
+
 
+# What the router of a sharded deployment can ask every shard (see sharding.Router.gather)
+SHARD_CALLS = {
+    "running_games": running_games,
+    "hand_off": hand_off_games,
+    "botstats": botstats,
+}
 
 if __name__ == "__main__":
     main()
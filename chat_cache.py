@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+TITLE_TTL = 60 * 60  # seconds; titles also get refreshed from every group message and title change
+INVITE_LINK_TTL = 24 * 60 * 60  # an admin may revoke the link, so it is fetched again now and then
+ADMINS_TTL = 10 * 60
+
+
+class ChatCache(object):
+    """
+    Chat titles, invite links and administrators of the bot's chats, so that
+    handlers don't have to ask Telegram every time they need them.
+
+    Entries expire after their TTL and can be dropped with invalidate(). The
+    invite link is the chat's primary link if it has one: exportChatInviteLink
+    (which revokes the previous link) is only called when it has none, so the
+    links the bot has already sent out keep working.
+    """
+
+    def __init__(self, bot, title_ttl=TITLE_TTL, invite_link_ttl=INVITE_LINK_TTL, admins_ttl=ADMINS_TTL):
+        self.bot = bot
+        self.ttls = {"title": title_ttl, "invite_link": invite_link_ttl, "admins": admins_ttl}
+        self._entries = {}  # (kind, chat id) -> (value, expiry)
+        self._lock = threading.Lock()
+
+    def _get(self, kind, chat_id):
+        with self._lock:
+            entry = self._entries.get((kind, chat_id))
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def _put(self, kind, chat_id, value):
+        with self._lock:
+            self._entries[(kind, chat_id)] = (value, time.monotonic() + self.ttls[kind])
+
+    def _fetch_chat(self, chat_id):
+        chat = self.bot.get_chat(chat_id=chat_id)
+        self._put("title", chat_id, chat.title)
+        if getattr(chat, "invite_link", None):
+            self._put("invite_link", chat_id, chat.invite_link)
+        return chat
+
+    def title(self, chat_id):
+        title = self._get("title", chat_id)
+        if title is None:
+            title = self._fetch_chat(chat_id).title
+        return title
+
+    def invite_link(self, chat_id):
+        link = self._get("invite_link", chat_id)
+        if link is None:
+            link = self._fetch_chat(chat_id).invite_link or self.bot.export_chat_invite_link(chat_id=chat_id)
+            self._put("invite_link", chat_id, link)
+        return link
+
+    def admin_ids(self, chat_id):
+        admin_ids = self._get("admins", chat_id)
+        if admin_ids is None:
+            admin_ids = frozenset(member.user.id for member in self.bot.get_chat_administrators(chat_id))
+            self._put("admins", chat_id, admin_ids)
+        return admin_ids
+
+    def is_admin(self, chat_id, user_id):
+        return user_id in self.admin_ids(chat_id)
+
+    def invalidate(self, chat_id, *kinds):
+        """
+        Forget the given kinds of entries (by default all) of a chat
+        """
+        with self._lock:
+            for kind in kinds or tuple(self.ttls):
+                self._entries.pop((kind, chat_id), None)
+
+    def observe(self, message):
+        """
+        Keep the cache up to date with what a message tells about its chat (its title, title changes, members
+        joining and leaving)
+        """
+        chat = message.chat
+        if chat.type == "private":
+            return
+        if chat.title:
+            self._put("title", chat.id, chat.title)
+        if message.new_chat_members or message.left_chat_member:
+            self.invalidate(chat.id, "admins")
+        if message.migrate_to_chat_id:  # the group became a supergroup, which gets a new id and invite link
+            self.invalidate(chat.id)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import replay
+import secret_hitler
+
+JOURNAL_DIR = "ignore/journal"
+HISTORY_DIR = "ignore/replays"  # complete command streams of finished games, see replay.py
+FSYNC_INTERVAL = 0.5  # seconds between batched fsyncs
+SNAPSHOT_EVERY = 100  # journal entries between two snapshots of a game
+RESUME_WORKERS = 8
+
+
+class Journal(object):
+    """
+    Crash-safe persistence for all running games.
+
+    Every game has an append-only journal of the commands it accepted
+    (ignore/journal/<chat id>.journal, one JSON object per line) and a
+    snapshot (<chat id>.snapshot, a pickle of the game and the sequence
+    number of the last journal entry it contains). Journals are fsync'd in
+    batches by a background thread. After SNAPSHOT_EVERY entries the game is
+    snapshotted and its journal starts over, so resuming a game never
+    replays more than that many commands.
+
+    The files of a game are only written while holding the game's own lock,
+    so a slow disk only holds up the game whose files are being written.
+
+    Additionally, the complete command stream of a game is kept in
+    <chat id>.history, headed by the game's seed. When the game is over it
+    is moved to HISTORY_DIR, where replay.py can rebuild any step of it.
+    """
+
+    def __init__(self, directory=JOURNAL_DIR, history_directory=HISTORY_DIR):
+        self.directory = directory
+        self.history_directory = history_directory
+        self._lock = threading.Lock()  # guards which games are journaled (self._game_locks) and self._dirty
+        self._game_locks = {}  # chat id -> Lock held while writing the game's files and sequence numbers
+        self._files = {}  # chat id -> open journal file
+        self._histories = {}  # chat id -> open history file
+        self._sequence = {}  # chat id -> sequence number of the last entry
+        self._since_snapshot = {}  # chat id -> number of entries since the last snapshot
+        self._dirty = set()  # chat ids with entries that haven't been fsync'd yet
+        self._running = False
+
+        for path in (directory, history_directory):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._sync_periodically, name="journal-sync")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._running = False
+        self.sync()
+
+    def _path(self, chat_id, kind):
+        return os.path.join(self.directory, "{}.{}".format(chat_id, kind))
+
+    def open(self, game):
+        """
+        Start journaling a (new or restored) game by taking a snapshot of it
+        """
+        with self._game_lock(game.global_chat, create=True):
+            self._sequence.setdefault(game.global_chat, 0)
+            self._snapshot(game)
+            self._open_history(game)
+
+    def _game_lock(self, chat_id, create=False):
+        """
+        The lock of a journaled game, or None if it isn't journaled (unless `create`)
+        """
+        with self._lock:
+            if create:
+                return self._game_locks.setdefault(chat_id, threading.Lock())
+            return self._game_locks.get(chat_id)
+
+    def _open_history(self, game):
+        """
+        Assumes the game's lock is held.
+        """
+        path = self._path(game.global_chat, "history")
+        is_new = not os.path.exists(path)
+        history_file = self._histories[game.global_chat] = open(path, "a")
+        if is_new:
+            history_file.write(json.dumps({"op": "create", "chat": game.global_chat, "seed": game.seed}) + "\n")
+
+    def close(self, game):
+        """
+        Stop journaling a game that is over and delete its files
+        """
+        chat_id = game.global_chat
+        with self._lock:
+            game_lock = self._game_locks.pop(chat_id, None) or threading.Lock()
+        with game_lock:
+            for files in (self._files, self._histories):
+                if chat_id in files:
+                    files.pop(chat_id).close()
+            with self._lock:
+                self._dirty.discard(chat_id)
+            self._sequence.pop(chat_id, None)
+            self._since_snapshot.pop(chat_id, None)
+            for kind in ("journal", "snapshot"):
+                if os.path.exists(self._path(chat_id, kind)):
+                    os.remove(self._path(chat_id, kind))
+            if os.path.exists(self._path(chat_id, "history")):
+                os.replace(self._path(chat_id, "history"),
+                           os.path.join(self.history_directory, "{}_{}.history".format(chat_id, game.seed)))
+
+    def record_command(self, game, chat_id, player, command, args):
+        """
+        Journal a command that `game` has just handled. Commands that cannot change the game are skipped.
+        """
+        if command in secret_hitler.Game.READ_ONLY_COMMANDS:
+            return
+        if command == "startgame" and game.game_state == secret_hitler.GameStates.ACCEPT_PLAYERS:
+            return  # not accepted (e.g. because a player has blocked the bot)
+        self._record(game, {"op": "command", "chat": chat_id, "user": player.id, "name": player.name,
+                            "command": command, "args": args, "state": game.game_state.name})
+
+    def record_failed_command(self, game, chat_id, player, command, args):
+        """
+        Journal a command that raised part-way through. Replaying it can't be relied on to change the game the same
+        way, so the game is snapshotted as it is now and resuming starts from there.
+        """
+        self.record_command(game, chat_id, player, command, args)
+        self.compact([game])
+
+    def record_leave(self, game, player):
+        self._record(game, {"op": "leave", "user": player.id, "name": player.name,
+                            "state": game.game_state.name})
+
+    def record_spectator_channel(self, game, user_id, name, channel_id):
+        self._record(game, {"op": "spectator_channel", "user": user_id, "name": name, "channel": channel_id,
+                            "state": game.game_state.name})
+
+    def _record(self, game, entry):
+        chat_id = game.global_chat
+        game_lock = self._game_lock(chat_id)
+        if game_lock is None:
+            return  # not journaled (anymore)
+        with game_lock:
+            if chat_id not in self._sequence:
+                return  # closed in the meantime
+            self._sequence[chat_id] += 1
+            entry["seq"] = self._sequence[chat_id]
+            entry["ts"] = game.command_time
+
+            line = json.dumps(entry) + "\n"
+            self._files[chat_id].write(line)
+            self._histories[chat_id].write(line)
+            with self._lock:
+                self._dirty.add(chat_id)
+
+            self._since_snapshot[chat_id] = self._since_snapshot.get(chat_id, 0) + 1
+            if self._since_snapshot[chat_id] >= SNAPSHOT_EVERY:
+                self._snapshot(game)
+
+    def _snapshot(self, game):
+        """
+        Assumes the game's lock is held. Atomically replaces the game's snapshot, then starts a new journal.
+        """
+        chat_id = game.global_chat
+        temp_path = self._path(chat_id, "snapshot.tmp")
+        with open(temp_path, "wb") as out_file:
+            pickle.dump((self._sequence[chat_id], game), out_file)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(temp_path, self._path(chat_id, "snapshot"))
+
+        # entries up to the snapshot's sequence number are skipped when resuming, so a crash right here is fine
+        journal_file = self._files.pop(chat_id, None)
+        if journal_file is not None:
+            journal_file.close()
+        self._files[chat_id] = open(self._path(chat_id, "journal"), "w")
+        self._since_snapshot[chat_id] = 0
+        with self._lock:
+            self._dirty.discard(chat_id)
+
+    def compact(self, games):
+        """
+        Snapshot the given games, so that resuming them doesn't have to replay anything
+        """
+        for game in games:
+            game_lock = self._game_lock(game.global_chat)
+            if game_lock is None:
+                continue
+            with game_lock:
+                if game.global_chat in self._sequence:
+                    self._snapshot(game)
+
+    def sync(self):
+        """
+        fsync all journals with new entries
+        """
+        with self._lock:
+            dirty = [(chat_id, self._game_locks.get(chat_id)) for chat_id in self._dirty]
+            self._dirty.clear()
+        for chat_id, game_lock in dirty:
+            if game_lock is None:
+                continue  # being closed
+            with game_lock:
+                if self._game_locks.get(chat_id) is not game_lock:
+                    continue  # closed in the meantime
+                self._files[chat_id].flush()
+                self._histories[chat_id].flush()  # only needed for debugging, so no fsync
+                # a duplicate stays open even if the journal is closed or replaced by a snapshot meanwhile
+                fd = os.dup(self._files[chat_id].fileno())
+            try:
+                os.fsync(fd)  # the slow part, so the game can go on recording while it runs
+            finally:
+                os.close(fd)
+
+    def _sync_periodically(self):
+        while self._running:
+            time.sleep(FSYNC_INTERVAL)
+            try:
+                self.sync()
+            except (IOError, OSError):
+                logging.getLogger(__name__).exception("Syncing the game journals failed")
+
+    def resume(self, select=None, on_game_over=None):
+        """
+        Rebuild all journaled games (in parallel) and continue journaling them. Returns the list of games.
+        If given, only games whose chat id passes select(chat_id) are resumed. Games that turn out to be over
+        (the bot went down before it could close them) are closed, and passed to on_game_over(game) if given.
+        """
+        chat_ids = [name[:-len(".snapshot")] for name in os.listdir(self.directory) if name.endswith(".snapshot")]
+        if select is not None:
+            chat_ids = [chat_id for chat_id in chat_ids if select(int(chat_id))]
+        games = []
+        with ThreadPoolExecutor(max_workers=RESUME_WORKERS) as executor:
+            for chat_id, result in zip(chat_ids, executor.map(self._rebuild, chat_ids)):
+                if result is None:
+                    continue
+                sequence, game = result
+                if game.game_state == secret_hitler.GameStates.GAME_OVER:
+                    self.close(game)
+                    if on_game_over is not None:
+                        on_game_over(game)
+                    continue
+                with self._game_lock(game.global_chat, create=True):
+                    self._sequence[game.global_chat] = sequence
+                    self._snapshot(game)  # later restarts don't need to replay the same entries again
+                    self._open_history(game)
+                games.append(game)
+        return games
+
+    def _rebuild(self, chat_id):
+        """
+        Load a game's snapshot and replay the newer entries of its journal. Returns (sequence number, game).
+        """
+        try:
+            with open(self._path(chat_id, "snapshot"), "rb") as in_file:
+                sequence, game = pickle.load(in_file)
+        except Exception:
+            logging.getLogger(__name__).exception("Could not load the snapshot of game %s", chat_id)
+            return None
+
+        entries = []
+        if os.path.exists(self._path(chat_id, "journal")):
+            with open(self._path(chat_id, "journal"), "r") as journal_file:
+                for line in journal_file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break  # the last line was only partially written when the bot went down
+        entries = [entry for entry in entries if entry["seq"] > sequence]
+
+        players = {}  # user id -> Player
+        for player in game.players + list(game.spectators):
+            players[player.id] = player
+        with secret_hitler.silenced():
+            for entry in entries:
+                try:
+                    replay.apply_entry(game, entry, players)
+                except secret_hitler.GameOverException:
+                    pass
+                except Exception:
+                    logging.getLogger(__name__).exception("Replaying entry %s of game %s failed", entry["seq"],
+                                                          chat_id)
+                sequence = entry["seq"]
+                if game.game_state.name != entry["state"]:
+                    logging.getLogger(__name__).warning("Replay of game %s diverged at entry %s (%s instead of %s)",
+                                                        chat_id, sequence, game.game_state.name, entry["state"])
+        return sequence, game
+
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import time
+
+HANDOFF_FILE = "ignore/handoff.json"
+
+
+def save(offset, updates, waiting_players, fname=HANDOFF_FILE):
+    """
+    Leave what the next process needs to carry on where this one stopped: the offset to poll updates from,
+    the updates that were received but not handled yet (as dicts) and the waiting lists of the groups.
+    (The games themselves are picked up from their journals.)
+    """
+    directory = os.path.dirname(fname)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = fname + ".tmp"
+    with open(temp_path, "w") as out_file:
+        json.dump({"created": time.time(), "offset": offset, "updates": updates, "waiting": waiting_players},
+                  out_file)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(temp_path, fname)
+
+
+def load(fname=HANDOFF_FILE):
+    """
+    Returns what the previous process left (see save), or None if it didn't hand off. The file is removed, so
+    that it is only used once.
+    """
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, "r") as in_file:
+            state = json.load(in_file)
+    except ValueError:
+        logging.getLogger(__name__).exception("Ignoring the unreadable handoff file %s", fname)
+        state = None
+    os.remove(fname)
+    if state is not None:
+        logging.getLogger(__name__).info("Taking over from the previous process (handed off %.1fs ago)",
+                                         time.time() - state["created"])
+    return state
@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import functools
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+
+import metrics
+
+# Telegram's documented limits: roughly one message per second in a single chat
+# and 30 messages per second over all chats.
+# (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+CHAT_RATE = 1.0  # messages per second per chat
+CHAT_BURST = 3
+GLOBAL_RATE = 30.0  # messages per second per bot
+GLOBAL_BURST = 30
+NUM_WORKERS = 8
+# network errors (including timeouts) are retried after 1, 2, 4, ... seconds, at most MAX_ATTEMPTS times
+BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+MAX_ATTEMPTS = 6
+MAX_PENDING = 50  # critical messages kept per unreachable user
+MAX_MESSAGE_LENGTH = 4096
+MESSAGE_SEPARATOR = "\n\n"  # between the messages merged at the end of a turn
+LIVE_DEBOUNCE = 2.0  # seconds a live message waits for more updates before it is edited
+
+
+class TokenBucket(object):
+    """
+    A bucket that refills with `rate` tokens per second up to `capacity`.
+    Every delivered message takes one token (see rate_limit.py for other uses).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+
+    def delay(self, now, tokens=1):
+        """
+        Returns the number of seconds until `tokens` tokens are available (0 if they are right now)
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self, tokens=1):
+        self.tokens -= tokens
+
+
+class Job(object):
+    """
+    A single Bot API call waiting in a chat's lane.
+    """
+    __slots__ = ("method", "chat_id", "kwargs", "supress_errors", "critical", "attempts", "future")
+
+    def __init__(self, method, chat_id, kwargs, supress_errors, critical=False):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.supress_errors = supress_errors
+        self.critical = critical  # must reach the user eventually (see FailedDeliveries)
+        self.attempts = 0
+        self.future = Future()
+
+
+class LiveMessage(object):
+    """
+    A message that is kept up to date by editing it (see MessageQueue.live).
+    """
+    __slots__ = ("message_id", "text", "kwargs", "edit")
+
+    def __init__(self, text, kwargs):
+        self.message_id = None  # once it has been sent
+        self.text = text  # the latest text, which it has or is about to have
+        self.kwargs = kwargs
+        self.edit = None  # Job of the edit that is queued but not delivered yet
+
+
+class MessageQueue(object):
+    """
+    Outbound delivery of Bot API calls, drained by a pool of worker threads.
+
+    Every chat has its own lane. A lane is handled by at most one worker at a
+    time, so messages to the same chat are delivered in the order they were
+    queued, while different chats are served in parallel. Deliveries are
+    throttled by a token bucket per chat and one for the whole bot, and a
+    RetryAfter from Telegram pauses the affected lane for the requested time.
+    Network errors pause the lane with exponential backoff, up to
+    MAX_ATTEMPTS times, before the job fails.
+
+    Messages sent inside a turn() are held back until the turn ends and then
+    merged per chat, so that one command costs one message per recipient
+    instead of a burst of them.
+
+    live() keeps a message such as a game's status board up to date by
+    editing it. Its edits have a lane of their own (but count against the
+    chat's bucket) and are debounced, so a burst of updates becomes a
+    single edit.
+    """
+
+    def __init__(self, bot, on_error=None, workers=NUM_WORKERS, global_share=1):
+        self.bot = bot
+        self.on_error = on_error  # called with (job, error) for every suppressed TelegramError
+        self.num_workers = workers
+        # processes sending for the same bot (see sharding.py) each get an equal share of its global limit
+        self.global_bucket = TokenBucket(GLOBAL_RATE / global_share, max(1, GLOBAL_BURST // global_share))
+
+        self._lock = threading.Condition()
+        self._lanes = {}  # lane -> deque of Jobs (lane exists while a job is queued or in flight)
+        self._buckets = {}  # chat id -> TokenBucket
+        self._chat_lanes = {}  # chat id -> number of its lanes in self._lanes (the chat's and its live messages')
+        self._schedule = []  # heap of (not before, sequence number, lane), at most one entry per lane
+        self._live = {}  # (chat id, key) -> LiveMessage, which is also the lane of its edits
+        self._sequence = itertools.count()
+        self._threads = []
+        self._running = False
+        self._turn = threading.local()  # .messages: [(chat id, text, critical, kwargs, Future)] of the thread's turn
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._work, name="outbound-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Deliver everything that is still queued, then stop the workers.
+        """
+        self.flush(timeout)
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def flush(self, timeout=None):
+        """
+        Block until all queued jobs have been handled. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._lanes:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def qsize(self):
+        with self._lock:
+            return sum(len(lane) for lane in self._lanes.values())
+
+    def send(self, chat_id, text, supress_errors=True, critical=False, **kwargs):
+        """
+        Queue a message. Returns a Future that resolves to the sent telegram.Message.
+        """
+        messages = getattr(self._turn, "messages", None)
+        if messages is not None:
+            if supress_errors:
+                future = Future()
+                messages.append((chat_id, text, critical, kwargs, future))
+                return future
+            # the caller waits for this one, so it can't wait for the end of the turn (nor overtake what's held back)
+            self._end_turn(messages)
+        kwargs.update(chat_id=chat_id, text=text)
+        return self.submit("send_message", chat_id, kwargs, supress_errors, critical)
+
+    @contextlib.contextmanager
+    def turn(self):
+        """
+        Hold back the (suppressed) messages this thread sends inside the block and send them when it ends, with
+        consecutive messages to the same chat merged as far as MAX_MESSAGE_LENGTH allows. A message is only merged
+        into the previous one if they have the same options (e.g. parse_mode) and the previous one has no
+        reply_markup, so a keyboard always stays at the bottom of the message it belongs to. Nested turns are part of the outermost one.
+        """
+        if getattr(self._turn, "messages", None) is not None:
+            yield
+            return
+        self._turn.messages = messages = []
+        try:
+            yield
+        finally:
+            self._turn.messages = None
+            self._end_turn(messages)
+
+    def _end_turn(self, messages):
+        """
+        Merge and queue the messages of a turn (emptying the list)
+        """
+        merged = []  # [chat id, [texts], critical, kwargs, [Futures]]
+        last = {}  # chat id -> its last entry in merged
+        for chat_id, text, critical, kwargs, future in messages:
+            entry = last.get(chat_id)
+            if (entry is not None and entry[3].get("reply_markup") is None
+                    and dict(entry[3], reply_markup=None) == dict(kwargs, reply_markup=None)
+                    and sum(message_length(part) + len(MESSAGE_SEPARATOR) for part in entry[1])
+                    + message_length(text) <= MAX_MESSAGE_LENGTH):
+                entry[1].append(text)
+                entry[2] = entry[2] or critical
+                entry[3] = kwargs  # with this message's keyboard, if it has one
+                entry[4].append(future)
+                metrics.COALESCED_MESSAGES.inc()
+                continue
+            # a message after one with a keyboard starts a new message; so does a message with other options
+            entry = last[chat_id] = [chat_id, [text], critical, kwargs, [future]]
+            merged.append(entry)
+        del messages[:]
+
+        for chat_id, texts, critical, kwargs, futures in merged:
+            kwargs = dict(kwargs, chat_id=chat_id, text=MESSAGE_SEPARATOR.join(texts))
+            delivery = self.submit("send_message", chat_id, kwargs, True, critical)
+            delivery.add_done_callback(functools.partial(resolve_all, futures))
+
+    def submit(self, method, chat_id, kwargs, supress_errors=True, critical=False):
+        """
+        Queue the Bot API call bot.<method>(**kwargs) in the lane of chat_id.
+        """
+        job = Job(method, chat_id, kwargs, supress_errors, critical)
+        with self._lock:
+            self._enqueue(chat_id, job, 0)
+        return job.future
+
+    def _enqueue(self, lane, job, delay):
+        """
+        Assumes self._lock is held.
+        """
+        if lane in self._lanes:
+            self._lanes[lane].append(job)
+        else:
+            self._lanes[lane] = deque([job])
+            self._chat_lanes[job.chat_id] = self._chat_lanes.get(job.chat_id, 0) + 1
+            self._schedule_lane(lane, delay)
+
+    def live(self, chat_id, key, text, **kwargs):
+        """
+        Show `text` in the chat's live message `key`: the first call sends it, later calls edit it (after
+        LIVE_DEBOUNCE seconds, taking along all updates that arrive in the meantime). Unchanged texts cost nothing.
+        """
+        lane = (chat_id, key)
+        with self._lock:
+            message = self._live.get(lane)
+            if message is None:
+                message = self._live[lane] = LiveMessage(text, kwargs)
+                job = Job("send_message", chat_id, dict(kwargs, chat_id=chat_id, text=text), True)
+                job.future.add_done_callback(functools.partial(self._live_sent, lane, message, text))
+                self._enqueue(lane, job, 0)
+                return
+            if text == message.text:
+                return
+            message.text, message.kwargs = text, kwargs
+            if message.message_id is not None:  # otherwise _live_sent edits it once it's there
+                self._edit_live(lane, message)
+
+    def end_live(self, chat_id, key):
+        """
+        Stop updating a live message (it keeps showing its last text); the next live() sends a new one
+        """
+        with self._lock:
+            self._live.pop((chat_id, key), None)
+
+    def _edit_live(self, lane, message):
+        """
+        Assumes self._lock is held.
+        """
+        kwargs = dict(message.kwargs, chat_id=lane[0], message_id=message.message_id, text=message.text)
+        if message.edit is not None:  # not taken by a worker yet
+            message.edit.kwargs = kwargs
+            return
+        message.edit = Job("edit_message_text", lane[0], kwargs, True)
+        message.edit.future.add_done_callback(functools.partial(self._live_edited, lane, message))
+        self._enqueue(lane, message.edit, LIVE_DEBOUNCE)
+
+    def _live_sent(self, lane, message, text, sent):
+        with self._lock:
+            if self._live.get(lane) is not message:
+                return
+            if sent.exception() is not None:
+                del self._live[lane]  # try again with the next update
+                return
+            message.message_id = sent.result().message_id
+            if message.text != text:  # updated in the meantime
+                self._edit_live(lane, message)
+
+    def _live_edited(self, lane, message, edited):
+        if isinstance(edited.exception(), BadRequest) and "not modified" not in str(edited.exception()):
+            with self._lock:  # e.g. someone deleted the message, so it is sent again with the next update
+                if self._live.get(lane) is message:
+                    del self._live[lane]
+
+    def _schedule_lane(self, lane, delay):
+        """
+        Assumes self._lock is held.
+        """
+        heapq.heappush(self._schedule, (time.monotonic() + delay, next(self._sequence), lane))
+        self._lock.notify()
+
+    def _next_lane(self):
+        """
+        Assumes self._lock is held. Waits for the next lane that is due and returns it,
+        or None if the queue is stopping.
+        """
+        while self._running:
+            if self._schedule:
+                wait = self._schedule[0][0] - time.monotonic()
+                if wait <= 0:
+                    return heapq.heappop(self._schedule)[2]
+                self._lock.wait(wait)
+            else:
+                self._lock.wait()
+        return None
+
+    def _reserve(self, chat_id):
+        """
+        Assumes self._lock is held. Takes a token from both the chat's and the global bucket,
+        or returns the number of seconds to wait if either of them is empty.
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        delay = max(bucket.delay(now), self.global_bucket.delay(now))
+        if delay == 0:
+            bucket.take()
+            self.global_bucket.take()
+        return delay
+
+    def _close_lane(self, lane, chat_id):
+        """
+        Assumes self._lock is held.
+        """
+        del self._lanes[lane]
+        self._chat_lanes[chat_id] -= 1
+        if not self._chat_lanes[chat_id]:  # otherwise the chat's other lanes still use its bucket
+            del self._chat_lanes[chat_id]
+            # a full bucket behaves exactly like a new one, so there is no need to keep it around
+            bucket = self._buckets.get(chat_id)
+            if bucket is not None and bucket.delay(time.monotonic()) == 0 and bucket.tokens >= bucket.capacity:
+                del self._buckets[chat_id]
+        self._lock.notify_all()  # wake up flush()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                lane = self._next_lane()
+                if lane is None:
+                    return
+                job = self._lanes[lane][0]
+                delay = self._reserve(job.chat_id)
+                if delay > 0:
+                    self._schedule_lane(lane, delay)
+                    continue
+                live = self._live.get(lane)
+                if live is not None and live.edit is job:  # later updates need an edit of their own
+                    live.edit = None
+
+            retry_after = self._deliver(job)
+
+            with self._lock:
+                if retry_after is not None:
+                    self._schedule_lane(lane, retry_after)
+                    continue
+                jobs = self._lanes[lane]
+                jobs.popleft()
+                if jobs:
+                    self._schedule_lane(lane, 0)
+                else:
+                    self._close_lane(lane, job.chat_id)
+
+    def _deliver(self, job):
+        """
+        Performs the Bot API call of a job. Returns the number of seconds after which the job must be
+        retried, or None if it is done (successfully or not).
+        """
+        try:
+            result = getattr(self.bot, job.method)(**job.kwargs)
+        except RetryAfter as e:
+            logging.getLogger(__name__).warning("Flood limit hit in chat %s, retrying in %s s", job.chat_id,
+                                                e.retry_after)
+            return e.retry_after
+        except BadRequest as e:  # retrying won't help
+            self._fail(job, e)
+        except NetworkError as e:
+            if job.attempts + 1 >= MAX_ATTEMPTS:
+                self._fail(job, e)
+                return None
+            delay = min(MAX_BACKOFF, BACKOFF * 2 ** job.attempts)
+            job.attempts += 1
+            logging.getLogger(__name__).warning("%s in chat %s, retrying in %s s", e, job.chat_id, delay)
+            return delay
+        except TelegramError as e:
+            self._fail(job, e)
+        except Exception as e:
+            logging.getLogger(__name__).exception("Delivery to chat %s failed", job.chat_id)
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+        return None
+
+    def _fail(self, job, error):
+        if job.supress_errors and self.on_error is not None:
+            self.on_error(job, error)
+        job.future.set_exception(error)
+
+
+def message_length(text):
+    """
+    The length of a text as Telegram counts it: in UTF-16 code units, so most emoji count twice
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_message(message, length=MAX_MESSAGE_LENGTH):
+    """
+    Split a text into parts of at most `length` UTF-16 code units, without splitting characters
+    """
+    if message_length(message) <= length:
+        return [message] if message else []
+    parts = []
+    start = 0
+    units = 0
+    for i, char in enumerate(message):
+        size = 2 if ord(char) > 0xFFFF else 1
+        if units + size > length:
+            parts.append(message[start:i])
+            start = i
+            units = 0
+        units += size
+    parts.append(message[start:])
+    return parts
+
+
+def resolve_all(futures, done):
+    """
+    Resolve all of `futures` like the Future `done`
+    """
+    error = done.exception()
+    for future in futures:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(done.result())
+
+
+class FailedDeliveries(object):
+    """
+    Handles the errors of suppressed deliveries in a background thread.
+
+    Users that can't be reached (they blocked the bot or never started a chat
+    with it) are remembered, with the critical messages that didn't reach
+    them (up to MAX_PENDING each). Once such a user is back, returned() sends
+    those messages again. Everything else is only logged.
+    """
+
+    def __init__(self, on_unreachable=None):
+        self.on_unreachable = on_unreachable  # called with the chat id when a user first becomes unreachable
+        self.outbound = None
+        self.unreachable = {}  # chat id -> deque of (method, kwargs) of critical jobs that failed
+        self._errors = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, outbound):
+        """
+        Start handling errors; `outbound` is the MessageQueue that redelivers messages
+        """
+        self.outbound = outbound
+        self._thread = threading.Thread(target=self._consume, name="delivery-errors")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._errors.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def report(self, job, error):
+        """
+        MessageQueue's on_error: queue an error for the background thread
+        """
+        self._errors.put((job, error))
+
+    def _consume(self):
+        while True:
+            item = self._errors.get()
+            if item is None:
+                return
+            try:
+                self._handle(*item)
+            except Exception:
+                logging.getLogger(__name__).exception("Handling a delivery error failed")
+
+    def _handle(self, job, error):
+        # only users can come back by messaging the bot; a group or channel that kicked the bot is just logged
+        if not isinstance(error, Unauthorized) or job.chat_id < 0:
+            logging.getLogger(__name__).warning("TelegramError! %s (%s to chat %s)", error, job.method, job.chat_id)
+            return
+        with self._lock:
+            is_new = job.chat_id not in self.unreachable
+            pending = self.unreachable.setdefault(job.chat_id, deque(maxlen=MAX_PENDING))
+            if job.critical:
+                pending.append((job.method, job.kwargs))
+        if is_new:
+            logging.getLogger(__name__).info("Chat %s is unreachable: %s", job.chat_id, error)
+            if self.on_unreachable is not None:
+                self.on_unreachable(job.chat_id)
+
+    def is_unreachable(self, chat_id):
+        return chat_id in self.unreachable
+
+    def returned(self, chat_id):
+        """
+        A user that was unreachable is back: send them the critical messages they missed. Returns their number.
+        """
+        with self._lock:
+            pending = self.unreachable.pop(chat_id, None)
+        if not pending:
+            return 0
+        self.outbound.send(chat_id, "While I couldn't reach you, I had these messages for you:")
+        for method, kwargs in pending:
+            self.outbound.submit(method, chat_id, kwargs, critical=True)
+        return len(pending)
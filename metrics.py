@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# upper bounds (in seconds) of the latency histograms' buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in zip(names, values)) + "}"
+
+
+class Counter(object):
+    """
+    A monotonically increasing count per combination of label values.
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}  # tuple of label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + format_labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+
+class Histogram(object):
+    """
+    Counts of observed values per bucket (plus their sum) per combination of label values.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # tuple of label values -> [count per bucket (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """
+        Observe how long the with block takes (also if it raises)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def summary(self):
+        """
+        Returns {tuple of label values: (count, mean, upper bound of the 95th percentile)}
+        """
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        result = {}
+        for key, counts, total in values:
+            count = sum(counts)
+            running = 0
+            for i, bucket_count in enumerate(counts):
+                running += bucket_count
+                if running >= 0.95 * count:
+                    break
+            result[key] = (count, total / count, self.buckets[i] if i < len(self.buckets) else float("inf"))
+        return result
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self.values.items())
+        samples = []
+        for key, counts, total in values:
+            running = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                running += bucket_count
+                samples.append((self.name + "_bucket" + format_labels(self.labels + ("le",), key + (bound,)),
+                                running))
+            samples.append((self.name + "_sum" + format_labels(self.labels, key), total))
+            samples.append((self.name + "_count" + format_labels(self.labels, key), running))
+        return samples
+
+
+class Gauge(object):
+    """
+    A value that is read when the metrics are collected: function() returns {tuple of label values: value}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labels = labels
+
+    def samples(self):
+        try:
+            values = self.function()
+        except Exception:
+            logging.getLogger(__name__).exception("Reading gauge %s failed", self.name)
+            return []
+        return [(self.name + format_labels(self.labels, key), value) for key, value in sorted(values.items())]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """
+        All metrics in Prometheus' text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append("{} {}".format(sample, value))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = REGISTRY.register(Histogram(
+    "secret_hitler_command_seconds", "Time spent handling a game command", ("command", "source")))
+API_CALLS = REGISTRY.register(Counter(
+    "secret_hitler_api_calls_total", "Bot API calls", ("method",)))
+API_ERRORS = REGISTRY.register(Counter(
+    "secret_hitler_api_errors_total", "Failed Bot API calls", ("method", "error")))
+API_SECONDS = REGISTRY.register(Histogram(
+    "secret_hitler_api_call_seconds", "Duration of Bot API calls", ("method",)))
+ACTOR_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "secret_hitler_actor_wait_seconds", "Time commands wait in their game's mailbox before they are handled"))
+COALESCED_MESSAGES = REGISTRY.register(Counter(
+    "secret_hitler_coalesced_messages_total", "Messages merged into the previous message to the same chat"))
+THROTTLED_REQUESTS = REGISTRY.register(Counter(
+    "secret_hitler_throttled_requests_total", "Commands and button presses dropped by the rate limiter", ("command",)))
+
+
+class InstrumentedBot(object):
+    """
+    Wraps a telegram.Bot and counts and times every Bot API call made through it, and its errors by type.
+    """
+
+    def __init__(self, bot):
+        self._bot = bot
+        self._wrapped = {}  # method name -> instrumented method
+
+    def __getattr__(self, name):
+        attribute = getattr(self._bot, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+        wrapped = self._wrapped.get(name)
+        if wrapped is None:
+            wrapped = self._wrapped[name] = self._instrument(name)
+        return wrapped
+
+    def _instrument(self, name):
+        def call(*args, **kwargs):
+            API_CALLS.inc(name)
+            start = time.perf_counter()
+            try:
+                return getattr(self._bot, name)(*args, **kwargs)
+            except Exception as e:
+                API_ERRORS.inc(name, type(e).__name__)
+                raise
+            finally:
+                API_SECONDS.observe(time.perf_counter() - start, name)
+        call.__name__ = name
+        return call
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, listen="127.0.0.1", registry=REGISTRY):
+    """
+    Serve the metrics at http://listen:port/metrics in a background thread. Returns the server.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.exposition().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((listen, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return server
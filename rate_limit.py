@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from message_queue import TokenBucket
+
+USER_RATE = 0.5  # tokens per second
+USER_BURST = 10
+CHAT_RATE = 1.0
+CHAT_BURST = 30
+PRUNE_INTERVAL = 60  # seconds between dropping the buckets that have filled up again
+
+DEFAULT_COST = 1
+# Commands that make the bot send more than one message (or do expensive lookups) cost more
+COMMAND_COSTS = {
+    "logs": 5,
+    "timelogs": 5,
+    "feedback": 3,
+    "startgame": 3,
+    "newgame": 2,
+    "listplayers": 2,
+    "boardstats": 2,
+    "deckstats": 2,
+    "anarchystats": 2,
+    "mystats": 2,
+    "groupstats": 2,
+    "help": 2,
+    "changelog": 2,
+}
+
+
+def cost(command):
+    """
+    The number of tokens a command (or "button" for an inline button press) takes
+    """
+    return COMMAND_COSTS.get(command, DEFAULT_COST)
+
+
+class RateLimiter(object):
+    """
+    Token buckets per user and per chat for the commands and button presses sent to the bot.
+
+    A request is let through only if both the bucket of its user and the bucket of its chat have enough tokens
+    for it, so a single user can't use up a chat's share and a busy chat can't be flooded by many users.
+    """
+
+    def __init__(self, user_rate=USER_RATE, user_burst=USER_BURST, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._lock = threading.Lock()
+        self._users = {}  # user id -> TokenBucket
+        self._chats = {}  # chat id -> TokenBucket
+        self._warned = set()  # user ids that have been told they are throttled (until a request of theirs passes)
+        self._pruned = time.monotonic()
+
+    def check(self, user_id, chat_id, tokens=DEFAULT_COST):
+        """
+        Take `tokens` tokens from the buckets of the user and the chat. Returns 0 if they were taken, or the number
+        of seconds until they will be available (taking nothing).
+        """
+        now = time.monotonic()
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                user = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            delay = max(user.delay(now, min(tokens, user.capacity)), chat.delay(now, min(tokens, chat.capacity)))
+            if delay == 0:
+                user.take(min(tokens, user.capacity))
+                chat.take(min(tokens, chat.capacity))
+                self._warned.discard(user_id)
+            if now - self._pruned > PRUNE_INTERVAL:
+                self._prune(now)
+            return delay
+
+    def warn(self, user_id):
+        """
+        Returns whether a throttled user should be told so: only once until one of their requests passes again
+        """
+        with self._lock:
+            if user_id in self._warned:
+                return False
+            self._warned.add(user_id)
+            return True
+
+    def _prune(self, now):
+        # a full bucket is as good as a new one
+        for buckets in (self._users, self._chats):
+            for key in [key for key, bucket in buckets.items() if bucket.delay(now, bucket.capacity) == 0]:
+                del buckets[key]
+        self._pruned = now
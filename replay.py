@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sys
+
+import secret_hitler
+
+# Run python -i replay.py [GAME HISTORY] [STEP] to rebuild a game (as it was after STEP commands) and interact with it
+
+
+class Replay(object):
+    """
+    Deterministically rebuilds a game from its seed and the ordered stream of commands it accepted, as written
+    by game_journal (one dict per command, see apply_entry). Nothing is sent to anybody while replaying.
+    """
+
+    def __init__(self, chat_id, seed):
+        self.game = secret_hitler.Game(chat_id, seed=seed)
+        self.players = {}  # user id -> Player
+        self.step = 0  # number of entries applied so far
+        self.over = False
+
+    def apply(self, entry):
+        """
+        Apply the next entry of the command stream. Returns False once the game is over.
+        """
+        if self.over:
+            return False
+        self.step += 1
+        with secret_hitler.silenced():
+            try:
+                apply_entry(self.game, entry, self.players)
+            except secret_hitler.GameOverException:
+                self.over = True
+        if self.game.game_state == secret_hitler.GameStates.GAME_OVER:
+            self.over = True
+        return not self.over
+
+    def run(self, entries, until=None):
+        """
+        Apply all entries, or only the first `until` of them. Returns the game.
+        """
+        for entry in entries:
+            if until is not None and self.step >= until:
+                break
+            if not self.apply(entry):
+                break
+        return self.game
+
+
+def apply_entry(game, entry, players):
+    """
+    Apply one command stream entry to a game. `players` maps user ids to the Player objects known so far;
+    users that haven't been seen yet get a new Player with the entry's name.
+    """
+    player = players.get(entry["user"])
+    if player is None:
+        player = players[entry["user"]] = secret_hitler.Player(entry["user"], entry["name"])
+    if entry["op"] == "command":
+        game.handle_message(entry["chat"], player, entry["command"], entry["args"], timestamp=entry["ts"])
+    elif entry["op"] == "leave":
+        game.command_time = entry["ts"]
+        player.leave_game(confirmed=True)
+    elif entry["op"] == "spectator_channel":
+        game.set_spectator_channel(entry["channel"])
+
+
+def load(fname):
+    """
+    Load a game history file. Returns a Replay of it (at step 0) and the list of its entries.
+    """
+    with open(fname, "r") as in_file:
+        header = json.loads(in_file.readline())
+        entries = []
+        for line in in_file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break  # the last line was only partially written
+    return Replay(header["chat"], header["seed"]), entries
+
+
+if __name__ == "__main__":
+    replay, entries = load(sys.argv[1])
+    game = replay.run(entries, until=int(sys.argv[2]) if len(sys.argv) > 2 else None)
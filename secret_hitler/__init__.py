@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""
+The Secret Chavez game engine.
+
+It doesn't depend on Telegram, the bot or any config files: the bot hands it a
+Transport and its username with configure(). Games pickled when the engine was
+a single module load unchanged, since all of its names are still available here.
+"""
+
+from .game import *
+from .transport import Transport, Unreachable
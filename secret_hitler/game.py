@@ -1,23 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import binascii
+import bisect
+import contextlib
+import heapq
+import math
 import pickle
 import random
 import re
-import sys
+import struct
+import threading
 import time
-import unicodedata
+from array import array
+from collections import deque
 from enum import Enum
 import functools
 
-from telegram.error import Unauthorized, TelegramError
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
-
-import bot_telegram
+from .transport import Unreachable
 
 # Fix for #14
-all_unicode_chars = (chr(i) for i in range(sys.maxunicode))
-non_printable_chars = ''.join(c for c in all_unicode_chars if unicodedata.category(c) == 'Cc')
-non_printable_regex = re.compile('[%s]'%re.escape(non_printable_chars))
+# These ranges are exactly the code points of Unicode category Cc (C0 controls, DEL, C1 controls). That
+# category is closed, so there is no need to scan all of Unicode with unicodedata.category() at import time.
+non_printable_regex = re.compile('[\x00-\x1f\x7f-\x9f]')
 
 
 def strip_non_printable(s):
@@ -29,22 +34,52 @@ def strip_non_printable(s):
 
 markdown_regex = re.compile(".*((\[.*\]\(.*\))|\*|_|`).*")
 
-with open("config/username", "r") as f:
-    BOT_USERNAME = f.read().rstrip()
+BOT_USERNAME = None  # without the "@", set by configure()
 BLAME_RATELIMIT = 69  # seconds
-TESTING = (__name__ == "__main__")  # test whenever this file is run directly
+MAX_PLAYERS = 10
+DWELL_SAMPLES = 10000  # most recent dwell times per state that percentiles are computed from
+TESTING = (__name__ == "__main__")  # test whenever this file is run directly (python -m secret_hitler.game)
 # set TESTING to True to simulate a game locally
-if not TESTING:
 
-    telegram_errors = []
+_transport = None  # a secret_hitler.transport.Transport, set by configure() (unnecessary in TESTING mode)
+
 
-    # unnecessary in TESTING mode
+def configure(transport=None, bot_username=None):
+    """
+    Tell the engine how to reach the players and what the bot is called. Only what is given is changed.
+    """
+    global _transport
+    global BOT_USERNAME
+    if transport is not None:
+        _transport = transport
+    if bot_username is not None:
+        BOT_USERNAME = bot_username
+
+
+_silence = threading.local()
+
+
+@contextlib.contextmanager
+def silenced():
+    """
+    Drop all messages sent from the current thread while in this context (used when replaying games).
+    """
+    _silence.active = True
+    try:
+        yield
+    finally:
+        _silence.active = False
+
+
+def is_silenced():
+    return getattr(_silence, "active", False)
 
 
 class Player(object):
     """
     Class for keeping track of an individual Secret Chavez player.
     """
+    __slots__ = ("id", "name", "game", "party", "role")
 
     def __init__(self, _id, _name):
         """
@@ -56,21 +91,31 @@ class Player(object):
         self.party = None
         self.role = None
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in Player.__slots__}
+
+    def __setstate__(self, state):
+        """
+        Players are pickled as a dict of their slots (see __getstate__)
+        """
+        for name in Player.__slots__:
+            setattr(self, name, state.get(name))
+
     def __str__(self):
         return self.name
 
-    def send_message(self, msg, supress_errors=True, reply_markup=None):
+    def send_message(self, msg, supress_errors=True, reply_markup=None, critical=False):
+        """
+        Critical messages (secret information and everything the player has to act on) are delivered again if the
+        player can't be reached right now, once they are back (see Transport.send)
+        """
         if TESTING:
             print("[ Message for {} ]\n{}".format(self, msg))
-        else:
-            try:
-                bot_telegram.bot.send_message(chat_id=self.id, text=msg, reply_markup=reply_markup)
-            except TelegramError as e:
-                if supress_errors:
-                    telegram_errors.append(e)
-                    # network issues can cause errors in Telegram
-                else:
-                    raise e
+        elif not is_silenced():
+            delivery = _transport.send(self.id, msg, supress_errors=supress_errors, keyboard=reply_markup,
+                                       critical=critical or reply_markup is not None)
+            if not supress_errors:
+                delivery.result()  # wait for the delivery and raise its error, if any
 
     def get_markdown_tag(self):
         return "[{}](tg://user?id={})".format(self.name, self.id)
@@ -81,7 +126,7 @@ class Player(object):
         """
         self.role = _role
         self.party = _role.replace("Chavez", "chavista")
-        self.send_message("Your secret role is {}".format(self.role))
+        self.send_message("Your secret role is {}".format(self.role), critical=True)
 
     def join_game(self, _game):
         if self.leave_game(confirmed=False):
@@ -108,6 +153,187 @@ class Player(object):
             # of the more significant states
 
 
+class LogEntry(object):
+    """
+    A single line of a game's log, with a bitmask of who knows about it (see GameLog).
+    Entries are ordered by `order`, which is also their position key in GameLog's indexes.
+    """
+    __slots__ = ("order", "text", "mask")
+
+    def __init__(self, order, text, mask):
+        self.order = order
+        self.text = text
+        self.mask = mask
+
+    def __lt__(self, other):
+        return self.order < other.order
+
+
+class GameLog(object):
+    """
+    Keeps track of everything that happened in a game and who knows about it.
+
+    Every entry carries a visibility bitmask: GROUP marks public knowledge
+    (which is known to every player as well), SPECTATORS is set on every entry,
+    and each player gets a bit of their own the first time an entry is added
+    for them.
+    Public entries are indexed once, all other entries are indexed for each
+    player who knows them, so reading the log for a single audience only
+    touches the entries that audience can see.
+    """
+    GROUP = 1
+    SPECTATORS = 2
+
+    def __init__(self, group, spectator):
+        self.entries = []  # all LogEntry objects in display order
+        self.next_order = 0
+        self.public = []  # entries with the GROUP bit
+        self.private = {}  # player bit -> entries without the GROUP bit that are known to that player
+        self.bits = {group: GameLog.GROUP, spectator: GameLog.SPECTATORS}  # Player -> bit
+
+    def mask(self, players):
+        """
+        Returns the bitmask for a collection of players (including the dummy group/spectator players). Players
+        without a bit of their own know nothing but the public entries.
+        """
+        mask = 0
+        for player in players:
+            mask |= self.bits.get(player, 0)
+        return mask
+
+    def reserve(self):
+        """
+        Reserves a place at the current end of the log for an entry that will only be added later
+        (see add). Returns the reserved order key.
+        """
+        self.next_order += 1
+        return self.next_order - 1
+
+    def add(self, text, known_to, order=None):
+        """
+        Adds an entry known to the players in `known_to` (including the dummy group/spectator players) at the end
+        of the log or, if given, at a place reserved earlier, and returns it.
+        """
+        mask = 0
+        for player in known_to:
+            if player not in self.bits:
+                self.bits[player] = 1 << len(self.bits)
+            mask |= self.bits[player]
+        if order is None:
+            entry = LogEntry(self.reserve(), text, mask)
+            self.entries.append(entry)
+        else:
+            entry = LogEntry(order, text, mask)
+            bisect.insort(self.entries, entry)
+        self._index(entry, entry.mask)
+        return entry
+
+    def reveal(self, entry, mask):
+        """
+        Makes an entry known to everyone in `mask` as well
+        """
+        if entry.mask & GameLog.GROUP:
+            return  # already public
+        if mask & GameLog.GROUP:
+            # public entries are only indexed once
+            for bit in self._player_bits(entry.mask):
+                self.private[bit].remove(entry)
+            entry.mask = GameLog.GROUP | GameLog.SPECTATORS
+            self._index(entry, entry.mask)
+        else:
+            new_bits = mask & ~entry.mask
+            entry.mask |= mask
+            self._index(entry, new_bits)
+
+    def visible_to(self, mask):
+        """
+        Returns all entries (in order) that are known to at least one member of the audience `mask`
+        """
+        if mask & GameLog.SPECTATORS:
+            return self.entries  # spectators know everything
+        if mask == GameLog.GROUP:
+            return self.public
+        if mask & (mask - 1) == 0:  # a single player
+            return list(heapq.merge(self.public, self.private.get(mask, [])))
+        mask |= GameLog.GROUP
+        return [entry for entry in self.entries if entry.mask & mask]
+
+    def _index(self, entry, mask):
+        if mask & GameLog.GROUP:
+            bisect.insort(self.public, entry)
+        else:
+            for bit in self._player_bits(mask):
+                bisect.insort(self.private.setdefault(bit, []), entry)
+
+    @staticmethod
+    def _player_bits(mask):
+        mask &= ~(GameLog.GROUP | GameLog.SPECTATORS)
+        while mask:
+            bit = mask & -mask
+            yield bit
+            mask ^= bit
+
+
+class Legislation(object):
+    """
+    Record of a single legislative session: who was in office, which policies were drawn and passed on,
+    what both of them claimed and how it ended. The session's lines in the game log are rendered from it.
+    """
+
+    def __init__(self, president, chancellor, drawn):
+        self.president = president
+        self.chancellor = chancellor
+        self.drawn = drawn  # policies the president received, e.g. "FFL"
+        self.passed = None  # policies the president passed on to the chancellor
+        self.president_claim = None
+        self.chancellor_claim = None
+        self.veto = False
+        self.result = None  # enacted policy
+
+        # log places reserved for entries that are added later
+        self.president_claim_slot = None
+        self.chancellor_claim_slot = None
+        self.discrepancy_slot = None
+        self.claim_entries = []  # stay private until the session is over
+
+    def is_over(self):
+        return self.veto or self.result is not None
+
+    def peek_line(self, who):
+        if who == self.president:
+            return "President {} peeks at {}".format(who, self.drawn)
+        return "Chancellor {} peeks at {}".format(who, self.passed)
+
+    def president_claim_line(self):
+        return "President {} claims {} ↦ {}".format(self.president.name, self.president_claim,
+                                                    self.president_claim[1:])
+
+    def chancellor_claim_line(self):
+        return "Chancellor {} claims {} ↦ {}".format(self.chancellor.name, self.chancellor_claim,
+                                                     self.chancellor_claim[1:])
+
+    def has_discrepancy(self):
+        """
+        True if both have claimed and the chancellor's claim does not match what the president claims to have
+        passed on
+        """
+        if self.president_claim is None or self.chancellor_claim is None:
+            return False
+        return sorted(self.president_claim[1:]) != sorted(self.chancellor_claim)
+
+
+class Election(object):
+    """
+    Record of an election: the candidates and everybody's vote (by seat, None for dead players).
+    """
+
+    def __init__(self, president, chancellor, votes, passed):
+        self.president = president
+        self.chancellor = chancellor
+        self.votes = votes
+        self.passed = passed
+
+
 class GameStates(Enum):
     ACCEPT_PLAYERS = 1
     CHANCY_NOMINATION = 2
@@ -121,38 +347,233 @@ class GameStates(Enum):
     GAME_OVER = 10
 
 
+# what the status board says about each state
+PHASES = {
+    GameStates.CHANCY_NOMINATION: "President {president} is nominating a chancellor",
+    GameStates.ELECTION: "Election of President {president} and Chancellor {chancellor}",
+    GameStates.LEG_PRES: "Legislative session: waiting on President {president}",
+    GameStates.LEG_CHANCY: "Legislative session: waiting on Chancellor {chancellor}",
+    GameStates.VETO_CHOICE: "President {president} and Chancellor {chancellor} are deciding whether to veto",
+    GameStates.INVESTIGATION: "President {president} is investigating a player",
+    GameStates.SPECIAL_ELECTION: "Special Election: President {president} is choosing the next candidate",
+    GameStates.EXECUTION: "President {president} is choosing a player to execute",
+    GameStates.GAME_OVER: "Game over",
+}
+
+
 class GameOverException(Exception):
     pass
 
 
+# Inline buttons carry (game id, state serial, action, argument) packed into 8 bytes (12 characters of base64)
+# instead of a command string. The argument is a seat for actions on players and an index into POLICIES for
+# policies.
+CALLBACK_STRUCT = struct.Struct(">IHBB")
+CALLBACK_ACTIONS = ("nominate", "ja", "nein", "discard", "enact", "investigate", "kill")
+PLAYER_ACTIONS = ("nominate", "investigate", "kill")
+POLICIES = "LF"
+
+
+def encode_callback(game_id, serial, command, arg=0):
+    return base64.urlsafe_b64encode(CALLBACK_STRUCT.pack(game_id & 0xFFFFFFFF, serial & 0xFFFF,
+                                                         CALLBACK_ACTIONS.index(command), arg)).decode("ascii")
+
+
+def decode_callback(data):
+    """
+    Returns (game id, state serial, command, argument) of a button's callback data. Raises ValueError if it isn't
+    one of ours.
+    """
+    try:
+        game_id, serial, action, arg = CALLBACK_STRUCT.unpack(base64.urlsafe_b64decode(data.encode("ascii")))
+        return game_id, serial, CALLBACK_ACTIONS[action], arg
+    except (binascii.Error, struct.error, IndexError, UnicodeEncodeError):
+        raise ValueError("invalid callback data {!r}".format(data))
+
+
+class TimeLog(object):
+    """
+    Timings of a game, stored column-wise in arrays. There is one row per
+    state change (with seat ENTERED) and one per player action: the first
+    action of a seat in a state, with the time the state was entered and the
+    time of the action.
+
+    What /timelogs shows is kept per term as the game goes on (NaN while
+    unknown), so showing it doesn't have to look at the rows. The same goes
+    for the time spent in each state and each seat's response times.
+    """
+    ENTERED = -1
+
+    def __init__(self):
+        # one entry per row
+        self.term = array("i")
+        self.state = array("b")
+        self.seat = array("b")
+        self.entered = array("d")
+        self.acted = array("d")
+
+        # one entry per term
+        self.term_start = array("d")
+        self.term_end = array("d")
+        self.election_start = array("d")
+        self.election_end = array("d")  # time of the last (first) vote
+        self.legislation_start = array("d")
+        self.closed_total = 0.0  # total duration of all terms but the last
+
+        # running aggregates per state (by GameStates value) and per seat
+        self.dwell_count = array("i", [0] * (len(GameStates) + 1))
+        self.dwell_total = array("d", [0.0] * (len(GameStates) + 1))
+        self.response_count = array("i", [0] * MAX_PLAYERS)
+        self.response_total = array("d", [0.0] * MAX_PLAYERS)
+
+        self.current_state = None
+        self.current_value = 0  # value of current_state (Enum.value is comparatively slow)
+        self.current_entered = None
+        self.current_acted = 0  # bitmask of the seats that have acted in the current state
+
+    def _add_row(self, seat, acted):
+        self.term.append(len(self.term_start) - 1)
+        self.state.append(self.current_value)
+        self.seat.append(seat)
+        self.entered.append(self.current_entered)
+        self.acted.append(acted)
+
+    def enter(self, state, now):
+        """
+        Record entering `state`, which starts a new term if it is CHANCY_NOMINATION.
+        Returns (previous state, seconds spent in it), or None if this is the first state.
+        """
+        previous = None
+        if self.current_state is not None:
+            dwell = now - self.current_entered
+            self.dwell_count[self.current_value] += 1
+            self.dwell_total[self.current_value] += dwell
+            previous = (self.current_state, dwell)
+
+        if state == GameStates.CHANCY_NOMINATION:
+            if self.term_start:
+                self.term_end[-1] = now
+                self.closed_total += now - self.term_start[-1]
+            for column in (self.term_start, self.term_end, self.election_start, self.election_end,
+                           self.legislation_start):
+                column.append(math.nan)
+            self.term_start[-1] = now
+        elif state == GameStates.ELECTION:
+            self.election_start[-1] = self.election_end[-1] = now
+        elif state == GameStates.LEG_PRES:
+            self.legislation_start[-1] = now
+
+        self.current_state, self.current_value, self.current_entered, self.current_acted = state, state.value, now, 0
+        self._add_row(TimeLog.ENTERED, now)
+        return previous
+
+    def act(self, seat, now):
+        """
+        Record an action of the player in `seat` in the current state (only the first one counts)
+        """
+        if self.current_acted >> seat & 1:
+            return
+        self.current_acted |= 1 << seat
+        self._add_row(seat, now)
+        self.response_count[seat] += 1
+        self.response_total[seat] += now - self.current_entered
+        if self.current_state is GameStates.ELECTION and now > self.election_end[-1]:
+            self.election_end[-1] = now
+
+    def skip_legislation(self, now):
+        """
+        The election failed: the term ends without a legislative session (which is assumed to take 0 seconds)
+        """
+        self.legislation_start[-1] = now
+        self.term_end[-1] = now
+
+    def total(self, now):
+        """
+        Duration of all terms so far, the current one counting until `now`
+        """
+        if not self.term_start:
+            return 0.0
+        return self.closed_total + (now - self.term_start[-1])
+
+    def mean_dwell(self, state):
+        count = self.dwell_count[state.value]
+        return self.dwell_total[state.value] / count if count else None
+
+    def mean_response(self, seat):
+        count = self.response_count[seat]
+        return self.response_total[seat] / count if count else None
+
+
+class DwellTimes(object):
+    """
+    The most recent times spent in each state, over all games of this process.
+    """
+
+    def __init__(self, samples=DWELL_SAMPLES):
+        self._lock = threading.Lock()
+        self.samples = {state: deque(maxlen=samples) for state in GameStates}
+
+    def add(self, state, seconds):
+        with self._lock:
+            self.samples[state].append(seconds)
+
+    def percentiles(self, fractions=(0.5, 0.9, 0.99)):
+        """
+        Returns {GameStates: (number of samples, [percentile for each fraction])} for the states with samples
+        """
+        with self._lock:
+            samples = {state: sorted(values) for state, values in self.samples.items() if values}
+        return {state: (len(values), [values[min(len(values) - 1, int(fraction * len(values)))]
+                                      for fraction in fractions])
+                for state, values in samples.items()}
+
+
+dwell_times = DwellTimes()
+
+
 class Game(object):
-    def __init__(self, chat_id):
+    def __init__(self, chat_id, seed=None):
         """
         Initialize a game with a given chat location. Prepare deck/discard, begin accepting players.
+        All of the game's randomness comes from `seed` (a random one if not given), see replay.py.
         """
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.rng = random.Random(self.seed)  # own RNG, so its state is saved (and restored) with the game
+        self.command_time = time.time()
         if TESTING:
             self.deck = ['F', 'F', 'L', 'F', 'F', 'L', 'F', 'F', 'L', 'F', 'F', 'L', 'F', 'F', 'L', 'F', 'L']
         else:
             self.deck = ['L', 'L', 'L', 'L', 'L', 'L',
                          'F', 'F', 'F', 'F', 'F', 'F', 'F', 'F', 'F', 'F', 'F']
-            random.shuffle(self.deck)
+            self.rng.shuffle(self.deck)
 
         self.global_chat = chat_id
 
         self.discard = []
 
-        self.players = []
+        self.players = []  # in seating order once the game has started
+        self.seat_of = {}  # Player -> index in self.players
+        self.roster = []  # by seat: (user id, name, role) as dealt, which leaving or joining other games can't change
         self.president = None
         self.chancellor = None
-        self.termlimited_players = set()
-        self.dead_players = set()
-        self.confirmed_not_Chavezs = set()
+        # bitmasks of seats (bit i is self.players[i])
+        self.dead_seats = 0
+        self.termlimited_seats = 0
+        self.cnh_seats = 0  # confirmed not Chavez
+        self.voted_seats = 0
 
         self.spectator = Player(None, "spectators")  # dummy player used for logs access
         self.group = Player(None, "everyone")  # dummy player used for logs access
         self.spectators = set()
-        self.logs = []  # [(message, [known_to])]
-        self.time_logs = []  # [ GameState -> (Player -> timestamp) ]
+        self.spectator_channel = None  # chat that gets the spectators' digests instead of each spectator
+        self.spectator_digest = []  # private log lines of the command being handled, for the spectators
+        self.log = GameLog(self.group, self.spectator)
+        self.elections = []  # [Election]
+        self.legislations = []  # [Legislation]
+        self.legislation = None  # Legislation in progress
+        self.unclaimed_presidencies = {}  # Player -> deque of Legislations without their claim
+        self.unclaimed_chancellorships = {}  # Player -> deque of Legislations without their claim
+        self.timings = TimeLog()
 
         self.last_nonspecial_president = None
         self.vetoable_polcy = None
@@ -161,15 +582,88 @@ class Game(object):
 
         self.num_players = 0
 
-        self.votes = []
+        self.votes = []  # by seat: True (ja), False (nein) or None
+        self.ja_votes = 0
+        self.nein_votes = 0
         self.mudista = 0
         self.chavista = 0
         self.anarchy_progress = 0
 
         self.game_state = GameStates.ACCEPT_PLAYERS
+        self.serial = 0  # bumped by every state change, so buttons of earlier states can be told apart
+        self.winner = None  # winning party once the game is decided
+
+        self.version = 0  # bumped by every change that can affect a rendering of the game
+        self.renders = {}  # rendering key -> (version, text)
+
+    def __setstate__(self, state):
+        """
+        Games pickled by versions of the bot from before the GameLog (and the seeded RNG, legislations etc.)
+        can't be restored
+        """
+        if "log" not in state:
+            raise ValueError("this game was saved by an older version of the bot and can't be restored")
+        self.__dict__.update(state)
+
+    def __getstate__(self):
+        """
+        Renderings aren't pickled, they are cheap to rebuild
+        """
+        state = self.__dict__.copy()
+        state["renders"] = {}
+        return state
+
+    def seats_mask(self, players):
+        """
+        Returns the bitmask of the seats of the given players (ignoring those without a seat)
+        """
+        mask = 0
+        for player in players:
+            if player in self.seat_of:
+                mask |= 1 << self.seat_of[player]
+        return mask
+
+    def reseat(self):
+        self.seat_of = {player: seat for seat, player in enumerate(self.players)}
+
+    def is_dead(self, player):
+        return self.dead_seats >> self.seat_of[player] & 1 == 1
+
+    def is_termlimited(self, player):
+        return self.termlimited_seats >> self.seat_of[player] & 1 == 1
+
+    def alive_players(self):
+        if not self.dead_seats:
+            return list(self.players)
+        return [player for seat, player in enumerate(self.players) if not self.dead_seats >> seat & 1]
+
+    def touch(self):
+        """
+        Mark the game as changed, which invalidates all cached renderings
+        """
+        self.version += 1
+
+    def cached(self, key, render, version=None):
+        """
+        Returns render() as of `version` (by default the game's version), rendering it only if it isn't cached yet
+        """
+        if version is None:
+            version = self.version
+        cached_version, text = self.renders.get(key, (None, None))
+        if cached_version != version:
+            text = render()
+            self.renders[key] = (version, text)
+        return text
+
+    def now(self):
+        """
+        Time of the command being handled. Everything a command does is logged with the same timestamp, which
+        makes replays exact.
+        """
+        return self.command_time
 
     def reset_blame_ratelimit(self):
-        self.last_blame = time.time() - BLAME_RATELIMIT
+        self.last_blame = self.now() - BLAME_RATELIMIT
 
     def show(self, things_to_show=None):
         """
@@ -187,10 +681,89 @@ class Game(object):
         - A separator                           "-"
         """
         if things_to_show is None:
-            things_to_show = ["mudista", "chavista", "br", "anarchy", "-", "players", "-", "deck_stats", "br",
-                              "Chavez_warning"]
+            things_to_show = ("mudista", "chavista", "br", "anarchy", "-", "players", "-", "deck_stats", "br",
+                              "Chavez_warning")
+        things_to_show = tuple(things_to_show)
+        return self.cached(things_to_show, lambda: "\n".join(
+            [self.cached(to_show, functools.partial(self.render_section, to_show)) for to_show in things_to_show]))
+
+    def status_board(self):
+        """
+        The text of the group's live status board: the board stats, the current phase and, during an election,
+        who has voted so far (not how)
+        """
+        return self.cached("status_board", self.render_status_board)
+
+    def render_status_board(self):
+        lines = [self.show(), self.render_section("-"),
+                 PHASES[self.game_state].format(president=self.president, chancellor=self.chancellor)]
+        if self.game_state == GameStates.ELECTION:
+            lines.append("Voted ({}/{}): {}".format(
+                self.ja_votes + self.nein_votes, self.num_alive_players,
+                ", ".join(self.players[i].name for i in range(self.num_players) if self.voted_seats >> i & 1) or "-"))
+        elif self.game_state == GameStates.GAME_OVER and self.winner is not None:
+            lines[-1] += ": the {}s won".format(self.winner)
+        return "\n".join(lines)
+
+    def button(self, text, command, arg=0):
+        """
+        A button for the current state. Its data carries the state's serial, so keyboards are cached per serial
+        rather than per version: they stay valid until the state changes.
+        """
+        return text, encode_callback(self.seed, self.serial, command, arg)
+
+    def players_keyboard(self, command, seats):
+        """
+        A keyboard with a button for each player in the bitmask `seats` that sends `command` about them
+        """
+        return self.cached(("keyboard", command, seats), lambda: tuple(
+            (self.button(self.players[seat].name, command, seat),) for seat in range(self.num_players)
+            if seats >> seat & 1), self.serial)
+
+    def policies_keyboard(self, command, policies):
+        return self.cached(("keyboard", command, tuple(policies)), lambda: (
+            tuple(self.button(policy, command, POLICIES.index(policy)) for policy in policies),), self.serial)
+
+    def vote_keyboard(self):
+        """
+        Ja/Nein keyboard, built once per state for all voters (or both veto deciders)
+        """
+        return self.cached("vote_keyboard", lambda: ((self.button("Ja", "ja"), self.button("Nein", "nein")),),
+                           self.serial)
+
+    def button_command(self, serial, command, arg):
+        """
+        Returns the arguments of the command of a button (see decode_callback) of this game, or None if the button
+        is from an earlier state
+        """
+        if serial != self.serial:
+            return None
+        if command in PLAYER_ACTIONS:
+            if arg >= self.num_players:
+                return None
+            return "{}".format(arg + 1)  # get_player() looks seat numbers up directly
+        elif command in ("discard", "enact"):
+            return POLICIES[arg] if arg < len(POLICIES) else None
+        return ""
+
+    def update_board(self, final=False):
+        """
+        Bring the group's status board up to date (it is edited in place, see Transport.live).
+        Once the game is over, the board gets a `final` update that shows how it ended and none after that.
+        """
+        if TESTING or is_silenced() or self.game_state == GameStates.ACCEPT_PLAYERS:
+            return
+        if self.game_state == GameStates.GAME_OVER and not final:
+            return
+        _transport.live(self.global_chat, "board", self.status_board())
+        if self.game_state == GameStates.GAME_OVER:
+            _transport.end_live(self.global_chat, "board")
+
+    def render_section(self, to_show):
+        """
+        Renders a single section of show()
+        """
         message = ""
-        to_show, rest = things_to_show[0], things_to_show[1:]
         if to_show == "mudista":
             message = "— mudista Track —\n" + " ".join(
                 ["✖️", "✖️", "✖️", "✖️", "✖️"][:self.mudista] + ["◻️", "◻️", "◻️", "◻️", "🕊"][self.mudista - 5:])
@@ -208,7 +781,7 @@ class Game(object):
                 ["✖️", "✖️", "✖️"][:self.anarchy_progress] + ["◻️", "◻️", "◻️"][:3 - self.anarchy_progress])
         elif to_show == "players":
             message = "— Presidential Order —\n" + " ➡️ ".join(
-                [player.name for player in self.players if player not in self.dead_players]) + " 🔁"
+                [player.name for player in self.alive_players()]) + " 🔁"
         elif to_show == "deck_stats":
             message = "There are {} policies left in the draw pile, {} in the discard pile.".format(len(self.deck),
                                                                                                     len(self.discard))
@@ -224,8 +797,6 @@ class Game(object):
             message += "───────────────"
         elif len(to_show) > 0:
             message += "(I don’t know what you mean by “{}”)".format(to_show)
-        if len(rest) > 0:
-            message += "\n" + self.show(rest)
         return message
 
     def start_game(self):
@@ -236,12 +807,15 @@ class Game(object):
         - begin presidential rotation with the first presidnet nominating their chancellor
         """
 
-        random.shuffle(self.players)  # randomize seating order
-        self.global_message("Randomized seating order:\n" + self.list_players())
-
+        self.rng.shuffle(self.players)  # randomize seating order
+        self.reseat()
         self.num_players = len(self.players)
         self.num_alive_players = self.num_players
         self.num_dead_players = 0
+        self.votes = [None] * self.num_players
+        self.touch()
+
+        self.global_message("Randomized seating order:\n" + self.list_players())
         self.reset_blame_ratelimit()
 
         if TESTING:
@@ -252,11 +826,11 @@ class Game(object):
                 # NOTE: testing configuration does not "notify" chavistas of night-phase info (if this breaks, it'll be apparent pretty quickly)
         else:
             if self.num_players == 5 or self.num_players == 6:  # 1F + H
-                chavistas = random.sample(self.players, 2)
+                chavistas = self.rng.sample(self.players, 2)
             elif self.num_players == 7 or self.num_players == 8:  # 2F + H
-                chavistas = random.sample(self.players, 3)
+                chavistas = self.rng.sample(self.players, 3)
             elif self.num_players == 9 or self.num_players == 10:  # 3F + H
-                chavistas = random.sample(self.players, 4)
+                chavistas = self.rng.sample(self.players, 4)
             else:
                 raise Exception("Invalid number of players")
 
@@ -264,20 +838,21 @@ class Game(object):
                 if p == chavistas[0]:
                     p.set_role("Chavez")
                     if self.num_players <= 6:
-                        p.send_message("chavista: {}".format(chavistas[1]))
+                        p.send_message("chavista: {}".format(chavistas[1]), critical=True)
                 elif p in chavistas:
                     p.set_role("chavista")
                     if self.num_players <= 6:
-                        p.send_message("Chavez: {}".format(chavistas[0]))
+                        p.send_message("Chavez: {}".format(chavistas[0]), critical=True)
                     else:
                         p.send_message("Other chavista{}: {}\nChavez: {}".format("s" if len(chavistas) > 3 else "",
                                                                                 ", ".join(
                                                                                     [other_p.name for other_p in
                                                                                      chavistas[1:] if other_p != p]),
-                                                                                chavistas[0]))
+                                                                                chavistas[0]), critical=True)
                 else:
                     p.set_role("mudista")
 
+        self.roster = [(player.id, player.name, player.role) for player in self.players]
         self.record_log("ROLES:", known_to=self.players)
         for player in self.players:
             if player.role == "mudista":
@@ -296,40 +871,136 @@ class Game(object):
         """
         if TESTING:
             print("[ Message for everyone ]\n{}".format(msg))
-        else:
-            try:
-                bot_telegram.bot.send_message(chat_id=self.global_chat, text=msg, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-            except TelegramError as e:
-                if supress_errors:
-                    telegram_errors.append(e)
-                    # network issues can cause errors in Telegram
-                else:
-                    raise e
+        elif not is_silenced():
+            delivery = _transport.send(self.global_chat, msg, supress_errors=supress_errors, keyboard=reply_markup,
+                                       markdown=True)
+            if not supress_errors:
+                delivery.result()
 
-    def record_log(self, msg, known_to=None, position=-1):
+    def record_log(self, msg, known_to=None, order=None):
+        """
+        Add a line to the game's log that is known to the players in known_to (all players and the group by
+        default). Spectators always see everything; non-public entries are collected for their digest (see
+        finish_command). `order` places the line at a spot reserved with self.log.reserve(). Returns the new log
+        entry.
+        """
         if known_to is None or known_to == self.players:
-            known_to = self.players + [self.group]
-        if self.spectator not in known_to:  # spectators always see everything
-            known_to.append(self.spectator)
+            known_to = [self.group]  # public knowledge
+        entry = self.log.add(msg, list(known_to) + [self.spectator], order)
+        # non-public knowledge, so spectators are informed explicitly
+        if not entry.mask & GameLog.GROUP and (self.spectators or self.spectator_channel is not None) \
+                and not is_silenced():
+            self.spectator_digest.append(msg)
+        return entry
 
-        if position >= 0:
-            self.logs.insert(position, (msg, known_to))
+    def send_spectator_digest(self):
+        """
+        Send the spectators what only they (and some players) learned from the command that was just handled:
+        one message to the spectator channel if the game has one, otherwise one to each spectator
+        """
+        if not self.spectator_digest:
+            return
+        digest = "\n".join(self.spectator_digest)
+        self.spectator_digest = []
+        if self.spectator_channel is None:
+            for p in self.spectators:
+                p.send_message(digest)
+        elif TESTING:
+            print("[ Message for the spectator channel ]\n{}".format(digest))
         else:
-            self.logs.append((msg, known_to))
-        if self.group not in known_to:  # non-public knowledge, so spectators are informed explicitly
+            _transport.send(self.spectator_channel, digest)
+
+    def set_spectator_channel(self, chat_id):
+        """
+        Send the spectators' digests to the chat `chat_id` (None: to each spectator again)
+        """
+        self.spectator_channel = chat_id
+        if chat_id is not None:
             for p in self.spectators:
-                p.send_message(msg)
-        # If a legislation ends or if claims were added to a retroactively added to a finished legislation, reveal corresponding claims
-        if ("Enacted" in msg) or ("Veto" in msg) or ("claims" in msg) or ("Discrepancy" in msg):
-            enactment_found = False
-            for message, known_to in reversed(self.logs):
-                if ("Enacted" in message) or ("Veto" in message):
-                    enactment_found = True
-                if enactment_found and (("claims" in message) or ("Discrepancy" in message)):
-                    known_to.extend(self.players + [self.group])
+                p.send_message("From now on, the spectators' log of this game is posted in a spectator channel.")
+
+    def finish_command(self, final=False):
+        """
+        Send what is sent once per handled command rather than right away: the spectators' digest and the status
+        board. Called by whoever passes the commands to handle_message.
+        """
+        self.send_spectator_digest()
+        self.update_board(final)
+
+    def start_legislation(self):
+        """
+        Open the record of a legislative session when the president draws the top 3 policies.
+        """
+        self.legislation = Legislation(self.president, self.chancellor, "".join(self.deck[:3]))
+        self.legislations.append(self.legislation)
+        self.unclaimed_presidencies.setdefault(self.president, deque()).append(self.legislation)
+
+        self.president.send_message(self.legislation.drawn, critical=True)
+        self.record_log(self.legislation.peek_line(self.president), known_to=[self.president])
+        self.legislation.president_claim_slot = self.log.reserve()
+
+    def pass_to_chancellor(self):
+        """
+        Record the policies the president passed on to the chancellor
+        """
+        self.legislation.passed = "".join(self.deck[:2])
+        self.unclaimed_chancellorships.setdefault(self.chancellor, deque()).append(self.legislation)
+
+        self.chancellor.send_message(self.legislation.passed, critical=True)
+        self.record_log(self.legislation.peek_line(self.chancellor), known_to=[self.president, self.chancellor])
+        self.legislation.chancellor_claim_slot = self.log.reserve()
+        self.legislation.discrepancy_slot = self.log.reserve()
+
+    def end_legislation(self, result=None, veto=False):
+        """
+        Close the record of the legislative session in progress (if any) and reveal its claims.
+        """
+        legislation, self.legislation = self.legislation, None
+        if legislation is None:
+            return  # anarchy
+        legislation.result = result
+        legislation.veto = veto
+        for entry in legislation.claim_entries:
+            self.log.reveal(entry, GameLog.GROUP)
+
+    def record_claim(self, legislation, msg, known_to, order):
+        """
+        Log a claim (or discrepancy) of a legislative session. It stays private until that session is over.
+        """
+        entry = self.record_log(msg, known_to=known_to, order=order)
+        if legislation.is_over():
+            self.log.reveal(entry, GameLog.GROUP)
+        else:
+            legislation.claim_entries.append(entry)
+
+    def claim(self, player, claim):
+        """
+        Log the claim of `player` for their first legislative session that they haven't claimed yet:
+        3 policies for a presidency, 2 for a chancellorship. Returns False if there is no such session.
+        """
+        if len(claim) == 3:
+            unclaimed = self.unclaimed_presidencies.get(player)
+        else:
+            unclaimed = self.unclaimed_chancellorships.get(player)
+        if not unclaimed:
+            return False
+
+        legislation = unclaimed.popleft()
+        if len(claim) == 3:
+            legislation.president_claim = claim
+            self.record_claim(legislation, legislation.president_claim_line(), [player],
+                              legislation.president_claim_slot)
+        else:
+            legislation.chancellor_claim = claim
+            self.record_claim(legislation, legislation.chancellor_claim_line(), [player],
+                              legislation.chancellor_claim_slot)
+        if legislation.has_discrepancy():
+            self.record_claim(legislation, "💥 Discrepancy!", [self.spectator], legislation.discrepancy_slot)
+        return True
 
     def show_logs(self, include_knowledge_of=None):
-        return "Logs for {}:\n".format(", ".join([player.name for player in include_knowledge_of]))+"\n".join([info for info, known_to in self.logs if len([player for player in include_knowledge_of if player in known_to]) > 0])
+        return "Logs for {}:\n".format(", ".join([player.name for player in include_knowledge_of])) + "\n".join(
+            [entry.text for entry in self.log.visible_to(self.log.mask(include_knowledge_of))])
 
     @staticmethod
     def format_time(seconds):
@@ -337,42 +1008,33 @@ class Game(object):
         return "{0:0>2}h {1:0>2}m".format(gmtime.tm_hour, gmtime.tm_min)
 
     def show_time_logs(self):
-        return "Time Logs:\n\n" + ("\n{}\n".format(self.show(["-"]))).join(
-            ["Term {}: {}".format(
+        timings = self.timings
+        now = self.now()
+        terms = []
+        for index in range(len(timings.term_start)):
+            start, end = timings.term_start[index], timings.term_end[index]
+            election_start, legislation_start = timings.election_start[index], timings.legislation_start[index]
+            terms.append("Term {}: {}\n  {} to nominate\n  {} to elect\n  {} to legislate".format(
                 index + 1,
-                "{}\n  {} to nominate\n  {} to elect\n  {} to legislate".format(
-                    # total time
-                    "{} (and counting)".format(self.format_time(time.time() - term[GameStates.CHANCY_NOMINATION][self.spectator])) if self.group not in term[GameStates.CHANCY_NOMINATION] else self.format_time(term[GameStates.CHANCY_NOMINATION][self.group] - term[GameStates.CHANCY_NOMINATION][self.spectator]),
-                    # time to nominate
-                    "???" if GameStates.ELECTION not in term else self.format_time(term[GameStates.ELECTION][self.spectator] - term[GameStates.CHANCY_NOMINATION][self.spectator]),
-                    # time to elect
-                    "???" if GameStates.LEG_PRES not in term else self.format_time(max(term[GameStates.ELECTION].values()) - term[GameStates.ELECTION][self.spectator]),
-                    # time to legislate
-                    "???" if self.group not in term[GameStates.CHANCY_NOMINATION] or GameStates.LEG_PRES not in term else self.format_time(term[GameStates.CHANCY_NOMINATION][self.group] - term[GameStates.LEG_PRES][self.spectator])
-                )
-            ) for index, term in enumerate(self.time_logs)]
-        ) + ("\n{}\n".format(self.show(["-"])))\
-                + "Total Time: {}".format(
-            self.format_time(
-                functools.reduce(
-                    lambda x, y: x+y,
-                    [term[GameStates.CHANCY_NOMINATION][self.group] - term[GameStates.CHANCY_NOMINATION][self.spectator] if index is not (len(self.time_logs)-1) else time.time() - term[GameStates.CHANCY_NOMINATION][self.spectator] for index, term in enumerate(self.time_logs)]
-                )
-            )
-        )
+                # total time
+                "{} (and counting)".format(self.format_time(now - start)) if math.isnan(end) else self.format_time(end - start),
+                # time to nominate
+                "???" if math.isnan(election_start) else self.format_time(election_start - start),
+                # time to elect
+                "???" if math.isnan(legislation_start) else self.format_time(timings.election_end[index] - election_start),
+                # time to legislate
+                "???" if math.isnan(end) or math.isnan(legislation_start) else self.format_time(end - legislation_start)
+            ))
+        separator = "\n{}\n".format(self.show(["-"]))
+        return "Time Logs:\n\n" + separator.join(terms) + separator + "Total Time: {}".format(
+            self.format_time(timings.total(now)))
 
     # DEBUG
     def print_time_logs(self):
-        message = "[\n"
-        for term in self.time_logs:
-            message += "  [\n"
-            for gamestate in term:
-                message += "    {}\n    [\n".format(gamestate)
-                for player in term[gamestate]:
-                    message += "      {}: {}\n".format(player, term[gamestate][player])
-                message += "    ]\n"
-            message += "  ]\n"
-        message += "]"
+        timings = self.timings
+        message = "term state seat entered acted\n"
+        for row in zip(timings.term, timings.state, timings.seat, timings.entered, timings.acted):
+            message += "{} {} {} {:.0f} {:.0f}\n".format(*row)
         return message
 
     def add_spectator(self, target):
@@ -447,6 +1109,9 @@ class Game(object):
         (RIP) indicates a dead player
         (CNH) indicates a player that has been proven not to be Chavez
         """
+        return self.cached("list_players", self.render_player_list)
+
+    def render_player_list(self):
         ret = ""
         for i in range(len(self.players)):
             status = ""
@@ -454,11 +1119,11 @@ class Game(object):
                 status += " (P)"
             if self.players[i] == self.chancellor:
                 status += " (C)"
-            if self.players[i] in self.termlimited_players:
+            if self.termlimited_seats >> i & 1:
                 status += " (TL)"
-            if self.players[i] in self.dead_players:
+            if self.dead_seats >> i & 1:
                 status += " (RIP)"
-            if self.players[i] in self.confirmed_not_Chavezs:
+            if self.cnh_seats >> i & 1:
                 status += " (CNH)"
             ret += "({}) {}{}\n".format(i + 1, self.players[i], status)
 
@@ -468,33 +1133,32 @@ class Game(object):
         """
         Given a Player p, add them to the game.
         """
+        self.seat_of[p] = len(self.players)
         self.players.append(p)
-        self.votes.append(None)
         self.num_players += 1
+        self.touch()
 
     def remove_player(self, p):
         """
         Remove a Player p from the game. (If p is not in the game, does nothing)
-        Only valid before game starts or, theoretically, if they're dead (untested)
+        Only valid before game starts or if they're dead (dead players keep their seat, so that everything
+        indexed by seat stays valid).
         If this method is called on a live player after the game has begun, the game will self-destruct
         (reveal all player roles and declare game over).
         """
-        if p not in self.players:
+        if p not in self.seat_of:
             return  # alredy "removed" because not in
         elif self.game_state == GameStates.ACCEPT_PLAYERS:
             self.players.remove(p)
-            self.votes.pop()
-            self.num_players -= 1
-        elif p in self.dead_players:  # TODO probably unnecessary
-            index = self.players.index(p)
-            self.players.pop(index)
-            self.votes.pop(index)
+            self.reseat()
             self.num_players -= 1
-            self.num_dead_players -= 1
+        elif self.is_dead(p):
+            pass
         else:
             self.global_message("Player {} left, so this game is self-destructing".format(p))
             self.set_game_state(GameStates.GAME_OVER)
             return
+        self.touch()
         leave_message = "Player {} has left".format(p)
         # If we're staging a new game, show updated staging info
         if self.game_state == GameStates.ACCEPT_PLAYERS:
@@ -510,10 +1174,12 @@ class Game(object):
         Assumes state is CHANCY_NOMINATION and target in self.players.
         Select player `target` for chancellor.
         """
-        if target in self.termlimited_players or target in self.dead_players or target == self.president:
+        if self.is_termlimited(target) or self.is_dead(target) or target == self.president:
             return False
         else:
+            self.timings.act(self.seat_of[self.president], self.now())
             self.chancellor = target
+            self.touch()
 
             self.global_message("President {} has nominated Chancellor {}.".format(self.president, self.chancellor))
             self.set_game_state(GameStates.ELECTION)
@@ -525,24 +1191,36 @@ class Game(object):
     def cast_vote(self, player, vote):
         """
         Assumes current state is ELECTION.
-        Casts a vote for a player.
-        """
-        self.players[self.players.index(player)] = vote
+        Casts (or changes) a player's vote.
+        """
+        seat = self.seat_of[player]
+        previous = self.votes[seat]
+        if previous is True:
+            self.ja_votes -= 1
+        elif previous is False:
+            self.nein_votes -= 1
+        self.votes[seat] = vote
+        if vote:
+            self.ja_votes += 1
+        else:
+            self.nein_votes += 1
+        self.voted_seats |= 1 << seat
+        self.touch()
 
     def list_nonvoters(self):
         """
         Assumes current state is ELECTION.
         List (and tags) all players who have not voted, separated by newlines.
         """
-        return "\n".join([self.players[i].get_markdown_tag() for i in range(self.num_players) if
-                          self.votes[i] is None and self.players[i] not in self.dead_players])
+        pending = ~(self.voted_seats | self.dead_seats)
+        return "\n".join([self.players[i].get_markdown_tag() for i in range(self.num_players) if pending >> i & 1])
 
     def election_is_done(self):
         """
         Assumes current state is ELECTION.
         Determine whether an election is done (all alive players have voted)
         """
-        return self.votes.count(None) == self.num_dead_players
+        return self.ja_votes + self.nein_votes == self.num_alive_players
 
     def election_call(self):
         """
@@ -552,9 +1230,9 @@ class Game(object):
          - False if failed
          - None if result cannot yet be determined
         """
-        if self.votes.count(True) > self.num_alive_players/2:
+        if self.ja_votes > self.num_alive_players/2:
             return True
-        elif self.votes.count(False) >= self.num_alive_players/2:
+        elif self.nein_votes >= self.num_alive_players/2:
             return False
         else:
             return None
@@ -564,9 +1242,9 @@ class Game(object):
         Assumes current state is ELECTION.
         Get election results in user-friendy format (list of "player - vote" strings, separated by newlines)
         """
-        return "\n".join(
+        return self.cached("election_results", lambda: "\n".join(
             ["{} - {}".format(self.players[i], "ja" if self.votes[i] else "nein") for i in range(self.num_players) if
-             self.players[i] not in self.dead_players])
+             not self.dead_seats >> i & 1]))
 
     def update_termlimits(self):
         """
@@ -575,10 +1253,10 @@ class Game(object):
 
         Assumes neither self.president nor self.chancellor is None
         """
-        self.termlimited_players.clear()
-        self.termlimited_players.add(self.chancellor)
-        if self.num_players - len(self.dead_players) > 5:
-            self.termlimited_players.add(self.president)
+        self.termlimited_seats = 1 << self.seat_of[self.chancellor]
+        if self.num_alive_players > 5:
+            self.termlimited_seats |= 1 << self.seat_of[self.president]
+        self.touch()
 
     def end_election(self):
         """
@@ -596,12 +1274,13 @@ class Game(object):
         """
         # assert self.election_is_done()
         election_result = self.election_call()
+        self.elections.append(Election(self.president, self.chancellor, list(self.votes), bool(election_result)))
 
         self.global_message("JA!" if election_result else "NEIN!")
         self.global_message(self.election_results())
 
         self.record_log("{}".format("JA!" if election_result else "NEIN!"), known_to=self.players)
-        if self.votes.count(False) > 0:
+        if self.nein_votes > 0:
             self.record_log("Against: {}".format(", ".join([player.name for player, vote in zip(self.players, self.votes) if vote == False])), known_to=self.players)
 
         if election_result:
@@ -609,24 +1288,27 @@ class Game(object):
                 if self.chancellor.role == "Chavez":
                     self.end_game("chavista", "Chavez was elected chancellor")
                 else:
-                    self.confirmed_not_Chavezs.add(self.chancellor)
+                    self.cnh_seats |= 1 << self.seat_of[self.chancellor]
+                    self.touch()
 
             self.set_game_state(GameStates.LEG_PRES)
 
             self.update_termlimits()
             self.anarchy_progress = 0
+            self.touch()
         else:
-            # Finish the election state properly and assume that legislating took 0 seconds
-            self.time_logs[-1][GameStates.LEG_PRES] = {self.spectator: 0 + time.time(), self.group: 0 + time.time()}
-            self.time_logs[-1][GameStates.CHANCY_NOMINATION][self.group] = 0 + time.time()
+            self.timings.skip_legislation(self.now())
 
             self.anarchy_progress += 1
+            self.touch()
             if self.anarchy_progress == 3:
                 self.anarchy()
 
             self.advance_presidency()
 
         self.votes = [None]*self.num_players
+        self.ja_votes = self.nein_votes = self.voted_seats = 0
+        self.touch()
 
     def president_legislate(self, discard):
         """
@@ -637,7 +1319,8 @@ class Game(object):
         if discard in self.deck[:3]:
             self.deck.remove(discard)
             self.discard.append(discard)
-            self.time_logs[-1][self.game_state][self.president] = 0 + time.time()
+            self.touch()
+            self.timings.act(self.seat_of[self.president], self.now())
             self.set_game_state(GameStates.LEG_CHANCY)
             return True
         else:
@@ -650,9 +1333,10 @@ class Game(object):
         and False if input was invalid.
         """
         if enact in self.deck[:2]:
-            self.time_logs[-1][self.game_state][self.chancellor] = 0 + time.time()
+            self.timings.act(self.seat_of[self.chancellor], self.now())
             self.deck.remove(enact)
             self.discard.append(self.deck.pop(0))
+            self.touch()
 
             if self.chavista == 5:
                 self.vetoable_polcy = enact
@@ -672,7 +1356,8 @@ class Game(object):
             self.deck.extend(self.discard)
             del self.discard[:]
 
-            random.shuffle(self.deck)
+            self.rng.shuffle(self.deck)
+            self.touch()
 
             self.global_message("Deck has been reshuffled.")
             self.record_log(self.show(["-"]), known_to=self.players)
@@ -703,12 +1388,15 @@ class Game(object):
         elif self.president_veto_vote and self.chancellor_veto_vote:  # veto
             self.global_message("VETO!")
             self.record_log(" - Veto!", known_to=self.players)
+            self.end_legislation(veto=True)
 
             self.discard.append(self.vetoable_polcy)
+            self.touch()
             self.check_reshuffle()
             self.vetoable_polcy = None
 
             self.anarchy_progress = 1
+            self.touch()
             self.advance_presidency()
             # counter must be at 0 because an election must have just succeeded
 
@@ -720,6 +1408,7 @@ class Game(object):
         advances the presidency
         """
         self.record_log("{} Enacted: {}".format("💠" if policy == "L" else "💢", "mudista" if policy == "L" else "chavista"), known_to=self.players)
+        self.end_legislation(result=policy)
 
         if policy == "L":
             self.pass_mudista()
@@ -729,14 +1418,14 @@ class Game(object):
         self.check_reshuffle()
         if not on_anarchy and self.game_state == GameStates.LEG_CHANCY:  # don't need to wait for other decisison
             self.advance_presidency()
-
-        self.global_message(self.show())
+        # (the tracks are on the status board, see update_board)
 
     def pass_mudista(self):
         """
         Pass a mudista policy, announce this fact, and check if this creates a mudista victory
         """
         self.mudista += 1
+        self.touch()
         self.global_message("A mudista policy was passed!")
 
         if self.mudista == 5:
@@ -748,6 +1437,7 @@ class Game(object):
         If not on anarcy, initiates appropriate executive powers depending on policy number and player count
         """
         self.chavista += 1
+        self.touch()
         if self.chavista == 3:
             self.global_message("A chavista policy was passed! Welcome to the ChavezZone™!")
         else:
@@ -768,7 +1458,7 @@ class Game(object):
                 self.check_reshuffle()
                 self.global_message("President {} is examining top 3 policies".format(self.president))
                 self.record_log("🔮 President {} is examining top 3 policies".format(self.president), [player for player in self.players if player != self.president] + [self.group])
-                self.president.send_message("Top three policies are: ")
+                self.president.send_message("Top three policies are: ", critical=True)
                 self.deck_peek(self.president, 3, True)
             elif self.num_players in (7, 8, 9, 10):
                 self.set_game_state(GameStates.SPECIAL_ELECTION)
@@ -780,10 +1470,10 @@ class Game(object):
         Presidential-succession helper function: determines the next (alive)
         player in the normal rotation after a given player.
         """
-        target_index = self.players.index(starting_after)
-        while self.players[target_index] == starting_after or self.players[target_index] in self.dead_players:
-            target_index += 1
-            target_index %= self.num_players
+        start = self.seat_of[starting_after]
+        target_index = (start + 1) % self.num_players
+        while self.dead_seats >> target_index & 1 and target_index != start:
+            target_index = (target_index + 1) % self.num_players
         return self.players[target_index]
 
     def advance_presidency(self):
@@ -798,6 +1488,7 @@ class Game(object):
             self.last_nonspecial_president = None  # indicate that special-election is over
 
         self.chancellor = None  # new president must now nominate chancellor
+        self.touch()
         self.set_game_state(GameStates.CHANCY_NOMINATION)
 
     def investigate(self, origin, target):
@@ -806,7 +1497,7 @@ class Game(object):
          - Announces who is investigating whom
          - Sends player their target's party affiliation
         """
-        origin.send_message("{0} is a {0.party}.".format(target))
+        origin.send_message("{0} is a {0.party}.".format(target), critical=True)
         self.global_message("{} has investigated {}".format(origin, target))
         self.record_log("🔎 {} investigated {}".format(origin, target), known_to=self.players)
         self.record_log("{} knows that {} is a {}.".format(origin, target, target.party), known_to=[origin, target])
@@ -817,7 +1508,7 @@ class Game(object):
         """
         policies = "".join(self.deck[:num])
 
-        who.send_message(policies)
+        who.send_message(policies, critical=True)
 
         spectator_who = {self.president: "President {}", self.chancellor: "Chancellor {}"}.get(who, "{}")
         spectator_who = spectator_who.format(who)
@@ -839,6 +1530,7 @@ class Game(object):
 
         self.last_nonspecial_president = self.president
         self.president = target
+        self.touch()
 
         return True
 
@@ -853,10 +1545,10 @@ class Game(object):
         if target.role == "Chavez":
             self.end_game("mudista", "Chavez murio de cancer")
         else:
-            self.dead_players.add(target)
+            self.dead_seats |= 1 << self.seat_of[target]
             self.num_alive_players -= 1
             self.num_dead_players += 1
-            self.update_termlimits()
+            self.update_termlimits()  # also marks the game as changed
 
     def anarchy(self):
         """
@@ -870,8 +1562,9 @@ class Game(object):
         self.pass_policy(self.deck.pop(0), on_anarchy=True)
         self.check_reshuffle()
 
-        self.termlimited_players.clear()
+        self.termlimited_seats = 0
         self.anarchy_progress = 0
+        self.touch()
 
     def end_game(self, winning_party, reason):
         """
@@ -880,6 +1573,7 @@ class Game(object):
         """
         self.global_message("The {} team wins! ({}.)".format(winning_party, reason))
         if winning_party in ("mudista", "chavista"):
+          self.winner = winning_party
           self.record_log("{} The {} team wins!".format("🕊" if winning_party=="mudista" else "☠",winning_party), self.players)
         self.set_game_state(GameStates.GAME_OVER)
         raise GameOverException("The {} team wins! ({}.)".format(winning_party, reason))
@@ -897,87 +1591,78 @@ class Game(object):
             return  # don't repeat state change unless specifically requested
 
         self.game_state = new_state
+        self.serial = (self.serial + 1) & 0xFFFF
+        self.touch()
         self.reset_blame_ratelimit()
 
-        if new_state == GameStates.CHANCY_NOMINATION:
-            self.time_logs.append({})
-            if len(self.time_logs) > 1:
-                self.time_logs[-2][new_state][self.group] = 0 + time.time()  # store time at which the previous term ended
-        self.time_logs[-1][new_state] = {self.spectator: 0 + time.time()}  # store time at which the state was entered
+        dwell = self.timings.enter(new_state, self.now())
+        if dwell is not None and not is_silenced():  # replayed games were timed already
+            dwell_times.add(*dwell)
 
         if self.game_state == GameStates.CHANCY_NOMINATION:
             self.global_message("President {} must nominate a chancellor".format(self.president))
-            self.president.send_message("Pick your chancellor!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(candidate.name, callback_data="/nominate {}".format(candidate.name))]
-                    for candidate in self.players if
-                    candidate not in self.termlimited_players and
-                    candidate not in self.dead_players and
-                    candidate != self.president
-                ]
-            ))
+            self.president.send_message("Pick your chancellor!", reply_markup=self.players_keyboard(
+                "nominate", ~(self.termlimited_seats | self.dead_seats | 1 << self.seat_of[self.president])))
         elif self.game_state == GameStates.ELECTION:
             self.global_message(
                 "Election: Vote on President {} and Chancellor {}".format(self.president, self.chancellor))
-            for p in self.players:  # send individual messages to clarify who you're voting on
-                if p not in self.dead_players:
+            for p in self.alive_players():  # send individual messages to clarify who you're voting on
                     p.send_message("Vote for President {} and Chancellor {}:".format(self.president, self.chancellor),
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Ja", callback_data="/ja"), InlineKeyboardButton("Nein", callback_data="/nein")]]))
+                        reply_markup=self.vote_keyboard())
         elif self.game_state == GameStates.LEG_PRES:
             self.global_message("Legislative session in progress (waiting on President {})".format(self.president))
-            self.deck_peek(self.president, 3)
+            self.start_legislation()
             self.president.send_message("Pick a policy to discard!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(policy, callback_data="/discard {}".format(policy)) for policy in self.deck[:3]]]))
+                                        reply_markup=self.policies_keyboard("discard", self.deck[:3]))
         elif self.game_state == GameStates.LEG_CHANCY:
             self.global_message("Legislative session in progress (waiting on Chancellor {})".format(self.chancellor))
-            self.deck_peek(self.chancellor, 2)
+            self.pass_to_chancellor()
             self.chancellor.send_message("Pick a policy to enact!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(policy, callback_data="/enact {}".format(policy)) for policy in self.deck[:2]]]))
+                                         reply_markup=self.policies_keyboard("enact", self.deck[:2]))
         elif self.game_state == GameStates.VETO_CHOICE:
             self.global_message(
                 "President {} and Chancellor {} are deciding whether to veto (both must agree to do so)".format(
                     self.president, self.chancellor))
-            self.president.send_message("Would you like to veto?",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Ja", callback_data="/ja"), InlineKeyboardButton("Nein", callback_data="/nein")]]))
-            self.chancellor.send_message("Would you like to veto?",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Ja", callback_data="/ja"), InlineKeyboardButton("Nein", callback_data="/nein")]]))
+            self.president.send_message("Would you like to veto?", reply_markup=self.vote_keyboard())
+            self.chancellor.send_message("Would you like to veto?", reply_markup=self.vote_keyboard())
             self.president_veto_vote = None
             self.chancellor_veto_vote = None
         elif self.game_state == GameStates.INVESTIGATION:
             self.global_message("President {} must investigate another player".format(self.president))
             self.president.send_message("Pick a player to investigate!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(candidate.name, callback_data="/investigate {}".format(candidate.name))]
-                    for candidate in self.players if candidate not in self.dead_players]))
+                                        reply_markup=self.players_keyboard("investigate", ~self.dead_seats))
         elif self.game_state == GameStates.SPECIAL_ELECTION:
             self.global_message(
                 "Special Election: President {} must choose the next presidential candidate".format(self.president))
             self.president.send_message(
-                "Pick the next presidential candidate!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(candidate.name, callback_data="/nominate {}".format(candidate.name))]
-                    for candidate in self.players if candidate not in self.dead_players and candidate != self.president]))
+                "Pick the next presidential candidate!", reply_markup=self.players_keyboard(
+                    "nominate", ~(self.dead_seats | 1 << self.seat_of[self.president])))
         elif self.game_state == GameStates.EXECUTION:
             self.global_message("El Presidente {} debe inseminar el cancer artificialmente a alguien".format(self.president))
             self.president.send_message(
                 "Selecciona a alguien para inseminarle cancer!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(candidate.name, callback_data="/kill {}".format(candidate.name))]
-                    for candidate in self.players if candidate not in self.dead_players]))
+                reply_markup=self.players_keyboard("kill", ~self.dead_seats))
         elif self.game_state == GameStates.GAME_OVER:
             # self.global_message("\n".join(["{} - {}".format(p, p.role) for p in self.players]))
             # reveal all player roles when the game has ended
 
             # reveal EVERYTHING THAT HAPPENED when game ends
             self.global_message(self.show_logs(include_knowledge_of=self.players))
+            self.finish_command(final=True)  # there's no command to finish after the GameOverException
 
             for p in self.players:
-                p.game = None  # allow players to join other games
+                if p.game is self:  # dead players that left may be in another game by now
+                    p.game = None  # allow players to join other games
             for s in self.spectators:
-                s.game = None  # allow spectators to join again
+                if s.game is self:
+                    s.game = None  # allow spectators to join again
 
     def save(self, fname):
         """
         Save all current game info to a file
         """
 
-        with open(fname, "w") as out_file:
+        with open(fname, "wb") as out_file:
             pickle.dump(self, out_file)
 
     @classmethod
@@ -985,7 +1670,7 @@ class Game(object):
         """
         Load a game from a file (output by save)
         """
-        with open(fname, "r") as in_file:
+        with open(fname, "rb") as in_file:
             return pickle.load(in_file)
 
     def get_blocked_player(self, test_msg="Trying to start game!"):
@@ -1000,7 +1685,7 @@ class Game(object):
         for p in self.players:
             try:
                 p.send_message(test_msg, supress_errors=False)
-            except Unauthorized as e:
+            except Unreachable:
                 return p
         return None
 
@@ -1008,13 +1693,19 @@ class Game(object):
                          "boardstats", "deckstats", "anarchystats", "blame", "ja", "nein",
                          "nominate", "kill", "investigate", "enact", "discard", "whois",
                          "spectate", "unspectate", "logs", "timelogs", "claim")
+    # commands that never change the game
+    READ_ONLY_COMMANDS = ("listplayers", "whois", "boardstats", "deckstats", "anarchystats", "blame", "logs",
+                          "timelogs")
 
-    def handle_message(self, chat_id, from_player, command, args=""):
+    def handle_message(self, chat_id, from_player, command, args="", timestamp=None):
         """
         Handle the message "/command args" from from_player. Using the game state
         and origin, perform the appropriate actions and change state if necessary.
         Returns a string that the bot should send as a reply or None if no reply is necessary.
+        `timestamp` overrides the time of the command (when replaying it).
         """
+        self.command_time = time.time() if timestamp is None else timestamp
+
         # commands valid at any time
         if command == "listplayers":
             return self.list_players()
@@ -1035,6 +1726,7 @@ class Game(object):
                         return error_msg
                     else:
                         from_player.name = new_name
+                        self.touch()
                         return "Successfully changed name to '{}'".format(new_name)
             else:
                 return "Must be in game to change nickname"
@@ -1043,51 +1735,15 @@ class Game(object):
                 args = args.upper()
                 if args not in ["FFF", "FFL", "FLF", "LFF", "FLL", "LFL", "LLF", "LLL", "FF", "FL", "LF", "LL"]:
                     return "Must specify claim like this: `/claim FFL` (read from left to right as: “I discarded F, my chancellor received FL.”) or `claim FL` (read as: “I received FL and discarded F”)."
+                elif self.claim(from_player, args):
+                    return "Your claim was logged."
                 elif len(args) == 3:
-                    # Find the first legislation where from_player was president and didn’t issue a claim
-                    for index, (log_line, known_to) in enumerate(self.logs):
-                        if log_line.startswith("President "+from_player.name+" peeks"):
-                            # If the peek is the very last message, or the next message is not already a (presidential) claim…
-                            if (index == len(self.logs)-1) or ((index < len(self.logs)-1) and ("claims" not in self.logs[index+1][0])):
-                                # …log the claim
-                                self.record_log("President {} claims {} ↦ {}".format(from_player.name, args, args[1:]), known_to=[from_player], position=index+1)
-                                # If there are at least two more messages after the newly-inserted claim, search for the chancellor’s claim
-                                if (len(self.logs) > index + 3) and self.logs[index+3][0].startswith("Chancellor"):
-                                    # Skip the presidential peek, presidential claim, chancellor peek
-                                    # Then find the tailing "XX ↦ X" part and take its first two characters
-                                    chancellor_claim = self.logs[index+3][0][-6:][0:2]
-                                    print("[Discrepancy Check (P)] {}/{} vs {}".format("".join(sorted(args)),"".join(sorted(args[1:])), "".join(sorted(chancellor_claim))))
-                                    # If the chancellor’s claim does not match what the president passed on…
-                                    if "".join(sorted(args[1:])) != "".join(sorted(chancellor_claim)):
-                                        print("[Discrepancy Check (P)] YES")
-                                        self.record_log("💥 Discrepancy!", known_to=[self.spectator], position=index+4)
-                                return "Your claim was logged."
                     return "There is no unclaimed presidency for player {}!".format(from_player.name)
-
-                if len(args) == 2:
-                    # Find the first legislation where from_player was chancellor and didn’t issue a claim
-                    for index, (log_line, known_to) in enumerate(self.logs):
-                        if log_line.startswith("Chancellor "+from_player.name+" peeks"):
-                            # If the peek is the very last message, or the next message is not already a (chancellor) claim…
-                            if (index == len(self.logs)-1) or ((index < len(self.logs)-1) and ("claims" not in self.logs[index+1][0])):
-                                # …log the claim
-                                self.record_log("Chancellor {} claims {} ↦ {}".format(from_player.name, args, args[1:]), known_to=[from_player], position=index+1)
-                                # If the message before the peek was a (presidential) claim…
-                                if "claims" in self.logs[index-1][0]:
-                                    # Find the tailing "XXX ↦ XX" part, and of those, the last two characters
-                                    president_claim = self.logs[index-1][0][-2:]
-                                    print("[Discrepancy Check (C)] {}/{} vs {}".format("".join(sorted(president_claim)),"".join(sorted(president_claim[1:])), "".join(sorted(args))))
-                                    # If the president’s claim does not match what the chancellor received…
-                                    if "".join(sorted(args)) != "".join(sorted(president_claim)):
-                                        print("[Discrepancy Check (C)] YES")
-                                        self.record_log("💥 Discrepancy!", known_to=[self.spectator], position=index+2)
-                                return "Your claim was logged."
-                    return "There is no unclaimed chancellorship for player {}!".format(from_player.name)
                 else:
-                    return "That does not look like a valid claim."
+                    return "There is no unclaimed chancellorship for player {}!".format(from_player.name)
 
         elif command == "spectate":
-            if (from_player in self.players) and (from_player not in self.dead_players):
+            if (from_player in self.seat_of) and not self.is_dead(from_player):
                 return "Error: you cannot spectate a game you're in. Please /leave to spectate."
             elif from_player in self.spectators:
                 return "Error: you are already spectating. /unspectate to stop."
@@ -1150,12 +1806,12 @@ class Game(object):
         elif command == "anarchystats":
             return self.show(["anarchy"])
         elif command == "blame":
-            if time.time() - self.last_blame < BLAME_RATELIMIT:
+            if self.now() - self.last_blame < BLAME_RATELIMIT:
                 from_player.send_message("Hey, slow down!")
                 return
                 # avoid spam by respding with DM (good luck if there's Darbs playing)
 
-            self.last_blame = time.time()
+            self.last_blame = self.now()
             pres_tag = "(president)"
             chancy_tag = "(chancellor)"
             if self.president is not None:
@@ -1179,7 +1835,7 @@ class Game(object):
                 return "{} needs to pick someone to special elect!".format(pres_tag)
             elif self.game_state == GameStates.EXECUTION:
                 return "{} necesita escoger a alguien para inseminarle cancer!".format(pres_tag)
-        elif from_player not in self.players or from_player in self.dead_players:
+        elif from_player not in self.seat_of or self.is_dead(from_player):
             return "Error: Spectators/dead players cannot use commands that modify game data"
             # further commands affect game state
         elif command in ("nominate", "kill", "investigate") and from_player == self.president:
@@ -1191,7 +1847,7 @@ class Game(object):
                 if args.lower().find("me too thanks") != -1:
                     target = from_player
                     target_confirmed = True
-                elif from_player.party == "chavista" and args.lower().find("Chavez") != -1:
+                elif from_player.party == "chavista" and args.lower().find("chavez") != -1:
                     for p in self.players:
                         if p.role == "Chavez":
                             target = p
@@ -1203,13 +1859,12 @@ class Game(object):
             if command == "nominate":
                 if self.game_state == GameStates.CHANCY_NOMINATION:
                     if self.select_chancellor(target):
-                        self.time_logs[-1][self.game_state][from_player] = 0 + time.time()
                         return None  # "You have nominated {} for chancellor.".format(target)
                     else:
                         return "Error: {} is term-limited/dead/yourself.".format(target)
                 elif self.game_state == GameStates.SPECIAL_ELECTION:
                     if self.special_elect(target):
-                        self.time_logs[-1][self.game_state][from_player] = 0 + time.time()
+                        self.timings.act(self.seat_of[from_player], self.now())
                         self.set_game_state(GameStates.CHANCY_NOMINATION)
                         return None  # "You have nominated {} for president.".format(target)
                     else:
@@ -1222,7 +1877,7 @@ class Game(object):
                         "It looks like you are trying to kill Chavez. You WILL LOSE THE GAME if you proceed. Reply /kill `Chavez` to confirm.")
                     return
                 else:
-                    self.time_logs[-1][self.game_state][from_player] = 0 + time.time()
+                    self.timings.act(self.seat_of[from_player], self.now())
                     self.kill(target)
                     self.global_message("{} hizo que {} muriera de cancer inseminado.".format(from_player, target))
                     target.send_message("You are now dead. RIP. Remember "
@@ -1230,15 +1885,14 @@ class Game(object):
                                         + "secret role, or otherwise influence the game!")
                     self.advance_presidency()
             elif command == "investigate" and self.game_state == GameStates.INVESTIGATION:
-                self.time_logs[-1][self.game_state][from_player] = 0 + time.time()
+                self.timings.act(self.seat_of[from_player], self.now())
                 self.investigate(from_player, target)
                 self.advance_presidency()
         elif command in ("ja", "nein"):
             vote = (command == "ja")
             if self.game_state == GameStates.ELECTION:
-                if from_player not in self.time_logs[-1][self.game_state]:  # Only record the first vote per election
-                    self.time_logs[-1][self.game_state][from_player] = 0 + time.time()
-                self.votes[self.players.index(from_player)] = vote
+                self.timings.act(self.seat_of[from_player], self.now())  # only the first vote counts
+                self.cast_vote(from_player, vote)
 
                 if self.election_is_done():
                     self.end_election()
@@ -1247,8 +1901,7 @@ class Game(object):
                 else:
                     return "Nein vote recorded; quickly /ja to switch"
             elif self.game_state == GameStates.VETO_CHOICE and from_player in (self.president, self.chancellor):
-                if from_player not in self.time_logs[-1][self.game_state]:  # Only record the first vote per veto
-                    self.time_logs[-1][self.game_state][from_player] = 0 + time.time()
+                self.timings.act(self.seat_of[from_player], self.now())  # only the first vote counts
                 if from_player == self.president:
                     self.president_veto_vote = vote
                 elif from_player == self.chancellor:
@@ -1281,10 +1934,10 @@ class Game(object):
 
     def TEST_handle(self, player, command, args=""):
         """
-        TESTING FUNCTION: run self.handle_message(player, command, args) but print out
+        TESTING FUNCTION: run self.handle_message(self.global_chat, player, command, args) but print out
         the input and output for debugging
         """
-        response = self.handle_message(player, command, args)
+        response = self.handle_message(self.global_chat, player, command, args)
         print("[{}] {} {}".format(player, command, args))
         if response:
             print("[Reply to {}] {}".format(player, response))
@@ -1294,9 +1947,8 @@ class Game(object):
         TESTING FUNCTION: use TEST_handle to simulate a unanimous "ja" (or unanimous "nein" if should_pass=False)
         This helps keep test-game code concise when you're not explicitly testing elections
         """
-        for p in self.players:
-            if p not in self.dead_players:
-                self.TEST_handle(p, "ja" if should_pass else "nein")
+        for p in self.alive_players():
+            self.TEST_handle(p, "ja" if should_pass else "nein")
 
 
 def test_game():
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+
+class Unreachable(Exception):
+    """
+    Raised by the delivery of a message that the recipient can't get (e.g. they blocked the bot or never
+    started a chat with it).
+    """
+    pass
+
+
+class Transport(object):
+    """
+    What the game engine needs to talk to its players and groups. The bot implements it on top of Telegram (see
+    telegram_transport.py); benchmarks/simulate.py has one that only counts messages.
+
+    Keyboards are tuples of rows, each a tuple of (button text, callback data) pairs, so the engine doesn't
+    depend on any Telegram types and can cache them.
+    """
+
+    def send(self, chat_id, text, supress_errors=True, critical=False, keyboard=None, markdown=False):
+        """
+        Queue a message (with Markdown formatting if `markdown`). Returns a concurrent.futures.Future of its
+        delivery, which fails with Unreachable if the recipient can't be reached (and only if not supress_errors).
+        Critical messages (secret information and everything the recipient has to act on) must reach the
+        recipient eventually, even if they can't be reached right now.
+        """
+        raise NotImplementedError
+
+    def live(self, chat_id, key, text):
+        """
+        Show `text` in the chat's live message `key`, sending it the first time and editing it afterwards
+        """
+        raise NotImplementedError
+
+    def end_live(self, chat_id, key):
+        """
+        Stop updating a live message; the next live() with the same key sends a new one
+        """
+        raise NotImplementedError
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import logging
+import multiprocessing
+import threading
+import zlib
+
+# Commands that the router answers itself (with results gathered from all shards) instead of forwarding them
+ROUTER_COMMANDS = ("listgames", "botstats", "restart")
+GATHER_TIMEOUT = 30  # seconds to wait for every shard's answer
+
+
+def shard_of(chat_id, num_shards):
+    """
+    Returns the index of the shard that owns a chat
+    """
+    return zlib.crc32(str(chat_id).encode("utf-8")) % num_shards
+
+
+def command_of(update):
+    """
+    Returns the command (without "/" and "@botname") of an update's message, or None
+    """
+    text = (update.get("message") or {}).get("text") or ""
+    if not text.startswith("/"):
+        return None
+    return text.split()[0][1:].split("@")[0]
+
+
+class Shard(object):
+    """
+    The worker side of a shard: one process that owns all games of the group chats hashed to it.
+
+    Updates and calls from the router arrive in `inbox`. Everything the shard
+    tells the router (results of calls and which users are in one of its
+    games) goes into the `reports` queue shared by all shards.
+    """
+
+    def __init__(self, index, num_shards, inbox, reports):
+        self.index = index
+        self.num_shards = num_shards
+        self.inbox = inbox
+        self.reports = reports
+        self.bound_users = set()  # users in a game of this shard (as far as the router knows)
+
+    def owns(self, chat_id):
+        return shard_of(chat_id, self.num_shards) == self.index
+
+    def bind(self, user_id):
+        """
+        Route the user's private chat to this shard
+        """
+        if user_id not in self.bound_users:
+            self.bound_users.add(user_id)
+            self.reports.put(("bind", user_id, self.index))
+
+    def unbind(self, user_id):
+        if user_id in self.bound_users:
+            self.bound_users.discard(user_id)
+            self.reports.put(("unbind", user_id, self.index))
+
+    def serve(self, process_update, calls):
+        """
+        Handle everything from the inbox until the router sends None.
+        `calls` maps names to the functions that Router.gather can call.
+        """
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                return
+            if message[0] == "update":
+                try:
+                    process_update(message[1])
+                except Exception:
+                    logging.getLogger(__name__).exception("Shard %s failed to process an update", self.index)
+            elif message[0] == "call":
+                _, call_id, name, args = message
+                try:
+                    result = calls[name](*args)
+                except Exception:
+                    logging.getLogger(__name__).exception("Shard %s failed to run %s", self.index, name)
+                    result = None
+                self.reports.put(("result", call_id, self.index, result))
+
+
+class Router(object):
+    """
+    The front of a sharded deployment.
+
+    Starts `num_shards` worker processes running target(index, num_shards,
+    inbox, reports) and forwards every update to one of them: group chats go
+    to the shard chosen by hashing the chat id, private chats (and button
+    presses in them) to the shard whose game the user is in, as reported by
+    the shards. Users that aren't in any game are hashed by their user id.
+    """
+
+    def __init__(self, num_shards, target):
+        self.num_shards = num_shards
+        self.target = target
+        self.users = {}  # user id -> shard index
+        self._context = multiprocessing.get_context("fork")
+        self.reports = self._context.Queue()
+        self.inboxes = []
+        self.processes = []
+
+        self._lock = threading.Condition()
+        self._calls = itertools.count()
+        self._results = {}  # call id -> {shard index: result}
+
+    def start(self):
+        """
+        Fork the shards. Must be called before the process starts any threads of its own.
+        """
+        for i in range(self.num_shards):
+            inbox = self._context.Queue()
+            process = self._context.Process(target=self.target, args=(i, self.num_shards, inbox, self.reports),
+                                            name="shard-{}".format(i))
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        thread = threading.Thread(target=self._collect, name="shard-reports")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self, timeout=60):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout)
+        self.reports.put(None)
+
+    def is_local(self, update):
+        """
+        Whether the router answers this update itself
+        """
+        return command_of(update) in ROUTER_COMMANDS
+
+    def shard_for(self, update):
+        message = update.get("message") or update.get("edited_message")
+        user = None
+        if message is not None:
+            chat, user = message["chat"], message.get("from")
+        elif "callback_query" in update:
+            chat, user = update["callback_query"]["message"]["chat"], update["callback_query"]["from"]
+        else:
+            return 0
+        if chat["type"] != "private":
+            return shard_of(chat["id"], self.num_shards)
+        user_id = user["id"] if user else chat["id"]
+        with self._lock:
+            shard = self.users.get(user_id)
+        return shard if shard is not None else shard_of(user_id, self.num_shards)
+
+    def route(self, update):
+        """
+        Forward an update (as a dict, like Telegram sends it) to its shard
+        """
+        self.inboxes[self.shard_for(update)].put(("update", update))
+
+    def gather(self, name, *args):
+        """
+        Call calls[name](*args) on every shard. Returns the list of their results (in shard order).
+        """
+        with self._lock:
+            call_id = next(self._calls)
+            self._results[call_id] = {}
+        for inbox in self.inboxes:
+            inbox.put(("call", call_id, name, args))
+        with self._lock:
+            self._lock.wait_for(lambda: len(self._results[call_id]) == self.num_shards, GATHER_TIMEOUT)
+            results = self._results.pop(call_id)
+        if len(results) < self.num_shards:
+            logging.getLogger(__name__).warning("Only %s of %s shards answered %s", len(results), self.num_shards,
+                                                name)
+        return [results[i] for i in sorted(results)]
+
+    def _collect(self):
+        while True:
+            report = self.reports.get()
+            if report is None:
+                return
+            with self._lock:
+                if report[0] == "bind":
+                    self.users[report[1]] = report[2]
+                elif report[0] == "unbind":
+                    if self.users.get(report[1]) == report[2]:
+                        del self.users[report[1]]
+                elif report[0] == "result":
+                    if report[1] in self._results:  # otherwise the call timed out already
+                        self._results[report[1]][report[2]] = report[3]
+                        self._lock.notify_all()
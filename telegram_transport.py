@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import functools
+from concurrent.futures import Future
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram.error import Unauthorized
+
+import message_queue
+import secret_hitler
+
+
+@functools.lru_cache(maxsize=1024)
+def reply_markup(keyboard):
+    """
+    The InlineKeyboardMarkup of an engine keyboard (see secret_hitler.Transport). Games reuse their keyboards,
+    e.g. one for all voters of an election, so this converts each of them once.
+    """
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data) for text, data in row]
+                                 for row in keyboard])
+
+
+def translate_error(delivery, result):
+    error = delivery.exception()
+    if isinstance(error, Unauthorized):
+        result.set_exception(secret_hitler.Unreachable(str(error)))
+    elif error is not None:
+        result.set_exception(error)
+    else:
+        result.set_result(delivery.result())
+
+
+class TelegramTransport(secret_hitler.Transport):
+    """
+    The game engine's transport: game messages go through a message_queue.MessageQueue.
+    """
+
+    def __init__(self, outbound):
+        self.outbound = outbound
+
+    def send(self, chat_id, text, supress_errors=True, critical=False, keyboard=None, markdown=False):
+        """
+        Texts that are too long for a single message (such as the log of a long game) are sent in parts, with the
+        keyboard on the last one. Returns the delivery of the last part.
+        """
+        kwargs = {}
+        if markdown:
+            kwargs["parse_mode"] = ParseMode.MARKDOWN
+        parts = message_queue.split_message(text)
+        for part in parts[:-1]:
+            self.outbound.send(chat_id, part, supress_errors=supress_errors, critical=critical, **kwargs)
+        if keyboard is not None:
+            kwargs["reply_markup"] = reply_markup(keyboard)
+        delivery = self.outbound.send(chat_id, parts[-1] if parts else text, supress_errors=supress_errors,
+                                      critical=critical, **kwargs)
+        if supress_errors:
+            return delivery
+        result = Future()
+        delivery.add_done_callback(functools.partial(translate_error, result=result))
+        return result
+
+    def live(self, chat_id, key, text):
+        self.outbound.live(chat_id, key, text)
+
+    def end_live(self, chat_id, key):
+        self.outbound.end_live(chat_id, key)
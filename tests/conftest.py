@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+import secret_hitler
+import simulate
+
+
+@pytest.fixture
+def transport():
+    """
+    Games of a test send their messages to a NullTransport
+    """
+    null_transport = simulate.NullTransport()
+    secret_hitler.configure(transport=null_transport, bot_username="test_bot")
+    return null_transport
+
+
+def play(game, players, agent, moves, journal=None):
+    """
+    Seat `players` in `game`, start it and make `moves` random moves (fewer if the game ends). Every command
+    goes to `journal` as well, if given, like the bot journals them. Returns whether the game is still running.
+    """
+    def handle(player, command, args=""):
+        try:
+            game.handle_message(game.global_chat, player, command, args)
+        except secret_hitler.GameOverException:
+            if journal is not None:
+                journal.record_command(game, game.global_chat, player, command, args)
+            raise
+        if journal is not None:
+            journal.record_command(game, game.global_chat, player, command, args)
+
+    try:
+        for player in players:
+            handle(player, "joingame")
+        handle(players[0], "startgame")
+        for _ in range(moves):
+            player, pending = simulate.pending_move(game)
+            handle(player, *agent.choose(game, player, pending))
+    except secret_hitler.GameOverException:
+        return False
+    return True
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import random
+import sqlite3
+
+import pytest
+
+import archive
+import secret_hitler
+import simulate
+from conftest import play
+
+
+@pytest.fixture
+def archive_db(tmp_path):
+    db = archive.Archive(str(tmp_path / "archive.sqlite"))
+    db.start()
+    yield db
+    db.stop()
+
+
+def finished_game(seed, num_players, before_each_move=None):
+    game = secret_hitler.Game(-1, seed=seed)
+    players = [secret_hitler.Player(i + 1, "P{}".format(i)) for i in range(num_players)]
+    agent = simulate.RandomAgent(random.Random(seed))
+    assert play(game, players, agent, 0)
+    try:
+        for _ in range(1000):
+            if before_each_move is not None:
+                before_each_move(game)
+            player, moves = simulate.pending_move(game)
+            game.handle_message(-1, player, *agent.choose(game, player, moves))
+    except secret_hitler.GameOverException:
+        return game
+    raise AssertionError("the game didn't end")
+
+
+def rows(db, query):
+    connection = sqlite3.connect(db.fname)
+    try:
+        return connection.execute(query).fetchall()
+    finally:
+        connection.close()
+
+
+def test_archived_games_update_the_aggregates(transport, archive_db):
+    games = [finished_game(seed, 5 + seed % 6) for seed in range(6)]
+    for game in games:
+        archive_db.archive(game)
+    archive_db.stop()
+
+    assert rows(archive_db, "SELECT COUNT(*) FROM games") == [(len(games),)]
+    stats = archive_db.group_stats(-1)
+    assert stats["games"] == len(games)
+    assert stats["mudista_wins"] == sum(game.winner == "mudista" for game in games)
+    assert stats["players"] == sum(game.num_players for game in games)
+
+    player = archive_db.player_stats(1)
+    assert player["games"] == len(games)
+    assert player["mudista_games"] + player["chavista_games"] + player["chavez_games"] == len(games)
+    assert player["wins"] == sum(role.replace("Chavez", "chavista") == game.winner
+                                 for game in games for user_id, _, role in game.roster if user_id == 1)
+    votes = sum(vote is not None for game in games for election in game.elections
+                for seat, vote in enumerate(election.votes) if game.players[seat].id == 1)
+    assert player["ja"] + player["nein"] == votes
+    assert archive_db.player_stats(999) is None
+
+
+def test_a_dead_player_who_left_is_archived_with_their_role(transport, archive_db):
+    left = []
+
+    def leave_when_dead(game):
+        if not left and game.dead_seats:
+            player = next(player for player in game.players if game.is_dead(player))
+            role = player.role
+            player.leave_game(confirmed=True)
+            secret_hitler.Game(-2).handle_message(-2, player, "joingame", "")
+            left.append((player.id, role))
+
+    for seed in range(20):
+        game = finished_game(seed, 7 + seed % 4, leave_when_dead)
+        if left:
+            break
+    assert left, "nobody died"
+    archive_db.archive(game)
+    archive_db.stop()
+    assert rows(archive_db, "SELECT user_id, role FROM seats WHERE user_id = {}".format(left[0][0])) == left
+
+
+def test_a_bad_record_does_not_stop_the_writer(transport, archive_db):
+    game = finished_game(1, 5)
+    record = archive.game_record(game)
+    record["seats"][0] = record["seats"][0][:3] + ("spy",) + record["seats"][0][4:]
+    archive_db._pending.put(record)
+    archive_db.archive(game)
+    archive_db.stop()
+    assert rows(archive_db, "SELECT COUNT(*) FROM games") == [(1,)]
+    assert rows(archive_db, "SELECT COUNT(*) FROM seats") == [(5,)]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+
+import secret_hitler
+import simulate
+from conftest import play
+
+
+def test_callback_data_round_trips():
+    data = secret_hitler.encode_callback(0x1234567890, 70000, "kill", 9)
+    assert len(data) <= 64  # Telegram's limit for callback data
+    assert secret_hitler.decode_callback(data) == (0x34567890, 70000 & 0xFFFF, "kill", 9)
+
+
+@pytest.mark.parametrize("data", ["", "not base64!", "AAAA", "/ja", "ünïcode",
+                                  secret_hitler.encode_callback(1, 1, "ja")[:-2]])
+def test_foreign_callback_data_is_rejected(data):
+    with pytest.raises(ValueError):
+        secret_hitler.decode_callback(data)
+
+
+@pytest.fixture
+def game(transport):
+    game = secret_hitler.Game(-1, seed=5)
+    players = [secret_hitler.Player(i + 1, "P{}".format(i)) for i in range(7)]
+    assert play(game, players, simulate.RandomAgent(random.Random(5)), 0)
+    return game
+
+
+def pressed(game, keyboard, text):
+    """
+    The command and arguments of the button `text` of a keyboard, as the bot's button handler gets them
+    """
+    data = next(data for row in keyboard for label, data in row if label == text)
+    game_id, serial, command, arg = secret_hitler.decode_callback(data)
+    assert game_id == game.seed & 0xFFFFFFFF
+    return command, game.button_command(serial, command, arg)
+
+
+def test_buttons_carry_seats_and_policies(game):
+    keyboard = game.players_keyboard("nominate", 0b110)
+    assert [[label for label, _ in row] for row in keyboard] == [[game.players[1].name], [game.players[2].name]]
+    assert pressed(game, keyboard, game.players[2].name) == ("nominate", "3")
+    assert pressed(game, game.policies_keyboard("discard", "FL"), "L") == ("discard", "L")
+    assert pressed(game, game.vote_keyboard(), "Nein") == ("nein", "")
+
+
+def test_buttons_of_earlier_states_expire(game):
+    nominee = game.players[1]  # the first president is in seat 0
+    keyboard = game.players_keyboard("nominate", 1 << 1)
+    game.handle_message(-1, game.president, "nominate", nominee.name)
+    assert game.game_state == secret_hitler.GameStates.ELECTION
+    assert pressed(game, keyboard, nominee.name) == ("nominate", None)
+
+
+def test_keyboards_are_built_once_per_state(game):
+    keyboard = game.vote_keyboard()
+    game.touch()  # e.g. a vote was cast
+    assert game.vote_keyboard() is keyboard
+    game.set_game_state(secret_hitler.GameStates.ELECTION)
+    assert game.vote_keyboard() != keyboard
+
+
+def test_buttons_for_seats_beyond_the_table_are_rejected(game):
+    data = secret_hitler.encode_callback(game.seed, game.serial, "kill", game.num_players)
+    _, serial, command, arg = secret_hitler.decode_callback(data)
+    assert game.button_command(serial, command, arg) is None
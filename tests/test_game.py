@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+
+import secret_hitler
+import simulate
+from conftest import play
+
+
+@pytest.fixture
+def game(transport):
+    game = secret_hitler.Game(-1, seed=7)
+    players = [secret_hitler.Player(i + 1, "P{}".format(i)) for i in range(7)]
+    assert play(game, players, simulate.RandomAgent(random.Random(7)), 0)
+    return game
+
+
+def test_a_chavista_president_has_to_confirm_killing_chavez(game):
+    chavista = next(player for player in game.players if player.role == "chavista")
+    chavez = next(player for player in game.players if player.role == "Chavez")
+    game.president = chavista
+    game.set_game_state(secret_hitler.GameStates.EXECUTION)
+
+    assert game.handle_message(-1, chavista, "kill", chavez.name) is None  # asks for confirmation
+    assert not game.is_dead(chavez)
+    with pytest.raises(secret_hitler.GameOverException):
+        game.handle_message(-1, chavista, "kill", "Chavez")
+    assert game.winner == "mudista"
+
+
+def test_reading_the_logs_changes_nothing(game):
+    bits = dict(game.log.bits)
+    player, outsider = game.players[0], secret_hitler.Player(99, "outsider")
+    assert "{} is {}".format(player, player.role) in game.show_logs([player])
+    assert "{} is {}".format(player, player.role) not in game.show_logs([outsider])
+    assert game.log.bits == bits
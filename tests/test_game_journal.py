@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import threading
+
+import pytest
+
+import game_journal
+import secret_hitler
+import simulate
+from conftest import play
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(game_journal, "SNAPSHOT_EVERY", 7)  # so that resuming uses snapshots and journals
+    journal = game_journal.Journal(str(tmp_path / "journal"), str(tmp_path / "history"))
+    journal.start()
+    yield journal
+    journal.stop()
+
+
+def resume(journal):
+    journal.stop()
+    return {game.global_chat: game for game in
+            game_journal.Journal(journal.directory, journal.history_directory).resume()}
+
+
+def new_game(journal, chat_id, seed, num_players):
+    game = secret_hitler.Game(chat_id, seed=seed)
+    journal.open(game)
+    players = [secret_hitler.Player(chat_id * -100 + i, "P{}".format(i)) for i in range(num_players)]
+    return game, players
+
+
+def test_resumed_games_match_the_running_ones(transport, journal):
+    running = {}
+    for seed in range(8):
+        game, players = new_game(journal, -1 - seed, seed, 5 + seed % 6)
+        if play(game, players, simulate.RandomAgent(random.Random(seed)), 10 + seed * 3, journal):
+            running[game.global_chat] = game
+    assert running
+
+    resumed = resume(journal)
+    assert sorted(resumed) == sorted(running)
+    for chat_id, game in running.items():
+        assert resumed[chat_id].game_state == game.game_state
+        assert resumed[chat_id].show() == game.show()
+        assert resumed[chat_id].list_players() == game.list_players()
+        assert resumed[chat_id].deck == game.deck
+
+
+def test_games_that_ended_before_the_restart_are_handed_over(transport, journal):
+    game, players = new_game(journal, -1, 3, 5)
+    assert not play(game, players, simulate.RandomAgent(random.Random(3)), 1000, journal)
+    assert game.winner is not None
+
+    journal.stop()
+    ended = []
+    resumed = game_journal.Journal(journal.directory, journal.history_directory).resume(on_game_over=ended.append)
+    assert resumed == []
+    assert [(ended_game.global_chat, ended_game.winner) for ended_game in ended] == [(-1, game.winner)]
+    assert os.listdir(journal.directory) == []
+
+
+def test_leaving_is_journaled(transport, journal):
+    game, players = new_game(journal, -1, 1, 6)
+    for player in players:
+        game.handle_message(-1, player, "joingame", "")
+        journal.record_command(game, -1, player, "joingame", "")
+    players[2].leave_game(confirmed=True)
+    journal.record_leave(game, players[2])
+
+    resumed = resume(journal)[-1]
+    assert resumed.num_players == 5
+    assert [player.id for player in resumed.players] == [player.id for player in game.players]
+
+
+def test_a_command_that_fails_part_way_is_snapshotted(transport, journal):
+    game, players = new_game(journal, -1, 2, 6)
+    agent = simulate.RandomAgent(random.Random(2))
+    assert play(game, players, agent, 8, journal)
+
+    player, moves = simulate.pending_move(game)
+    game.anarchy_progress += 1  # what the command changed before it raised
+    journal.record_failed_command(game, -1, player, *agent.choose(game, player, moves))
+    for _ in range(3):
+        player, moves = simulate.pending_move(game)
+        command, args = agent.choose(game, player, moves)
+        game.handle_message(-1, player, command, args)
+        journal.record_command(game, -1, player, command, args)
+
+    resumed = resume(journal)[-1]
+    assert resumed.anarchy_progress == game.anarchy_progress
+    assert resumed.game_state == game.game_state
+    assert resumed.show() == game.show()
+
+
+def test_a_slow_fsync_does_not_hold_up_the_games(transport, journal, monkeypatch):
+    agent = simulate.RandomAgent(random.Random(3))
+    games = []
+    for i in range(2):
+        game, players = new_game(journal, -1 - i, i, 5)
+        assert play(game, players, agent, 0, journal)
+        games.append(game)
+    syncer = threading.Thread(target=journal.sync)
+    fsyncing, release = threading.Event(), threading.Event()
+    fsync = os.fsync
+
+    def slow_fsync(fd):
+        if threading.current_thread() is syncer:
+            fsyncing.set()
+            release.wait(5)
+        fsync(fd)
+
+    monkeypatch.setattr(game_journal.os, "fsync", slow_fsync)
+    syncer.start()
+    try:
+        assert fsyncing.wait(5)
+        for game in games:  # including the game being fsync'd
+            for _ in range(3):
+                player, moves = simulate.pending_move(game)
+                command, args = agent.choose(game, player, moves)
+                game.handle_message(game.global_chat, player, command, args)
+                journal.record_command(game, game.global_chat, player, command, args)
+            journal.compact([game])
+        assert syncer.is_alive()  # nothing above waited for it
+    finally:
+        release.set()
+        syncer.join(5)
+
+
+def test_games_pickled_before_the_game_log_are_refused():
+    game = secret_hitler.Game.__new__(secret_hitler.Game)
+    with pytest.raises(ValueError):
+        game.__setstate__({"players": [], "logs": []})
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+from telegram.error import NetworkError, Unauthorized
+
+import message_queue
+from message_queue import FailedDeliveries, MessageQueue, TokenBucket, message_length, split_message
+
+
+class Sent(object):
+    def __init__(self, message_id, kwargs):
+        self.message_id = message_id
+        self.kwargs = kwargs
+
+
+class FakeBot(object):
+    """
+    Records the Bot API calls made through it. `errors` maps a chat id to a list of exceptions to raise for its
+    next calls, and `delays` maps a method to the number of seconds its calls take.
+    """
+
+    def __init__(self):
+        self.calls = []  # (method, kwargs)
+        self.errors = {}
+        self.delays = {}
+        self._lock = threading.Lock()
+
+    def _call(self, method, kwargs):
+        time.sleep(self.delays.get(method, 0))
+        with self._lock:
+            errors = self.errors.get(kwargs["chat_id"])
+            if errors:
+                raise errors.pop(0)
+            self.calls.append((method, kwargs))
+            return Sent(len(self.calls), kwargs)
+
+    def send_message(self, **kwargs):
+        return self._call("send_message", kwargs)
+
+    def edit_message_text(self, **kwargs):
+        return self._call("edit_message_text", kwargs)
+
+    def texts(self, chat_id):
+        return [kwargs["text"] for method, kwargs in self.calls if kwargs["chat_id"] == chat_id]
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+@pytest.fixture
+def outbound(bot):
+    queue = MessageQueue(bot)
+    queue.start()
+    yield queue
+    queue.stop(timeout=5)
+
+
+def test_messages_to_a_chat_keep_their_order(bot, outbound):
+    for i in range(3):
+        outbound.send(1, "one {}".format(i))
+        outbound.send(2, "two {}".format(i))
+    assert outbound.flush(timeout=5)
+    assert bot.texts(1) == ["one 0", "one 1", "one 2"]
+    assert bot.texts(2) == ["two 0", "two 1", "two 2"]
+
+
+def test_turn_merges_messages_per_chat(bot, outbound):
+    with outbound.turn():
+        first = outbound.send(1, "a")
+        outbound.send(2, "b")
+        last = outbound.send(1, "c")
+        assert not first.done()
+    assert first.result(timeout=5) is last.result(timeout=5)
+    assert outbound.flush(timeout=5)
+    assert bot.texts(1) == ["a" + message_queue.MESSAGE_SEPARATOR + "c"]
+    assert bot.texts(2) == ["b"]
+
+
+def test_turn_keeps_keyboards_at_the_bottom(bot, outbound):
+    with outbound.turn():
+        outbound.send(1, "vote", reply_markup="keyboard")
+        outbound.send(1, "after")
+        outbound.send(2, "before")
+        outbound.send(2, "vote", reply_markup="keyboard")
+    assert outbound.flush(timeout=5)
+    assert [(kwargs["text"], kwargs.get("reply_markup")) for _, kwargs in bot.calls if kwargs["chat_id"] == 1] \
+        == [("vote", "keyboard"), ("after", None)]
+    assert [(kwargs["text"], kwargs.get("reply_markup")) for _, kwargs in bot.calls if kwargs["chat_id"] == 2] \
+        == [("before" + message_queue.MESSAGE_SEPARATOR + "vote", "keyboard")]
+
+
+def test_turn_only_merges_messages_with_the_same_options(bot, outbound):
+    with outbound.turn():
+        outbound.send(1, "plain")
+        outbound.send(1, "*bold*", parse_mode="Markdown")
+    assert outbound.flush(timeout=5)
+    assert bot.texts(1) == ["plain", "*bold*"]
+
+
+def test_turn_merges_within_the_utf16_length_limit(bot, outbound):
+    text = "🕊" * 1500  # 3000 UTF-16 code units
+    with outbound.turn():
+        for _ in range(2):
+            outbound.send(1, text)
+    assert outbound.flush(timeout=5)
+    assert bot.texts(1) == [text, text]
+
+
+def test_waiting_for_a_message_sends_the_turn_first(bot, outbound):
+    with outbound.turn():
+        outbound.send(1, "held back")
+        outbound.send(1, "waited for", supress_errors=False).result(timeout=5)
+    assert bot.texts(1) == ["held back", "waited for"]
+
+
+def test_network_errors_are_retried(bot, outbound, monkeypatch):
+    monkeypatch.setattr(message_queue, "BACKOFF", 0.01)
+    bot.errors[1] = [NetworkError("timed out")]
+    assert outbound.send(1, "eventually").result(timeout=5).kwargs["text"] == "eventually"
+
+
+def test_live_updates_are_debounced(bot, outbound, monkeypatch):
+    monkeypatch.setattr(message_queue, "LIVE_DEBOUNCE", 0.05)
+    outbound.live(1, "board", "first")
+    assert outbound.flush(timeout=5)
+    for text in ("second", "third", "fourth"):
+        outbound.live(1, "board", text)
+    assert outbound.flush(timeout=5)
+    assert [(method, kwargs["text"]) for method, kwargs in bot.calls] \
+        == [("send_message", "first"), ("edit_message_text", "fourth")]
+
+
+def test_a_chat_keeps_its_bucket_while_its_live_message_is_in_flight(bot, monkeypatch):
+    monkeypatch.setattr(message_queue, "CHAT_RATE", 1000.0)  # the bucket is full again when the edit is done
+    bot.delays.update(send_message=0.4, edit_message_text=0.1)
+    outbound = MessageQueue(bot, workers=2)
+    outbound.start()
+    try:
+        outbound.live(1, "board", "board")
+        outbound.submit("edit_message_text", 1, {"chat_id": 1, "message_id": 1, "text": "edited"})
+        assert outbound.flush(timeout=5)
+        bot.delays.clear()
+        outbound.send(1, "after")
+        assert outbound.flush(timeout=5)
+        assert all(thread.is_alive() for thread in outbound._threads)
+        assert bot.texts(1) == ["edited", "board", "after"]
+    finally:
+        outbound.stop(timeout=5)
+
+
+def test_split_message_counts_utf16_code_units():
+    assert split_message("") == []
+    assert split_message("abc", 2) == ["ab", "c"]
+    parts = split_message("a" + "🕊" * 3, 4)
+    assert parts == ["a🕊", "🕊🕊"]
+    assert [message_length(part) for part in parts] == [3, 4]
+
+
+def test_token_bucket_takes_several_tokens():
+    bucket = TokenBucket(rate=2.0, capacity=4)
+    bucket.timestamp = 0.0
+    assert bucket.delay(0.0, 3) == 0
+    bucket.take(3)
+    assert bucket.delay(0.0, 3) == pytest.approx(1.0)
+    assert bucket.delay(1.0, 3) == 0
+
+
+def test_unreachable_users_get_their_critical_messages_back(bot, outbound):
+    unreachable = []
+    failed = FailedDeliveries(on_unreachable=unreachable.append)
+    failed.start(outbound)
+    try:
+        failed.report(message_queue.Job("send_message", 7, {"chat_id": 7, "text": "your role"}, True, True),
+                      Unauthorized("bot was blocked by the user"))
+        failed.report(message_queue.Job("send_message", -7, {"chat_id": -7, "text": "board"}, True, True),
+                      Unauthorized("bot was kicked from the group chat"))
+    finally:
+        failed.stop(timeout=5)
+    assert unreachable == [7]
+    assert failed.is_unreachable(7) and not failed.is_unreachable(-7)
+    assert failed.returned(7) == 1
+    assert outbound.flush(timeout=5)
+    assert bot.texts(7)[-1] == "your role"
+    assert not failed.is_unreachable(7)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import rate_limit
+from rate_limit import RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    A stopped time.monotonic() for the rate limiter and its buckets; set clock.now to move it
+    """
+    class Clock(object):
+        now = 1000.0
+
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: Clock.now)
+    return Clock
+
+
+def test_requests_pass_until_the_burst_is_used_up(clock):
+    limiter = RateLimiter(user_rate=0.5, user_burst=3, chat_rate=10, chat_burst=100)
+    assert [limiter.check(1, -1) for _ in range(3)] == [0, 0, 0]
+    assert limiter.check(1, -1) == pytest.approx(2.0)
+    clock.now += 2
+    assert limiter.check(1, -1) == 0
+
+
+def test_expensive_commands_take_more_tokens_but_never_more_than_a_burst(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=4, chat_rate=10, chat_burst=100)
+    assert limiter.check(1, -1, rate_limit.cost("logs")) == 0  # costs 5: takes the whole burst
+    assert limiter.check(1, -1, rate_limit.cost("ja")) == pytest.approx(1.0)
+
+
+def test_users_and_chats_have_separate_buckets(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=2, chat_rate=1, chat_burst=3)
+    assert [limiter.check(1, -1) for _ in range(2)] == [0, 0]
+    assert limiter.check(1, -1) > 0  # the user's bucket is empty
+    assert limiter.check(2, -1) == 0
+    assert limiter.check(3, -1) > 0  # the chat's bucket is empty
+    assert limiter.check(3, -2) == 0
+
+
+def test_throttled_users_are_warned_once(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=1, chat_rate=10, chat_burst=100)
+    limiter.check(1, -1)
+    assert limiter.check(1, -1) > 0
+    assert limiter.warn(1)
+    assert limiter.check(1, -1) > 0
+    assert not limiter.warn(1)
+    clock.now += 1
+    assert limiter.check(1, -1) == 0
+    assert limiter.check(1, -1) > 0
+    assert limiter.warn(1)
+
+
+def test_full_buckets_are_pruned(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=2, chat_rate=1, chat_burst=2)
+    limiter.check(1, -1)
+    clock.now += 1
+    limiter.check(2, -2)
+    clock.now += 0.5
+    limiter._prune(clock.now)
+    assert list(limiter._users) == [2] and list(limiter._chats) == [-2]
+
+
+def test_command_costs():
+    assert rate_limit.cost("logs") == 5
+    assert rate_limit.cost("button") == rate_limit.cost("ja") == rate_limit.DEFAULT_COST
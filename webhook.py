@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+import json
+import logging
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+API_URL = "https://api.telegram.org"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_BODY = 1 << 20  # Telegram updates are far smaller than this
+
+
+def load_settings(fname):
+    """
+    Read a settings file with one "key = value" per line (lines starting with # are ignored).
+    Returns None if the file does not exist.
+    """
+    try:
+        with open(fname, "r") as settings_file:
+            lines = settings_file.read().splitlines()
+    except IOError:
+        return None
+    settings = {}
+    for line in lines:
+        if line.strip() and not line.strip().startswith("#"):
+            key, value = line.split("=", 1)
+            settings[key.strip()] = value.strip()
+    return settings
+
+
+def set_webhook(api_key, url, secret, max_connections=40, allowed_updates=None, api_url=API_URL):
+    """
+    Tell Telegram to push updates to `url`, signed with `secret`.
+    (Called via plain HTTP because not every python-telegram-bot version knows about secret tokens.)
+    """
+    data = {"url": url, "secret_token": secret, "max_connections": max_connections}
+    if allowed_updates is not None:
+        data["allowed_updates"] = allowed_updates
+    request = urllib.request.Request("{}/bot{}/setWebhook".format(api_url, api_key),
+                                     data=json.dumps(data).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        result = json.loads(response.read().decode("utf-8"))
+    if not result.get("ok"):
+        raise RuntimeError("setWebhook failed: {}".format(result))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default of 5 makes bursts of connections wait for a SYN retry
+
+
+class WebhookServer(object):
+    """
+    Local HTTP listener for updates pushed by Telegram.
+
+    Every POST to `path` must carry the secret token that was registered with
+    set_webhook. Its JSON body is passed to on_update(data) right away, on the
+    request's own thread; at most `concurrency` requests are handled at the
+    same time (Telegram opens up to max_connections, see set_webhook). If `record_to` is given, every accepted update is also
+    appended to that file (one JSON object per line), e.g. for
+    benchmarks/webhook_replay.py.
+    """
+
+    def __init__(self, on_update, secret, listen="127.0.0.1", port=8443, path="/", concurrency=40,
+                 record_to=None):
+        self.on_update = on_update
+        self.secret = secret.encode("utf-8")
+        self.path = path
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.record_file = open(record_to, "a") if record_to else None
+        self.record_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((listen, port), self._handler_class())
+        self.thread = None
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.send_response(server.handle_request(self.path, self.headers, self.rfile))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.getLogger(__name__).debug(format, *args)
+
+        return Handler
+
+    def handle_request(self, path, headers, body):
+        """
+        Returns the HTTP status code for a request
+        """
+        if path != self.path:
+            return 404
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode("utf-8"), self.secret):
+            logging.getLogger(__name__).warning("Rejected a webhook request with a wrong secret token")
+            return 403
+        length = int(headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            return 413
+        try:
+            data = json.loads(body.read(length).decode("utf-8"))
+        except ValueError:
+            return 400
+
+        with self.slots:
+            if self.record_file is not None:
+                with self.record_lock:
+                    self.record_file.write(json.dumps(data) + "\n")
+                    self.record_file.flush()
+            try:
+                self.on_update(data)
+            except Exception:
+                logging.getLogger(__name__).exception("Handing over update %s failed", data.get("update_id"))
+                return 500
+        return 200
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="webhook")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.record_file is not None:
+            self.record_file.close()